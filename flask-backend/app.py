@@ -1,29 +1,568 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 import firebase_admin
-from firebase_admin import credentials, messaging, firestore
+from firebase_admin import credentials, exceptions, messaging, firestore
+import atexit
+import hashlib
 import json
 import os
-from datetime import datetime
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from user_lookup import resolve_fcm_tokens
+from fanout import FCM_MULTICAST_LIMIT, is_transient_error, send_multicast_batched
+from notification_log import NotificationLogWriter
+from token_cache import TokenCache, is_invalid_token_error
+from token_hygiene import STALE_TOPIC_REASONS, TokenPruner, stale_token_reason, stale_tokens, sweep_tokens
+from donor_index import DonorIndex, normalize_blood_group
+from geo import parse_coordinates
+from blood_compat import CompatibilityIndex, eligible_donor_groups
+from donor_match import DonorTable, NotifiedCounts, request_donor_ids
+from request_index import RequestIndex
+from views import CollectionView, ViewWatchdog
+from snapshot import SnapshotError, load_donor_snapshot, write_donor_snapshot
+from bulk_users import (CSV, FORMATS, NDJSON, InvalidUpload, export_users, import_users, parse_rows, prune_uploads,
+                        to_ndjson)
+from rollups import BUCKET_SPANS, DAY, GRANULARITIES, HOUR, archive_notifications, merge_aggregates, new_aggregate, read_stats, \
+    rolled_up_until, rollup_notifications
+from jobs import FAILED, JobQueue, JobStore
+from cursors import decode_cursor, encode_cursor
+from coalesce import IdempotencyConflict, RequestCoalescer, request_fingerprint
+from rate_limit import DonorRateLimiter, QuietHours
+from local_backend import local_backend_from_env
+from metrics import Metrics, TimedJSONProvider, TracedFirestore, TracedMessaging
+from resilience import (CLOSED, OPEN, AdaptiveLimit, BackendUnavailable, CircuitBreaker, Dependency, clear_deadline,
+                        deadline_scope, is_dependency_failure, retry_after_header, set_deadline)
+from profiler import SamplingProfiler
+from waves import ACTIVE, CANCELLED, DEFAULT_WAVE_STEPS, EXHAUSTED, FILLED, WaveScheduler, WaveStore
+from topics import (FCM_TOPIC_BATCH_LIMIT, INVALID_TOKEN_REASONS, is_valid_topic, manage_topic_subscriptions,
+                    subscription_id, write_subscription_records)
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from google.api_core.exceptions import DeadlineExceeded
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for React Native requests
 
-# Initialize Firebase Admin SDK
-# You'll need to download your Firebase service account key
-# Place it in the same directory as this file and name it 'firebase-service-account.json'
-try:
-    cred = credentials.Certificate('firebase-service-account.json')
-    firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    print("Firebase Admin SDK initialized successfully")
-except Exception as e:
-    print(f"Error initializing Firebase: {e}")
+# Request, Firestore, FCM and JSON timings served in Prometheus format at /metrics
+metrics = Metrics()
+app.json = TimedJSONProvider(app, metrics)
+# Sampling profiler, off unless PROFILER_ENABLED is set or it is switched on through /profiler
+profiler = SamplingProfiler()
+
+# Recently used FCM tokens, so repeat notifications skip the users lookup
+token_cache = TokenCache(max_size=50000, ttl=600)
+
+# Per-donor push budget: a burst of DONOR_PUSH_BURST, refilled at DONOR_PUSHES_PER_HOUR
+# QUIET_HOURS such as '22-7' (local to QUIET_HOURS_UTC_OFFSET_MINUTES) holds back non-urgent pushes
+quiet_hours = QuietHours.parse(
+    os.environ.get('QUIET_HOURS', ''), int(os.environ.get('QUIET_HOURS_UTC_OFFSET_MINUTES', 0))
+)
+donor_limiter = DonorRateLimiter(
+    capacity=float(os.environ.get('DONOR_PUSH_BURST', 6)),
+    refill_per_hour=float(os.environ.get('DONOR_PUSHES_PER_HOUR', 6)),
+    max_donors=int(os.environ.get('DONOR_RATE_LIMIT_MAX_DONORS', 1000000)),
+    quiet_hours=quiet_hours
+)
+# Topic sends only guard against runaway loops, so each topic gets a separate, much larger budget
+topic_limiter = DonorRateLimiter(
+    capacity=float(os.environ.get('TOPIC_PUSH_BURST', 100)),
+    refill_per_hour=float(os.environ.get('TOPIC_PUSHES_PER_HOUR', 1000)),
+    max_donors=1024,
+    quiet_hours=quiet_hours
+)
+
+# In-memory donor indexes, kept in sync with the users collection
+donor_index = DonorIndex()
+compat_index = CompatibilityIndex()
+# Columnar donor table scored by /match-donors; accept history comes from the requests collection
+donor_table = DonorTable()
+# Open blood requests by location, served to donors by /nearby-requests
+request_index = RequestIndex()
+DEFAULT_REQUEST_FEED_RADIUS_KM = 15
+DEFAULT_REQUEST_FEED_PAGE_SIZE = 50
+MAX_REQUEST_FEED_PAGE_SIZE = 200
+URGENT_LEVELS = {'critical', 'emergency'}
+DEFAULT_NEARBY_RADIUS_KM = 25
+MAX_NEARBY_RADIUS_KM = 500
+DEFAULT_MAX_RECIPIENTS = 100
+MAX_RECIPIENTS_LIMIT = 5000
+
+# Send endpoints queue jobs that worker threads run with retries; jobs persist in SQLite
+JOBS_DB_PATH = os.environ.get('JOBS_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.sqlite3'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_RETENTION_SECONDS = 7 * 24 * 3600
+FANOUT_BATCH_RETRIES = 2
+
+# Donor state is snapshotted this often for warm restarts, next to the jobs database; 0 disables snapshots
+DONOR_SNAPSHOT_PATH = os.environ.get(
+    'DONOR_SNAPSHOT_PATH', os.path.join(os.path.dirname(os.path.abspath(JOBS_DB_PATH)), 'donors.snapshot')
+)
+DONOR_SNAPSHOT_INTERVAL_SECONDS = float(os.environ.get('DONOR_SNAPSHOT_INTERVAL_SECONDS', 300))
+donor_snapshot_stats = {}
+
+# Bulk topic management limits per request
+MAX_BULK_TOPIC_USERS = 100000
+MAX_BULK_TOPICS = 20
+
+# /bulk/users uploads are spooled here, then a job streams them into users through a BulkWriter
+BULK_UPLOAD_DIR = os.environ.get(
+    'BULK_UPLOAD_DIR', os.path.join(os.path.dirname(os.path.abspath(JOBS_DB_PATH)), 'bulk-uploads')
+)
+MAX_BULK_UPLOAD_BYTES = int(os.environ.get('MAX_BULK_UPLOAD_BYTES', 256 * 1024 * 1024))
+BULK_IMPORT_MAX_OPS_PER_SECOND = int(os.environ.get('BULK_IMPORT_MAX_OPS_PER_SECOND', 500))
+BULK_UPLOAD_CHUNK_BYTES = 64 * 1024
+UPLOAD_CONTENT_TYPES = {'application/x-ndjson': NDJSON, 'application/jsonl': NDJSON, 'text/csv': CSV}
+bulk_user_rows = metrics.counter('bulk_user_rows_total', 'Users rows imported or exported in bulk by outcome',
+                                 ('direction', 'outcome'))
+
+# Every stored token is validated with a dry-run send this often; 0 disables the periodic sweep
+TOKEN_SWEEP_INTERVAL_HOURS = float(os.environ.get('TOKEN_SWEEP_INTERVAL_HOURS', 24))
+
+# Notification logs are rolled up into hourly/daily stats this often; 0 disables the periodic rollup
+# Rolled up logs older than NOTIFICATION_RETENTION_DAYS move to gzip JSONL files and leave Firestore
+NOTIFICATION_ROLLUP_INTERVAL_HOURS = float(os.environ.get('NOTIFICATION_ROLLUP_INTERVAL_HOURS', 1))
+NOTIFICATION_RETENTION_DAYS = float(os.environ.get('NOTIFICATION_RETENTION_DAYS', 30))
+NOTIFICATION_ARCHIVE_DIR = os.environ.get(
+    'NOTIFICATION_ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(JOBS_DB_PATH)), 'notification-archive')
+)
+MAX_STATS_BUCKETS = {HOUR: 24 * 31, DAY: 366}
+DEFAULT_STATS_RANGE = {HOUR: timedelta(hours=24), DAY: timedelta(days=7)}
+
+# Notification history is served in pages; fcmToken is never returned
+DEFAULT_NOTIFICATIONS_PAGE_SIZE = 50
+MAX_NOTIFICATIONS_PAGE_SIZE = 100
+NOTIFICATION_FIELDS = {
+    'userId', 'type', 'topic', 'title', 'body', 'data', 'status', 'sentAt', 'messageId', 'batchId',
+    'error', 'bloodType', 'location', 'urgency', 'requesterName', 'hospitalName', 'distanceKm'
+}
+job_queue = JobQueue(JobStore(JOBS_DB_PATH), workers=JOB_WORKERS)
+
+# Identical blood requests within this many seconds reuse the first send; Idempotency-Keys live a day
+BLOOD_REQUEST_DEDUPE_WINDOW_SECONDS = float(os.environ.get('BLOOD_REQUEST_DEDUPE_WINDOW_SECONDS', 300))
+IDEMPOTENCY_KEY_TTL_SECONDS = 24 * 3600
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+def is_reusable_outcome(outcome):
+    """A remembered send may be handed to duplicates unless its job or inline run failed"""
+    if 'jobId' in outcome:
+        job = job_queue.store.get(outcome['jobId'])
+        return job is not None and job['status'] != FAILED
+    return outcome['status'] < 500
+
+# Urgent requests with a requestId escalate in waves: WAVE_SIZE donors, then wait WAVE_INTERVAL_SECONDS
+WAVE_SIZE = int(os.environ.get('WAVE_SIZE', 20))
+WAVE_INTERVAL_SECONDS = float(os.environ.get('WAVE_INTERVAL_SECONDS', 300))
+MAX_WAVE_SIZE = 500
+MAX_WAVE_FAILURES = 3
+wave_store = WaveStore(JOBS_DB_PATH)
+# Blood request pushes per donor, the denominator of accept rates, outlive the process next to the jobs
+notified_counts = NotifiedCounts(JOBS_DB_PATH)
+
+request_coalescer = RequestCoalescer(
+    window=BLOOD_REQUEST_DEDUPE_WINDOW_SECONDS,
+    idempotency_ttl=IDEMPOTENCY_KEY_TTL_SECONDS,
+    is_reusable=is_reusable_outcome
+)
+
+def apply_user_change(user_id, user_data):
+    """Apply one users document, or None for a removal, to the in-memory donor views"""
+    donor_index.apply_user(user_id, user_data)
+    compat_index.apply_user(user_id, user_data)
+    donor_table.apply_user(user_id, user_data)
+    if user_data is None or not user_data.get('fcmToken'):
+        token_cache.invalidate(user_id)
+    else:
+        token_cache.put(user_id, user_data['fcmToken'])
+
+def on_users_synced():
+    donor_index.ready = True
+    compat_index.ready = True
+    donor_table.ready = True
+
+def apply_request_change(request_id, request_data):
+    """Count donor acceptances and index open requests from one requests document"""
+    donor_table.apply_request(request_id, request_data)
+    request_index.apply_request(request_id, request_data)
+
+def on_requests_synced():
+    request_index.ready = True
+
+# Listeners on users and requests keep the views above current; the watchdog resubscribes dead ones
+users_view = CollectionView('users', apply_user_change, on_synced=on_users_synced)
+requests_view = CollectionView('requests', apply_request_change, on_synced=on_requests_synced)
+view_watchdog = ViewWatchdog(
+    [users_view, requests_view], interval=float(os.environ.get('VIEW_WATCH_CHECK_SECONDS', 5))
+)
+
+# Every Firestore and FCM call goes through its dependency's circuit breaker and AIMD concurrency limit.
+# A breaker opens after BREAKER_FAILURE_THRESHOLD consecutive timeouts or outage errors and fails calls
+# fast for BREAKER_RESET_SECONDS; the limit halves whenever a call is slower than the latency target.
+# Calls made for a request also get the time left before its deadline: the Request-Timeout header, in
+# seconds, or REQUEST_TIMEOUT_SECONDS (0 for none).
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get('REQUEST_TIMEOUT_SECONDS', 30))
+MAX_REQUEST_TIMEOUT_SECONDS = 300
+TIMEOUT_ERRORS = (DeadlineExceeded, exceptions.DeadlineExceededError, TimeoutError)
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', 10))
+
+def backend_dependency(name, max_concurrency, latency_target_ms):
+    return Dependency(
+        name,
+        CircuitBreaker(failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_SECONDS),
+        AdaptiveLimit(max_concurrency, latency_target=latency_target_ms / 1000)
+    )
+
+dependencies = {
+    'firestore': backend_dependency('firestore', int(os.environ.get('FIRESTORE_MAX_CONCURRENCY', 64)),
+                                    float(os.environ.get('FIRESTORE_LATENCY_TARGET_MS', 1000))),
+    'fcm': backend_dependency('fcm', int(os.environ.get('FCM_MAX_CONCURRENCY', 32)),
+                              float(os.environ.get('FCM_LATENCY_TARGET_MS', 3000))),
+}
+
+# Routes reach Firestore and FCM through these globals; init_backend swaps them
+NOTIFICATION_BACKEND = os.environ.get('NOTIFICATION_BACKEND', 'firebase')
+db = None
+db_source = None
+log_writer = None
+token_pruner = None
+
+def warm_start_donors():
+    """Fill the donor views from the last snapshot; returns the ids and read time the users view catches up from"""
+    if donor_table.ready or DONOR_SNAPSHOT_INTERVAL_SECONDS <= 0 or not os.path.exists(DONOR_SNAPSHOT_PATH):
+        return (), None
+    started = time.perf_counter()
+    try:
+        snapshot = load_donor_snapshot(DONOR_SNAPSHOT_PATH, donor_table, donor_index, compat_index, source=db_source)
+    except (SnapshotError, OSError, ValueError, KeyError) as e:
+        print(f"Ignoring donor snapshot {DONOR_SNAPSHOT_PATH}: {e}")
+        return (), None
+    on_users_synced()
+    donor_snapshot_stats.update({
+        'loadedDonors': snapshot.count,
+        'loadedReadTime': snapshot.meta['readTime'],
+        'loadSeconds': round(time.perf_counter() - started, 3),
+    })
+    print(f"Loaded {snapshot.count} donors from {DONOR_SNAPSHOT_PATH} in {donor_snapshot_stats['loadSeconds']}s")
+    return snapshot.strings['userIds'], snapshot.meta['readTime']
+
+def take_donor_snapshot():
+    """Write the donor table as of the users view's last read time; returns the stats, or None unless the view is live"""
+    started = time.perf_counter()
+    read_time, exported = users_view.read_consistent(donor_table.export)
+    if read_time is None:
+        return None
+    size = write_donor_snapshot(DONOR_SNAPSHOT_PATH, exported, read_time.timestamp(), source=db_source)
+    donor_snapshot_stats.update({
+        'path': DONOR_SNAPSHOT_PATH,
+        'donors': len(exported[0]),
+        'bytes': size,
+        'readTime': read_time.timestamp(),
+        'takenAt': time.time(),
+        'writeSeconds': round(time.perf_counter() - started, 3),
+    })
+    return dict(donor_snapshot_stats)
+
+def init_backend(firestore_client, messaging_client=messaging):
+    """Point the routes at a Firestore client and an FCM messaging module, or stand-ins with the same API"""
+    global db, db_source, messaging, log_writer, token_pruner
+    stop_backend()
+    # Snapshots are only loaded into a process talking to the project they were taken from
+    db_source = getattr(firestore_client, 'project', None)
+    # Every Firestore and FCM call made through these is timed as a backend span
+    db = TracedFirestore(firestore_client, metrics, dependencies['firestore'])
+    messaging = TracedMessaging(messaging_client, metrics, dependencies['fcm'])
+    token_cache.clear()
+    # Outcomes remembered from the previous backend say nothing about this one
+    request_coalescer.clear()
+    # Notification logs are committed in batches by a background thread
+    log_writer = NotificationLogWriter(db).start()
+    # Tokens FCM rejects as dead are cleared from users and their topics in the background
+    token_pruner = TokenPruner(db, messaging, on_pruned=token_cache.invalidate).start()
+    known_ids, since = warm_start_donors()
+    users_view.start(db, known_ids, since)
+    requests_view.start(db)
+
+def stop_backend():
+    """Stop the users and requests listeners and flush queued notification logs and token prunes"""
+    users_view.stop()
+    requests_view.stop()
+    if log_writer is not None:
+        log_writer.stop()
+    if token_pruner is not None:
+        token_pruner.stop()
+
+atexit.register(stop_backend)
+
+def init_default_backend():
+    """Connect to the Firebase project, or to the in-memory stand-ins with NOTIFICATION_BACKEND=local"""
+    # You'll need to download your Firebase service account key
+    # Place it in the same directory as this file and name it 'firebase-service-account.json'
+    try:
+        if NOTIFICATION_BACKEND == 'local':
+            init_backend(*local_backend_from_env())
+            print("Using the in-memory local Firestore/FCM backend")
+        else:
+            cred = credentials.Certificate('firebase-service-account.json')
+            firebase_admin.initialize_app(cred)
+            init_backend(firestore.client())
+            print("Firebase Admin SDK initialized successfully")
+    except Exception as e:
+        print(f"Error initializing Firebase: {e}")
+
+def get_user_fcm_token(user_id):
+    """Return (fcm_token, user_exists) for a user, reading Firestore only on a cache miss"""
+    fcm_token = token_cache.get(user_id)
+    if fcm_token:
+        return fcm_token, True
+    
+    user_doc = db.collection('users').document(user_id).get()
+    if not user_doc.exists:
+        return None, False
+    
+    fcm_token = user_doc.to_dict().get('fcmToken')
+    token_cache.put(user_id, fcm_token)
+    return fcm_token, True
+
+def run_or_queue_job(kind, payload, wait):
+    """Run a job inline or persist it for the workers; returns the outcome to hand to duplicates"""
+    if wait:
+        result, status = job_queue.handler(kind)(payload, None)
+        return {'result': result, 'status': status}
+    return {'jobId': job_queue.submit(kind, payload)}
+
+def job_response(outcome, deduplicated=False, wait=False):
+    """Turn a job outcome into the route response"""
+    if 'result' in outcome:
+        result = dict(outcome['result'], deduplicated=True) if deduplicated else outcome['result']
+        response = jsonify(result)
+        if result.get('retryAfterSeconds') is not None:
+            response.headers['Retry-After'] = str(result['retryAfterSeconds'])
+        return response, outcome['status']
+    
+    job_id = outcome['jobId']
+    status = 'queued'
+    if deduplicated:
+        job = job_queue.status(job_id)
+        status = job['status']
+        # A waiting caller gets the finished result of the job it was collapsed into
+        if wait and job['result'] is not None:
+            return jsonify(dict(job['result'], deduplicated=True, jobId=job_id)), job['httpStatus']
+    body = {
+        "success": True,
+        "message": "Duplicate request, returning the existing job" if deduplicated else "Job queued",
+        "jobId": job_id,
+        "status": status,
+        "statusUrl": f"/jobs/{job_id}"
+    }
+    if deduplicated:
+        body["deduplicated"] = True
+    return jsonify(body), 202
+
+def dispatch_job(kind, payload, coalesce_key=None):
+    """Queue a background job and answer 202, or run it inline when the caller passes ?wait=true
+    
+    A request repeating an Idempotency-Key header, or sharing coalesce_key with
+    one in flight or in the dedupe window, gets the earlier job or result.
+    """
+    wait = request.args.get('wait', '').lower() in ('1', 'true', 'yes')
+    # A caller that sent Request-Timeout bounds its queued job too; other jobs take as long as they need
+    timeout = request_timeout() if 'Request-Timeout' in request.headers else None
+    if timeout is not None and not wait:
+        payload = dict(payload, deadlineAt=time.time() + timeout)
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if not idempotency_key and coalesce_key is None:
+        return job_response(run_or_queue_job(kind, payload, wait))
+    
+    if idempotency_key and len(idempotency_key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        return jsonify({"error": f"Idempotency-Key must be at most {MAX_IDEMPOTENCY_KEY_LENGTH} characters"}), 400
+    
+    try:
+        outcome, how = request_coalescer.execute(
+            lambda: run_or_queue_job(kind, payload, wait),
+            request_fingerprint(kind, payload, ignore=('timestamp', 'deadlineAt')),
+            coalesce_key=coalesce_key,
+            idempotency_key=f"{kind}:{idempotency_key}" if idempotency_key else None
+        )
+    except IdempotencyConflict as e:
+        return jsonify({"error": str(e)}), 422
+    
+    if how is not None:
+        metrics.deduplicated.inc(kind, how)
+        print(f"Duplicate {kind} request {how} an earlier send")
+    return job_response(outcome, deduplicated=how is not None, wait=wait)
+
+def request_timeout():
+    """Seconds the caller will wait, from its Request-Timeout header or the default; None for no deadline"""
+    try:
+        timeout = float(request.headers['Request-Timeout'])
+    except (KeyError, ValueError):
+        timeout = REQUEST_TIMEOUT_SECONDS
+    if timeout <= 0:
+        return None
+    return min(timeout, MAX_REQUEST_TIMEOUT_SECONDS)
+
+def error_response(e):
+    """503 with Retry-After for a backend call failed fast, 503/504 for a failing or timed out backend, else 500"""
+    if isinstance(e, BackendUnavailable):
+        response = jsonify({
+            "error": str(e),
+            "dependency": e.dependency,
+            "reason": e.reason,
+            "retryAfterSeconds": round(e.retry_after, 3)
+        })
+        response.headers['Retry-After'] = retry_after_header(e.retry_after)
+        return response, 503
+    if is_dependency_failure(e):
+        return jsonify({"error": str(e)}), 504 if isinstance(e, TIMEOUT_ERRORS) else 503
+    return jsonify({"error": str(e)}), 500
+
+@app.errorhandler(BackendUnavailable)
+def backend_unavailable(e):
+    return error_response(e)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.deadline_token = set_deadline(request_timeout())
+
+@app.after_request
+def record_request_latency(response):
+    token = g.pop('deadline_token', None)
+    if token is not None:
+        # A streamed body is generated after this, without the request's deadline
+        clear_deadline(token)
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.requests.observe(time.perf_counter() - started, request.method, route, str(response.status_code))
+    return response
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({"status": "healthy", "timestamp": datetime.now().isoformat()})
+    return jsonify({
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        # Answered without touching a backend; an open breaker means that dependency is being failed fast
+        "dependencies": {name: dependency.breaker.state for name, dependency in dependencies.items()}
+    })
+
+@app.route('/notification-log-stats', methods=['GET'])
+def notification_log_stats():
+    """Queue depth and flush latency of the notification log writer"""
+    return jsonify({"success": True, "stats": log_writer.stats()})
+
+@app.route('/token-cache-stats', methods=['GET'])
+def token_cache_stats():
+    """Hit, miss and eviction counters of the FCM token cache"""
+    return jsonify({"success": True, "stats": token_cache.stats()})
+
+@app.route('/rate-limit-stats', methods=['GET'])
+def rate_limit_stats():
+    """Allowed and throttled counts and memory use of the per-donor and per-topic rate limiters"""
+    return jsonify({"success": True, "stats": donor_limiter.stats(), "topicStats": topic_limiter.stats()})
+
+@app.route('/coalescing-stats', methods=['GET'])
+def coalescing_stats():
+    """Executed, joined and replayed counts of the request deduplication layer"""
+    return jsonify({"success": True, "stats": request_coalescer.stats()})
+
+@app.route('/view-stats', methods=['GET'])
+def view_stats():
+    """Consistency metadata of the in-memory users and requests views and the indexes built on them"""
+    return jsonify({
+        "success": True,
+        "views": [users_view.stats(), requests_view.stats()],
+        "indexes": {
+            "donors": donor_index.stats(),
+            "compatibility": compat_index.stats(),
+            "donorTable": donor_table.stats(),
+            "openRequests": request_index.stats()
+        },
+        "snapshot": donor_snapshot_stats
+    })
+
+@app.route('/resilience', methods=['GET'])
+def get_resilience():
+    """Circuit breaker state, concurrency limit and fast-failed calls of each backend dependency"""
+    return jsonify({
+        "success": True,
+        "dependencies": {name: dependency.stats() for name, dependency in dependencies.items()}
+    })
+
+@app.route('/resilience', methods=['POST'])
+def set_resilience():
+    """Hold a dependency's breaker open, or close it and reset its concurrency limit"""
+    try:
+        data = request.get_json(silent=True) or {}
+        dependency = dependencies.get(data.get('dependency'))
+        if dependency is None:
+            return jsonify({"error": f"dependency must be one of {', '.join(dependencies)}"}), 400
+        state = data.get('state')
+        if state not in (OPEN, CLOSED):
+            return jsonify({"error": f"state must be {OPEN} or {CLOSED}"}), 400
+        dependency.breaker.force(state)
+        if state == CLOSED:
+            dependency.limit.reset()
+        print(f"{dependency.name} breaker set {state} through /resilience")
+        return jsonify({"success": True, "dependency": dependency.name, **dependency.stats()})
+    except Exception as e:
+        print(f"Error updating resilience settings: {e}")
+        return error_response(e)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request, backend call, FCM error and job metrics in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/profiler', methods=['GET'])
+def get_profiler():
+    """Sampling profiler status and hottest stacks; ?format=collapsed returns flame graph input"""
+    if request.args.get('format') == 'collapsed':
+        return Response(profiler.collapsed(), mimetype='text/plain')
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    return jsonify({
+        "success": True,
+        "profiler": profiler.stats(),
+        "stacks": [{"stack": stack, "samples": count} for stack, count in profiler.top(limit)]
+    })
+
+@app.route('/profiler', methods=['POST'])
+def toggle_profiler():
+    """Start or stop the sampling profiler at runtime"""
+    try:
+        data = request.get_json() or {}
+        enabled = data.get('enabled')
+        interval_ms = data.get('intervalMs')
+        
+        if not isinstance(enabled, bool):
+            return jsonify({"error": "enabled must be true or false"}), 400
+        if interval_ms is not None and (not isinstance(interval_ms, (int, float)) or not 1 <= interval_ms <= 1000):
+            return jsonify({"error": "intervalMs must be a number between 1 and 1000"}), 400
+        
+        if data.get('reset'):
+            profiler.reset()
+        if enabled:
+            profiler.start(interval_ms / 1000 if interval_ms is not None else None)
+        else:
+            profiler.stop()
+        return jsonify({"success": True, "profiler": profiler.stats()})
+        
+    except Exception as e:
+        print(f"Error toggling profiler: {e}")
+        return error_response(e)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status, progress and result of a queued notification job"""
+    job = job_queue.status(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({"success": True, "job": job})
 
 @app.route('/save-fcm-token', methods=['POST'])
 def save_fcm_token():
@@ -45,6 +584,7 @@ def save_fcm_token():
             'lastTokenUpdate': firestore.SERVER_TIMESTAMP,
             'updatedAt': firestore.SERVER_TIMESTAMP
         }, merge=True)
+        token_cache.put(user_id, fcm_token)
         
         print(f"FCM token saved for user {user_id}")
         return jsonify({
@@ -55,7 +595,84 @@ def save_fcm_token():
         
     except Exception as e:
         print(f"Error saving FCM token: {e}")
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
+def throttled_result(message, key, limiter=None, **fields):
+    """429 result for a send held back by a rate limiter, the donor one by default, or quiet hours"""
+    limiter = limiter or donor_limiter
+    result = {"error": message, "throttled": True, "retryAfterSeconds": limiter.retry_after(key)}
+    result.update(fields)
+    return result, 429
+
+def send_or_refund(message, limiter, key):
+    """Send one message, giving back the push limiter counted for key if the send fails"""
+    try:
+        return messaging.send(message)
+    except Exception:
+        limiter.refund([key])
+        raise
+
+def run_send_notification(payload, progress=None):
+    """Send a notification to one user; returns (response body, HTTP status)"""
+    user_id = payload['userId']
+    title = payload['title']
+    body = payload['body']
+    custom_data = payload.get('data', {})
+    
+    # Get user's FCM token from the cache or Firestore
+    fcm_token, user_exists = get_user_fcm_token(user_id)
+    
+    if not user_exists:
+        return {"error": "User not found"}, 404
+    
+    if not fcm_token:
+        return {"error": "FCM token not found for user"}, 404
+    
+    if not donor_limiter.acquire(user_id):
+        return throttled_result("Notification rate limit reached for user", user_id, userId=user_id)
+    
+    # Create notification message
+    message = messaging.Message(
+        notification=messaging.Notification(
+            title=title,
+            body=body,
+        ),
+        data=custom_data,
+        token=fcm_token,
+    )
+    
+    # Send notification, dropping the cached token if FCM rejects it
+    try:
+        response = messaging.send(message)
+    except Exception as e:
+        # Nothing was delivered, so a retried job must not be charged for this attempt
+        donor_limiter.refund([user_id])
+        if is_invalid_token_error(e):
+            token_cache.invalidate(user_id, fcm_token)
+        reason = stale_token_reason(e)
+        if reason is not None:
+            token_pruner.enqueue((user_id, fcm_token, reason))
+        raise
+    
+    # Queue notification log
+    log_writer.enqueue({
+        'userId': user_id,
+        'title': title,
+        'body': body,
+        'data': custom_data,
+        'fcmToken': fcm_token,
+        'messageId': response,
+        'sentAt': firestore.SERVER_TIMESTAMP,
+        'status': 'sent'
+    })
+    
+    print(f"Notification sent to user {user_id}: {response}")
+    return {
+        "success": True,
+        "message": "Notification sent successfully",
+        "messageId": response,
+        "userId": user_id
+    }, 200
 
 @app.route('/send-notification', methods=['POST'])
 def send_notification():
@@ -70,55 +687,138 @@ def send_notification():
         if not user_id or not title or not body:
             return jsonify({"error": "userId, title, and body are required"}), 400
         
-        # Get user's FCM token from Firestore
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
-        
-        if not user_doc.exists:
-            return jsonify({"error": "User not found"}), 404
-        
-        user_data = user_doc.to_dict()
-        fcm_token = user_data.get('fcmToken')
+        return dispatch_job('send-notification', {
+            'userId': user_id,
+            'title': title,
+            'body': body,
+            'data': custom_data
+        })
         
-        if not fcm_token:
-            return jsonify({"error": "FCM token not found for user"}), 404
+    except Exception as e:
+        print(f"Error sending notification: {e}")
+        return error_response(e)
+
+def send_multicast_and_log(user_ids, tokens, title, body, custom_data, log_fields=None, recipient_fields=None,
+                           progress=None, urgent=False):
+    """Multicast to aligned user_ids/tokens, evict rejected tokens and queue one log per user
+    
+    Recipients over their push budget are dropped before batching; returns
+    (BatchResponse, throttled count, user ids sent to in the order of its responses).
+    """
+    allowed = donor_limiter.acquire_many(user_ids, urgent=urgent)
+    throttled = len(allowed) - sum(allowed)
+    if throttled:
+        user_ids = [user_id for user_id, ok in zip(user_ids, allowed) if ok]
+        tokens = [token for token, ok in zip(tokens, allowed) if ok]
+        if recipient_fields:
+            recipient_fields = [fields for fields, ok in zip(recipient_fields, allowed) if ok]
+    
+    on_batch = None
+    if progress is not None:
+        progress.update(
+            recipients=len(tokens),
+            batches=-(-len(tokens) // FCM_MULTICAST_LIMIT),
+            batchesDone=0,
+            successCount=0,
+            failureCount=0
+        )
         
-        # Create notification message
-        message = messaging.Message(
-            notification=messaging.Notification(
+        def on_batch(index, total, responses):
+            succeeded = sum(1 for r in responses if r.success)
+            progress.increment(batchesDone=1, successCount=succeeded, failureCount=len(responses) - succeeded)
+    
+    try:
+        response = send_multicast_batched(
+            messaging,
+            tokens,
+            messaging.Notification(
                 title=title,
                 body=body,
             ),
-            data=custom_data,
-            token=fcm_token,
+            custom_data,
+            retries=FANOUT_BATCH_RETRIES,
+            on_batch=on_batch,
         )
-        
-        # Send notification
-        response = messaging.send(message)
-        
-        # Log notification sent
-        db.collection('notifications').add({
+    except Exception:
+        donor_limiter.refund(user_ids)
+        raise
+    # Pushes FCM did not deliver do not count against the donor, or a retried wave would be throttled
+    undelivered = [user_id for user_id, r in zip(user_ids, response.responses) if not r.success]
+    if undelivered:
+        donor_limiter.refund(undelivered)
+    
+    # Evict tokens FCM reported as unregistered or invalid and queue them for pruning
+    stale = stale_tokens(user_ids, tokens, response.responses)
+    for user_id, token, _ in stale:
+        token_cache.invalidate(user_id, token)
+    token_pruner.enqueue_many(stale)
+    
+    records = []
+    for i, user_id in enumerate(user_ids):
+        record = dict(log_fields or {})
+        if recipient_fields:
+            record.update(recipient_fields[i])
+        record.update({
             'userId': user_id,
             'title': title,
             'body': body,
-            'data': custom_data,
-            'fcmToken': fcm_token,
-            'messageId': response,
+            'fcmToken': tokens[i],
             'sentAt': firestore.SERVER_TIMESTAMP,
-            'status': 'sent'
-        })
-        
-        print(f"Notification sent to user {user_id}: {response}")
-        return jsonify({
-            "success": True,
-            "message": "Notification sent successfully",
-            "messageId": response,
-            "userId": user_id
+            'status': 'sent',
+            'batchId': response.responses[i].message_id if response.responses[i].success else None,
+            'error': str(response.responses[i].exception) if not response.responses[i].success else None
         })
-        
-    except Exception as e:
-        print(f"Error sending notification: {e}")
-        return jsonify({"error": str(e)}), 500
+        records.append(record)
+    log_writer.enqueue_many(records)
+    # Blood request pushes FCM accepted are the denominator of each donor's accept rate
+    if (log_fields or {}).get('type') == 'blood_request':
+        notified = [user_id for user_id, r in zip(user_ids, response.responses) if r.success]
+        donor_table.record_notified(notified)
+        notified_counts.add(notified)
+    return response, throttled, user_ids
+
+def run_send_notification_to_multiple(payload, progress=None):
+    """Send a notification to many users; returns (response body, HTTP status)"""
+    user_ids = payload['userIds']
+    title = payload['title']
+    body = payload['body']
+    custom_data = payload.get('data', {})
+    
+    # Get FCM tokens for all users in chunked get_all round trips
+    lookup = resolve_fcm_tokens(db, user_ids, cache=token_cache)
+    tokens = lookup.tokens
+    valid_user_ids = lookup.user_ids
+    
+    if not tokens:
+        return {
+            "error": "No valid FCM tokens found",
+            "missingUserIds": lookup.missing,
+            "usersWithoutToken": lookup.without_token
+        }, 404
+    
+    # Send in parallel batches of up to 500 tokens and queue the logs
+    response, throttled, _ = send_multicast_and_log(
+        valid_user_ids, tokens, title, body, custom_data,
+        log_fields={'data': custom_data},
+        progress=progress
+    )
+    
+    if throttled == len(tokens):
+        return throttled_result("Notification rate limit reached for every user", valid_user_ids[0],
+                                throttledCount=throttled)
+    
+    print(f"Multicast notification sent: {response.success_count} successful, {response.failure_count} failed, "
+          f"{throttled} throttled")
+    return {
+        "success": True,
+        "message": "Multicast notification sent",
+        "successCount": response.success_count,
+        "failureCount": response.failure_count,
+        "throttledCount": throttled,
+        "totalCount": len(tokens),
+        "missingUserIds": lookup.missing,
+        "usersWithoutToken": lookup.without_token
+    }, 200
 
 @app.route('/send-notification-to-multiple', methods=['POST'])
 def send_notification_to_multiple():
@@ -133,63 +833,60 @@ def send_notification_to_multiple():
         if not user_ids or not title or not body:
             return jsonify({"error": "userIds, title, and body are required"}), 400
         
-        # Get FCM tokens for all users
-        tokens = []
-        valid_user_ids = []
-        
-        for user_id in user_ids:
-            user_ref = db.collection('users').document(user_id)
-            user_doc = user_ref.get()
-            
-            if user_doc.exists:
-                user_data = user_doc.to_dict()
-                fcm_token = user_data.get('fcmToken')
-                if fcm_token:
-                    tokens.append(fcm_token)
-                    valid_user_ids.append(user_id)
-        
-        if not tokens:
-            return jsonify({"error": "No valid FCM tokens found"}), 404
-        
-        # Create multicast message
-        message = messaging.MulticastMessage(
-            notification=messaging.Notification(
-                title=title,
-                body=body,
-            ),
-            data=custom_data,
-            tokens=tokens,
-        )
-        
-        # Send notification
-        response = messaging.send_multicast(message)
-        
-        # Log notifications
-        for i, user_id in enumerate(valid_user_ids):
-            db.collection('notifications').add({
-                'userId': user_id,
-                'title': title,
-                'body': body,
-                'data': custom_data,
-                'fcmToken': tokens[i],
-                'sentAt': firestore.SERVER_TIMESTAMP,
-                'status': 'sent',
-                'batchId': response.responses[i].message_id if response.responses[i].success else None,
-                'error': str(response.responses[i].exception) if not response.responses[i].success else None
-            })
-        
-        print(f"Multicast notification sent: {response.success_count} successful, {response.failure_count} failed")
-        return jsonify({
-            "success": True,
-            "message": "Multicast notification sent",
-            "successCount": response.success_count,
-            "failureCount": response.failure_count,
-            "totalCount": len(tokens)
+        return dispatch_job('send-notification-to-multiple', {
+            'userIds': user_ids,
+            'title': title,
+            'body': body,
+            'data': custom_data
         })
         
     except Exception as e:
         print(f"Error sending multicast notification: {e}")
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
+def run_send_notification_by_topic(payload, progress=None):
+    """Send a notification to a topic; returns (response body, HTTP status)"""
+    topic = payload['topic']
+    title = payload['title']
+    body = payload['body']
+    custom_data = payload.get('data', {})
+    
+    # Every subscriber receives a topic message, so the topic itself carries a push budget
+    if not topic_limiter.acquire(topic):
+        return throttled_result("Notification rate limit reached for topic", topic, topic_limiter, topic=topic)
+    
+    # Create topic message
+    message = messaging.Message(
+        notification=messaging.Notification(
+            title=title,
+            body=body,
+        ),
+        data=custom_data,
+        topic=topic,
+    )
+    
+    # Send notification
+    response = send_or_refund(message, topic_limiter, topic)
+    
+    # Queue notification log
+    log_writer.enqueue({
+        'topic': topic,
+        'title': title,
+        'body': body,
+        'data': custom_data,
+        'messageId': response,
+        'sentAt': firestore.SERVER_TIMESTAMP,
+        'status': 'sent',
+        'type': 'topic'
+    })
+    
+    print(f"Topic notification sent to {topic}: {response}")
+    return {
+        "success": True,
+        "message": "Topic notification sent successfully",
+        "messageId": response,
+        "topic": topic
+    }, 200
 
 @app.route('/send-notification-by-topic', methods=['POST'])
 def send_notification_by_topic():
@@ -204,61 +901,77 @@ def send_notification_by_topic():
         if not topic or not title or not body:
             return jsonify({"error": "topic, title, and body are required"}), 400
         
-        # Create topic message
-        message = messaging.Message(
-            notification=messaging.Notification(
-                title=title,
-                body=body,
-            ),
-            data=custom_data,
-            topic=topic,
-        )
-        
-        # Send notification
-        response = messaging.send(message)
-        
-        # Log notification
-        db.collection('notifications').add({
+        return dispatch_job('send-notification-by-topic', {
             'topic': topic,
             'title': title,
             'body': body,
-            'data': custom_data,
-            'messageId': response,
-            'sentAt': firestore.SERVER_TIMESTAMP,
-            'status': 'sent',
-            'type': 'topic'
-        })
-        
-        print(f"Topic notification sent to {topic}: {response}")
-        return jsonify({
-            "success": True,
-            "message": "Topic notification sent successfully",
-            "messageId": response,
-            "topic": topic
+            'data': custom_data
         })
         
     except Exception as e:
         print(f"Error sending topic notification: {e}")
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
+def to_rfc3339(timestamp):
+    """Format a Firestore timestamp with full precision for use in a cursor"""
+    if hasattr(timestamp, 'rfc3339'):
+        return timestamp.rfc3339()
+    return timestamp.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
 
 @app.route('/get-user-notifications', methods=['GET'])
 def get_user_notifications():
-    """Get notification history for a user"""
+    """Get notification history for a user, one keyset-paginated page at a time"""
     try:
         user_id = request.args.get('userId')
-        limit = int(request.args.get('limit', 50))
+        cursor = request.args.get('cursor')
+        fields = request.args.get('fields')
         
         if not user_id:
             return jsonify({"error": "userId is required"}), 400
         
-        # Get notifications from Firestore
+        try:
+            limit = int(request.args.get('limit', DEFAULT_NOTIFICATIONS_PAGE_SIZE))
+        except ValueError:
+            return jsonify({"error": "limit must be an integer"}), 400
+        limit = max(1, min(limit, MAX_NOTIFICATIONS_PAGE_SIZE))
+        
+        # Get notifications from Firestore, newest first with the document id as tie-breaker
         notifications_ref = db.collection('notifications')
-        query = notifications_ref.where('userId', '==', user_id).order_by('sentAt', direction=firestore.Query.DESCENDING).limit(limit)
+        query = (notifications_ref.where('userId', '==', user_id)
+                 .order_by('sentAt', direction=firestore.Query.DESCENDING)
+                 .order_by('__name__', direction=firestore.Query.DESCENDING))
         
+        # Push the projection down to Firestore; sentAt is always read for the cursor
+        if fields:
+            selected = [field.strip() for field in fields.split(',') if field.strip()]
+            unknown = [field for field in selected if field not in NOTIFICATION_FIELDS]
+            if unknown:
+                return jsonify({"error": f"Unknown or private fields: {', '.join(unknown)}"}), 400
+            query = query.select(list(dict.fromkeys(selected + ['sentAt'])))
+        
+        if cursor:
+            try:
+                position = decode_cursor(cursor)
+                if position.get('u') != user_id:
+                    raise ValueError("Cursor belongs to a different user")
+                sent_at = DatetimeWithNanoseconds.from_rfc3339(position['s'])
+                doc_id = position['id']
+            except (KeyError, TypeError, ValueError) as e:
+                return jsonify({"error": f"Invalid cursor: {e}"}), 400
+            query = query.start_after({'sentAt': sent_at, '__name__': doc_id})
+        
+        # Read one extra document to learn whether another page exists
         notifications = []
-        for doc in query.stream():
+        next_cursor = None
+        for doc in query.limit(limit + 1).stream():
+            if len(notifications) == limit:
+                last = notifications[-1]
+                next_cursor = encode_cursor({'u': user_id, 's': to_rfc3339(last_sent_at), 'id': last['id']})
+                break
             notification_data = doc.to_dict()
+            notification_data.pop('fcmToken', None)
             notification_data['id'] = doc.id
+            last_sent_at = notification_data.get('sentAt')
             # Convert timestamp to string
             if 'sentAt' in notification_data and notification_data['sentAt']:
                 notification_data['sentAt'] = notification_data['sentAt'].isoformat()
@@ -267,12 +980,178 @@ def get_user_notifications():
         return jsonify({
             "success": True,
             "notifications": notifications,
-            "count": len(notifications)
+            "count": len(notifications),
+            "nextCursor": next_cursor,
+            "hasMore": next_cursor is not None
         })
         
     except Exception as e:
         print(f"Error getting notifications: {e}")
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
+@app.route('/nearby-requests', methods=['GET'])
+def get_nearby_requests():
+    """Open blood requests near a donor, closest first, with ETags and deltas since a previous poll"""
+    try:
+        coordinates = parse_coordinates({
+            'latitude': request.args.get('latitude'), 'longitude': request.args.get('longitude')
+        })
+        if coordinates is None:
+            return jsonify({"error": "latitude and longitude must be valid coordinates"}), 400
+        
+        blood_group = request.args.get('bloodGroup')
+        if blood_group and not eligible_donor_groups(blood_group):
+            return jsonify({"error": f"Unknown blood group {blood_group}"}), 400
+        
+        try:
+            radius_km = float(request.args.get('radiusKm', DEFAULT_REQUEST_FEED_RADIUS_KM))
+            limit = int(request.args.get('limit', DEFAULT_REQUEST_FEED_PAGE_SIZE))
+        except ValueError:
+            return jsonify({"error": "radiusKm and limit must be numbers"}), 400
+        if not 0 < radius_km <= MAX_NEARBY_RADIUS_KM:
+            return jsonify({"error": f"radiusKm must be in (0, {MAX_NEARBY_RADIUS_KM}]"}), 400
+        limit = max(1, min(limit, MAX_REQUEST_FEED_PAGE_SIZE))
+        
+        # since is the deltaToken of an earlier poll; one from another process or before a restart is ignored
+        since = None
+        if request.args.get('since'):
+            try:
+                token = decode_cursor(request.args['since'])
+                if token.get('e') == request_index.epoch:
+                    since = int(token['v'])
+            except (KeyError, TypeError, ValueError) as e:
+                return jsonify({"error": f"Invalid since token: {e}"}), 400
+        
+        after = None
+        if request.args.get('cursor'):
+            try:
+                position = decode_cursor(request.args['cursor'])
+                after = (float(position['d']), str(position['id']))
+                page_version = int(position['v'])
+            except (KeyError, TypeError, ValueError) as e:
+                return jsonify({"error": f"Invalid cursor: {e}"}), 400
+        
+        if not request_index.ready:
+            return jsonify({"error": "Request index is still loading"}), 503
+        
+        version, matches, removed, full = request_index.query(
+            coordinates[0], coordinates[1], radius_km, donor_group=blood_group,
+            exclude_user_id=request.args.get('userId'), since=since
+        )
+        if after is not None:
+            matches = [item for item in matches if (round(item[0], 6), item[1].request_id) > after]
+            version = page_version
+        
+        page = matches[:limit]
+        next_cursor = None
+        if len(matches) > limit:
+            last_distance, last = page[-1]
+            next_cursor = encode_cursor({'d': round(last_distance, 6), 'id': last.request_id, 'v': version})
+        
+        body = {
+            "requests": [dict(entry.summary, distanceKm=round(distance, 3)) for distance, entry in page],
+            "removed": removed if after is None else [],
+            "full": full,
+            "nextCursor": next_cursor,
+        }
+        # The ETag covers the listed content only, so polls answer 304 while nothing nearby changed
+        etag = hashlib.sha1(json.dumps(body, sort_keys=True).encode('utf8')).hexdigest()
+        body.update(
+            success=True,
+            count=len(page),
+            hasMore=next_cursor is not None,
+            deltaToken=encode_cursor({'e': request_index.epoch, 'v': version})
+        )
+        response = jsonify(body)
+        response.set_etag(etag)
+        return response.make_conditional(request)
+        
+    except Exception as e:
+        print(f"Error getting nearby requests: {e}")
+        return error_response(e)
+
+def run_blood_request_notification(payload, progress=None):
+    """Send a blood request to nearby, compatible or topic donors; returns (response body, HTTP status)"""
+    blood_type = payload['bloodType']
+    location = payload['location']
+    urgency = payload['urgency']
+    requester_name = payload['requesterName']
+    hospital_name = payload['hospitalName']
+    coordinates = payload.get('coordinates')
+    include_compatible = payload['includeCompatible']
+    
+    # Create notification content
+    title = f"🩸 Urgent: {blood_type} Blood Needed!"
+    body = f"{requester_name} needs {blood_type} blood in {location}"
+    if hospital_name:
+        body += f" at {hospital_name}"
+    
+    notification_data = {
+        'type': 'blood_request',
+        'bloodType': blood_type,
+        'location': location,
+        'urgency': urgency,
+        'requesterName': requester_name,
+        'hospitalName': hospital_name,
+        'timestamp': payload['timestamp']
+    }
+    
+    # Waves start with the best-ranked donors and widen until the request fills
+    if payload.get('waves') and donor_table.ready:
+        return start_wave_dispatch(payload, title, body, notification_data, progress)
+    
+    # With coordinates, notify only the nearest donors instead of the whole topic
+    if coordinates is not None and donor_index.ready:
+        donor_groups = set(eligible_donor_groups(blood_type)) if include_compatible else {normalize_blood_group(blood_type)}
+        return notify_nearby_donors(
+            coordinates, payload['radiusKm'], payload['maxRecipients'], donor_groups,
+            title, body, notification_data, progress
+        )
+    
+    if include_compatible and compat_index.ready:
+        return notify_compatible_donors(blood_type, title, body, notification_data, progress)
+    
+    # Send to blood type topic
+    topic = f"blood_type_{blood_type.lower().replace('+', 'pos').replace('-', 'neg')}"
+    if not topic_limiter.acquire(topic, urgent=urgency in URGENT_LEVELS):
+        return throttled_result("Notification rate limit reached for topic", topic, topic_limiter, topic=topic)
+    
+    message = messaging.Message(
+        notification=messaging.Notification(
+            title=title,
+            body=body,
+        ),
+        data=notification_data,
+        topic=topic,
+    )
+    
+    # Send notification
+    response = send_or_refund(message, topic_limiter, topic)
+    
+    # Queue notification log
+    log_writer.enqueue({
+        'type': 'blood_request',
+        'topic': topic,
+        'title': title,
+        'body': body,
+        'bloodType': blood_type,
+        'location': location,
+        'urgency': urgency,
+        'requesterName': requester_name,
+        'hospitalName': hospital_name,
+        'messageId': response,
+        'sentAt': firestore.SERVER_TIMESTAMP,
+        'status': 'sent'
+    })
+    
+    print(f"Blood request notification sent to topic {topic}: {response}")
+    return {
+        "success": True,
+        "message": "Blood request notification sent successfully",
+        "mode": "topic",
+        "messageId": response,
+        "topic": topic
+    }, 200
 
 @app.route('/blood-request-notification', methods=['POST'])
 def send_blood_request_notification():
@@ -288,62 +1167,445 @@ def send_blood_request_notification():
         if not blood_type or not location:
             return jsonify({"error": "bloodType and location are required"}), 400
         
-        # Create notification content
-        title = f"🩸 Urgent: {blood_type} Blood Needed!"
-        body = f"{requester_name} needs {blood_type} blood in {location}"
-        if hospital_name:
-            body += f" at {hospital_name}"
+        coordinates = parse_coordinates(data.get('coordinates'))
+        if data.get('coordinates') is not None and coordinates is None:
+            return jsonify({"error": "coordinates must contain a valid latitude and longitude"}), 400
         
-        # Send to blood type topic
-        topic = f"blood_type_{blood_type.lower().replace('+', 'pos').replace('-', 'neg')}"
+        try:
+            radius_km = float(data.get('radiusKm', DEFAULT_NEARBY_RADIUS_KM))
+            max_recipients = int(data.get('maxRecipients', DEFAULT_MAX_RECIPIENTS))
+        except (TypeError, ValueError):
+            return jsonify({"error": "radiusKm and maxRecipients must be numbers"}), 400
         
-        message = messaging.Message(
-            notification=messaging.Notification(
-                title=title,
-                body=body,
-            ),
-            data={
-                'type': 'blood_request',
-                'bloodType': blood_type,
-                'location': location,
-                'urgency': urgency,
-                'requesterName': requester_name,
-                'hospitalName': hospital_name,
-                'timestamp': str(datetime.now().timestamp())
-            },
-            topic=topic,
-        )
+        if not 0 < radius_km <= MAX_NEARBY_RADIUS_KM or not 0 < max_recipients <= MAX_RECIPIENTS_LIMIT:
+            return jsonify({
+                "error": f"radiusKm must be in (0, {MAX_NEARBY_RADIUS_KM}] and maxRecipients in (0, {MAX_RECIPIENTS_LIMIT}]"
+            }), 400
         
-        # Send notification
-        response = messaging.send(message)
+        # Urgent requests also reach every donor group compatible with the recipient
+        include_compatible = bool(data.get('includeCompatible', urgency in URGENT_LEVELS))
+        if include_compatible and not eligible_donor_groups(blood_type):
+            return jsonify({"error": f"Unknown blood type {blood_type}"}), 400
         
-        # Log notification
-        db.collection('notifications').add({
-            'type': 'blood_request',
-            'topic': topic,
-            'title': title,
-            'body': body,
+        # Urgent requests tied to a requests document escalate in waves until enough donors accept
+        request_id = data.get('requestId')
+        waves = bool(data.get('waves', urgency in URGENT_LEVELS and bool(request_id) and coordinates is not None))
+        if waves and (not request_id or coordinates is None or not eligible_donor_groups(blood_type)):
+            return jsonify({"error": "Wave dispatch needs requestId, coordinates and a known bloodType"}), 400
+        try:
+            wave_size = int(data.get('waveSize', WAVE_SIZE))
+            wave_interval = float(data.get('waveIntervalSeconds', WAVE_INTERVAL_SECONDS))
+        except (TypeError, ValueError):
+            return jsonify({"error": "waveSize and waveIntervalSeconds must be numbers"}), 400
+        if waves and (not 0 < wave_size <= MAX_WAVE_SIZE or wave_interval <= 0):
+            return jsonify({
+                "error": f"waveSize must be in (0, {MAX_WAVE_SIZE}] and waveIntervalSeconds positive"
+            }), 400
+        
+        # Staff at one hospital filing the same request, or app retries, collapse into one send; anything
+        # that changes who is notified, or a different requests document, makes it a different request
+        coalesce_key = (
+            'blood-request', normalize_blood_group(blood_type) or str(blood_type), str(location).strip().lower(),
+            str(hospital_name).strip().lower(), str(urgency).strip().lower(), str(request_id or ''),
+            tuple(coordinates) if coordinates is not None else None, radius_km, max_recipients,
+            include_compatible, waves, wave_size if waves else None, wave_interval if waves else None
+        )
+        return dispatch_job('blood-request-notification', {
             'bloodType': blood_type,
             'location': location,
             'urgency': urgency,
             'requesterName': requester_name,
             'hospitalName': hospital_name,
-            'messageId': response,
-            'sentAt': firestore.SERVER_TIMESTAMP,
-            'status': 'sent'
-        })
+            'coordinates': list(coordinates) if coordinates is not None else None,
+            'radiusKm': radius_km,
+            'maxRecipients': max_recipients,
+            'includeCompatible': include_compatible,
+            'requestId': request_id,
+            'waves': waves,
+            'waveSize': wave_size,
+            'waveIntervalSeconds': wave_interval,
+            'timestamp': str(datetime.now().timestamp())
+        }, coalesce_key=coalesce_key)
+        
+    except Exception as e:
+        print(f"Error sending blood request notification: {e}")
+        return error_response(e)
+
+def blood_request_log_fields(notification_data):
+    """Fields stored on every notification log of a blood request"""
+    return {
+        'type': 'blood_request',
+        'bloodType': notification_data['bloodType'],
+        'location': notification_data['location'],
+        'urgency': notification_data['urgency'],
+        'requesterName': notification_data['requesterName'],
+        'hospitalName': notification_data['hospitalName']
+    }
+
+def start_wave_dispatch(payload, title, body, notification_data, progress=None):
+    """Persist a wave dispatch for a blood request and send its first wave"""
+    wave_id = wave_store.create({
+        'requestId': payload['requestId'],
+        'bloodType': normalize_blood_group(payload['bloodType']),
+        'coordinates': payload['coordinates'],
+        'waveSize': payload['waveSize'],
+        'intervalSeconds': payload['waveIntervalSeconds'],
+        'steps': [list(step) for step in DEFAULT_WAVE_STEPS],
+        'title': title,
+        'body': body,
+        'data': notification_data
+    })
+    result, status = run_wave(wave_id, 0, progress)
+    return dict(result, mode='waves'), status
+
+def request_fill(request_id):
+    """Return (accepted donors, units needed, closed) for a requests document"""
+    request_doc = db.collection('requests').document(request_id).get()
+    if not request_doc.exists:
+        return 0, 1, True
+    request_data = request_doc.to_dict()
+    accepted = max(int(request_data.get('unitsFulfilled') or 0), len(request_donor_ids(request_data)))
+    return accepted, int(request_data.get('units') or 1), request_data.get('status') in ('completed', 'cancelled')
+
+def run_wave(wave_id, wave, progress=None):
+    """Send wave number wave of a dispatch unless its request has filled; returns (response body, HTTP status)"""
+    dispatch = wave_store.get(wave_id)
+    if dispatch is None or dispatch['status'] != ACTIVE or dispatch['wave'] != wave:
+        return {
+            "success": True,
+            "message": "Wave already sent or dispatch stopped",
+            "waveId": wave_id,
+            "status": dispatch['status'] if dispatch is not None else None
+        }, 200
+    
+    # The wave was claimed by clearing next_at, so any failure must put it back on the schedule
+    try:
+        return send_wave(wave_id, wave, dispatch, progress)
+    except Exception as e:
+        return retry_wave(wave_id, wave, dispatch['payload'], [e])
+
+def send_wave(wave_id, wave, dispatch, progress=None):
+    """Match and notify the donors of one claimed wave; returns (response body, HTTP status)"""
+    plan = dispatch['payload']
+    if wave > 0:
+        accepted, needed, closed = request_fill(plan['requestId'])
+        if closed or accepted >= needed:
+            wave_store.finish(wave_id, FILLED)
+            print(f"Wave dispatch {wave_id} stopped after {len(dispatch['history'])} waves: {accepted}/{needed} accepted")
+            return {
+                "success": True,
+                "message": "Blood request filled, no more waves sent",
+                "waveId": wave_id,
+                "status": FILLED,
+                "acceptedCount": accepted,
+                "notifiedCount": len(dispatch['notified'])
+            }, 200
+    
+    # Widen the radius or donor groups until a step finds donors nobody has notified yet
+    lat, lon = plan['coordinates']
+    notified = dispatch['notified']
+    matches = []
+    step = wave
+    while step < len(plan['steps']) and not matches:
+        radius_km, compatible = plan['steps'][step]
+        step += 1
+        matches = donor_table.match(lat, lon, radius_km, plan['bloodType'], plan['waveSize'],
+                                    exclude=set(notified), exact_group=not compatible)
+    
+    if not matches:
+        wave_store.record_wave(wave_id, wave, step, notified, None, status=EXHAUSTED)
+        print(f"Wave dispatch {wave_id} exhausted after notifying {len(notified)} donors")
+        return {
+            "error": "No more matching donors to notify" if notified else "No matching donors found",
+            "waveId": wave_id,
+            "status": EXHAUSTED,
+            "notifiedCount": len(notified)
+        }, 200 if notified else 404
+    
+    response, throttled, sent_ids = send_multicast_and_log(
+        [match.user_id for match in matches],
+        [match.fcm_token for match in matches],
+        plan['title'], plan['body'], plan['data'],
+        log_fields=dict(blood_request_log_fields(plan['data']), waveId=wave_id, wave=len(dispatch['history']) + 1),
+        recipient_fields=[{'distanceKm': round(match.distance_km, 3)} for match in matches],
+        progress=progress,
+        urgent=True
+    )
+    
+    # Failed calls come back as per-token failures; a wave nobody received because FCM was down is sent again
+    errors = [r.exception for r in response.responses if not r.success]
+    if response.responses and not response.success_count and all(is_transient_error(e) for e in errors):
+        return retry_wave(wave_id, wave, plan, errors)
+    
+    summary = {
+        'radiusKm': radius_km,
+        'compatibleGroups': compatible,
+        'recipientCount': len(matches),
+        'successCount': response.success_count,
+        'throttledCount': throttled,
+        'sentAt': time.time()
+    }
+    next_at = time.time() + plan['intervalSeconds']
+    # Donors whose push failed or was throttled stay eligible for the next wave
+    notified = notified + [user_id for user_id, r in zip(sent_ids, response.responses) if r.success]
+    wave_store.record_wave(wave_id, wave, step, notified, summary, next_at)
+    wave_scheduler.schedule(wave_id, next_at)
+    
+    print(f"Wave {len(dispatch['history']) + 1} of dispatch {wave_id} sent to {len(matches)} donors within "
+          f"{radius_km} km, {response.success_count} successful")
+    return dict(
+        summary,
+        success=True,
+        message="Blood request wave sent",
+        waveId=wave_id,
+        wave=len(dispatch['history']) + 1,
+        notifiedCount=len(notified),
+        nextWaveAt=next_at
+    ), 200
+
+def retry_wave(wave_id, wave, plan, errors):
+    """Reschedule a wave whose send failed, no sooner than the interval or any Retry-After; returns (body, status)
+
+    The scheduler retries the same wave, so the job succeeds with 202 while
+    the dispatch stays active: a failed job would have the client submit the
+    blood request again and start a second dispatch. Only a dispatch given up
+    after MAX_WAVE_FAILURES answers 503.
+    """
+    delay = max([plan['intervalSeconds']] + [getattr(e, 'retry_after', 0) or 0 for e in errors])
+    retry_at = time.time() + delay
+    wave_store.reschedule(wave_id, wave, retry_at, MAX_WAVE_FAILURES)
+    print(f"Error sending wave {wave} of dispatch {wave_id}: {errors[0]}")
+    dispatch = wave_store.get(wave_id)
+    if dispatch is None or dispatch['status'] != ACTIVE:
+        return {"error": str(errors[0]), "waveId": wave_id, "status": dispatch['status'] if dispatch else None}, 503
+    wave_scheduler.schedule(wave_id, retry_at)
+    return {
+        "success": True,
+        "message": "Wave send failed and was rescheduled",
+        "waveId": wave_id,
+        "status": ACTIVE,
+        "lastError": str(errors[0]),
+        "retryAt": retry_at
+    }, 202
+
+def run_blood_request_wave(payload, progress=None):
+    """Job handler for a scheduled wave; returns (response body, HTTP status)"""
+    return run_wave(payload['waveId'], payload['wave'], progress)
+
+def fire_due_wave(wave_id):
+    """Queue the due wave of a dispatch, unless another process already claimed it"""
+    wave = wave_store.take_due(wave_id)
+    if wave is not None:
+        job_queue.submit('blood-request-wave', {'waveId': wave_id, 'wave': wave})
+
+wave_scheduler = WaveScheduler(fire_due_wave)
+
+@app.route('/blood-request-waves/<wave_id>', methods=['GET'])
+def get_wave_dispatch(wave_id):
+    """Status and per-wave history of an escalating blood request dispatch"""
+    dispatch = wave_store.get(wave_id)
+    if dispatch is None:
+        return jsonify({"error": "Wave dispatch not found"}), 404
+    return jsonify({
+        "success": True,
+        "waveId": wave_id,
+        "requestId": dispatch['payload']['requestId'],
+        "status": dispatch['status'],
+        "waves": dispatch['history'],
+        "notifiedCount": len(dispatch['notified']),
+        "nextWaveAt": dispatch['next_at'],
+        "createdAt": dispatch['created_at'],
+        "updatedAt": dispatch['updated_at']
+    })
+
+@app.route('/blood-request-waves/<wave_id>', methods=['DELETE'])
+def cancel_wave_dispatch(wave_id):
+    """Stop sending further waves of a blood request"""
+    try:
+        if wave_store.get(wave_id) is None:
+            return jsonify({"error": "Wave dispatch not found"}), 404
+        if not wave_store.finish(wave_id, CANCELLED):
+            return jsonify({"error": "Wave dispatch already stopped"}), 409
+        return jsonify({"success": True, "message": "Wave dispatch cancelled", "waveId": wave_id})
+    except Exception as e:
+        print(f"Error cancelling wave dispatch: {e}")
+        return error_response(e)
+
+def notify_nearby_donors(coordinates, radius_km, max_recipients, blood_groups, title, body, notification_data,
+                         progress=None):
+    """Multicast a blood request to the nearest available donors of the given groups"""
+    lat, lon = coordinates
+    nearby = donor_index.nearest(lat, lon, radius_km, max_recipients, blood_groups=blood_groups)
+    
+    if not nearby:
+        return {
+            "error": "No nearby donors found",
+            "radiusKm": radius_km
+        }, 404
+    
+    donors = [donor for _, donor in nearby]
+    response, throttled, _ = send_multicast_and_log(
+        [donor.user_id for donor in donors],
+        [donor.fcm_token for donor in donors],
+        title, body, notification_data,
+        log_fields=blood_request_log_fields(notification_data),
+        recipient_fields=[{'distanceKm': round(distance, 3)} for distance, _ in nearby],
+        progress=progress,
+        urgent=notification_data['urgency'] in URGENT_LEVELS
+    )
+    
+    if throttled == len(donors):
+        return throttled_result("Notification rate limit reached for every nearby donor", donors[0].user_id,
+                                throttledCount=throttled)
+    
+    print(f"Blood request notification sent to {len(donors)} nearby donors: "
+          f"{response.success_count} successful, {response.failure_count} failed, {throttled} throttled")
+    return {
+        "success": True,
+        "message": "Blood request notification sent to nearby donors",
+        "mode": "nearby",
+        "donorBloodGroups": sorted(blood_groups),
+        "radiusKm": radius_km,
+        "recipientCount": len(donors),
+        "maxDistanceKm": round(nearby[-1][0], 3),
+        "successCount": response.success_count,
+        "failureCount": response.failure_count,
+        "throttledCount": throttled
+    }, 200
+
+def notify_compatible_donors(blood_type, title, body, notification_data, progress=None):
+    """Multicast a blood request to every available donor who can give to blood_type"""
+    donor_ids = compat_index.eligible_donors(blood_type)
+    lookup = resolve_fcm_tokens(db, sorted(donor_ids), cache=token_cache)
+    
+    if not lookup.tokens:
+        return {"error": "No compatible donors found"}, 404
+    
+    response, throttled, _ = send_multicast_and_log(
+        lookup.user_ids, lookup.tokens, title, body, notification_data,
+        log_fields=blood_request_log_fields(notification_data),
+        progress=progress,
+        urgent=notification_data['urgency'] in URGENT_LEVELS
+    )
+    
+    if throttled == len(lookup.tokens):
+        return throttled_result("Notification rate limit reached for every compatible donor", lookup.user_ids[0],
+                                throttledCount=throttled)
+    
+    print(f"Blood request notification sent to {len(lookup.tokens)} compatible donors: "
+          f"{response.success_count} successful, {response.failure_count} failed, {throttled} throttled")
+    return {
+        "success": True,
+        "message": "Blood request notification sent to compatible donors",
+        "mode": "compatible",
+        "donorBloodGroups": sorted(eligible_donor_groups(blood_type)),
+        "recipientCount": len(lookup.tokens),
+        "successCount": response.success_count,
+        "failureCount": response.failure_count,
+        "throttledCount": throttled
+    }, 200
+
+def run_match_donors(payload, progress=None):
+    """Rank donors for a blood request and notify the top matches; returns (response body, HTTP status)"""
+    lat, lon = payload['coordinates']
+    matches = donor_table.match(lat, lon, payload['radiusKm'], payload['bloodGroup'], payload['limit'])
+    
+    if not matches:
+        return {"error": "No matching donors found", "radiusKm": payload['radiusKm']}, 404
+    
+    custom_data = dict(payload.get('data', {}), type='blood_request', bloodType=payload['bloodGroup'],
+                       urgency=payload['urgency'])
+    response, throttled, _ = send_multicast_and_log(
+        [match.user_id for match in matches],
+        [match.fcm_token for match in matches],
+        payload['title'], payload['body'], custom_data,
+        log_fields={'type': 'blood_request', 'bloodType': payload['bloodGroup'], 'urgency': payload['urgency']},
+        recipient_fields=[
+            {'distanceKm': round(match.distance_km, 3), 'matchScore': round(match.score, 4)} for match in matches
+        ],
+        progress=progress,
+        urgent=payload['urgency'] in URGENT_LEVELS
+    )
+    
+    if throttled == len(matches):
+        return throttled_result("Notification rate limit reached for every matched donor", matches[0].user_id,
+                                throttledCount=throttled)
+    
+    print(f"Blood request sent to {len(matches)} matched donors: "
+          f"{response.success_count} successful, {response.failure_count} failed, {throttled} throttled")
+    return {
+        "success": True,
+        "message": "Blood request notification sent to the best matched donors",
+        "matches": match_results(matches),
+        "recipientCount": len(matches),
+        "successCount": response.success_count,
+        "failureCount": response.failure_count,
+        "throttledCount": throttled
+    }, 200
+
+def match_results(matches):
+    """JSON rows for ranked donor matches; tokens are never returned"""
+    return [{
+        'userId': match.user_id,
+        'distanceKm': round(match.distance_km, 3),
+        'acceptRate': round(match.accept_rate, 4),
+        'score': round(match.score, 4)
+    } for match in matches]
+
+@app.route('/match-donors', methods=['POST'])
+def match_donors():
+    """Rank available, eligible donors by distance and responsiveness; notify=true also sends to them"""
+    try:
+        data = request.get_json()
+        blood_group = normalize_blood_group(data.get('bloodGroup'))
+        coordinates = parse_coordinates(data.get('coordinates'))
+        notify = bool(data.get('notify', False))
+        
+        if not eligible_donor_groups(blood_group):
+            return jsonify({"error": "bloodGroup must be a known blood group"}), 400
+        if coordinates is None:
+            return jsonify({"error": "coordinates must contain a valid latitude and longitude"}), 400
+        
+        try:
+            radius_km = float(data.get('radiusKm', DEFAULT_NEARBY_RADIUS_KM))
+            limit = int(data.get('limit', DEFAULT_MAX_RECIPIENTS))
+        except (TypeError, ValueError):
+            return jsonify({"error": "radiusKm and limit must be numbers"}), 400
+        
+        if not 0 < radius_km <= MAX_NEARBY_RADIUS_KM or not 0 < limit <= MAX_RECIPIENTS_LIMIT:
+            return jsonify({
+                "error": f"radiusKm must be in (0, {MAX_NEARBY_RADIUS_KM}] and limit in (0, {MAX_RECIPIENTS_LIMIT}]"
+            }), 400
+        
+        if not donor_table.ready:
+            return jsonify({"error": "Donor table is still loading"}), 503
+        
+        if notify:
+            if not data.get('title') or not data.get('body'):
+                return jsonify({"error": "title and body are required to notify matched donors"}), 400
+            return dispatch_job('match-donors', {
+                'bloodGroup': blood_group,
+                'coordinates': list(coordinates),
+                'radiusKm': radius_km,
+                'limit': limit,
+                'urgency': data.get('urgency', 'normal'),
+                'title': data['title'],
+                'body': data['body'],
+                'data': data.get('data', {})
+            })
         
-        print(f"Blood request notification sent to topic {topic}: {response}")
+        matches = donor_table.match(coordinates[0], coordinates[1], radius_km, blood_group, limit)
         return jsonify({
             "success": True,
-            "message": "Blood request notification sent successfully",
-            "messageId": response,
-            "topic": topic
+            "bloodGroup": blood_group,
+            "radiusKm": radius_km,
+            "count": len(matches),
+            "matches": match_results(matches)
         })
         
     except Exception as e:
-        print(f"Error sending blood request notification: {e}")
-        return jsonify({"error": str(e)}), 500
+        print(f"Error matching donors: {e}")
+        return error_response(e)
 
 @app.route('/subscribe-to-topic', methods=['POST'])
 def subscribe_to_topic():
@@ -357,29 +1619,25 @@ def subscribe_to_topic():
             return jsonify({"error": "userId and topic are required"}), 400
         
         # Get user's FCM token
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
+        fcm_token, user_exists = get_user_fcm_token(user_id)
         
-        if not user_doc.exists:
+        if not user_exists:
             return jsonify({"error": "User not found"}), 404
         
-        user_data = user_doc.to_dict()
-        fcm_token = user_data.get('fcmToken')
-        
         if not fcm_token:
             return jsonify({"error": "FCM token not found for user"}), 404
         
         # Subscribe to topic
         response = messaging.subscribe_to_topic([fcm_token], topic)
         
-        # Log subscription
-        db.collection('topic_subscriptions').add({
+        # Log subscription under a deterministic id so unsubscribe can write it directly
+        db.collection('topic_subscriptions').document(subscription_id(user_id, topic)).set({
             'userId': user_id,
             'topic': topic,
             'fcmToken': fcm_token,
             'subscribedAt': firestore.SERVER_TIMESTAMP,
             'status': 'subscribed'
-        })
+        }, merge=True)
         
         print(f"User {user_id} subscribed to topic {topic}")
         return jsonify({
@@ -391,7 +1649,7 @@ def subscribe_to_topic():
         
     except Exception as e:
         print(f"Error subscribing to topic: {e}")
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
 
 @app.route('/unsubscribe-from-topic', methods=['POST'])
 def unsubscribe_from_topic():
@@ -405,15 +1663,11 @@ def unsubscribe_from_topic():
             return jsonify({"error": "userId and topic are required"}), 400
         
         # Get user's FCM token
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
+        fcm_token, user_exists = get_user_fcm_token(user_id)
         
-        if not user_doc.exists:
+        if not user_exists:
             return jsonify({"error": "User not found"}), 404
         
-        user_data = user_doc.to_dict()
-        fcm_token = user_data.get('fcmToken')
-        
         if not fcm_token:
             return jsonify({"error": "FCM token not found for user"}), 404
         
@@ -421,14 +1675,12 @@ def unsubscribe_from_topic():
         response = messaging.unsubscribe_from_topic([fcm_token], topic)
         
         # Update subscription status
-        subscriptions_ref = db.collection('topic_subscriptions')
-        query = subscriptions_ref.where('userId', '==', user_id).where('topic', '==', topic)
-        
-        for doc in query.stream():
-            doc.reference.update({
-                'status': 'unsubscribed',
-                'unsubscribedAt': firestore.SERVER_TIMESTAMP
-            })
+        db.collection('topic_subscriptions').document(subscription_id(user_id, topic)).set({
+            'userId': user_id,
+            'topic': topic,
+            'status': 'unsubscribed',
+            'unsubscribedAt': firestore.SERVER_TIMESTAMP
+        }, merge=True)
         
         print(f"User {user_id} unsubscribed from topic {topic}")
         return jsonify({
@@ -440,9 +1692,468 @@ def unsubscribe_from_topic():
         
     except Exception as e:
         print(f"Error unsubscribing from topic: {e}")
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
+def run_bulk_topic_subscription(payload, progress=None):
+    """Subscribe or unsubscribe many users to many topics; returns (response body, HTTP status)"""
+    subscribe = payload['subscribe']
+    topics = payload['topics']
+    
+    # Resolve all tokens up front in chunked get_all round trips
+    lookup = resolve_fcm_tokens(db, payload['userIds'], cache=token_cache)
+    if not lookup.tokens:
+        return {
+            "error": "No valid FCM tokens found",
+            "missingUserIds": lookup.missing,
+            "usersWithoutToken": lookup.without_token
+        }, 404
+    
+    on_chunk = None
+    if progress is not None:
+        progress.update(
+            topics=len(topics),
+            chunks=len(topics) * -(-len(lookup.tokens) // FCM_TOPIC_BATCH_LIMIT),
+            chunksDone=0,
+            successCount=0,
+            failureCount=0
+        )
+        
+        def on_chunk(topic, succeeded, failed):
+            progress.increment(chunksDone=1, successCount=succeeded, failureCount=failed)
+    
+    results = manage_topic_subscriptions(
+        messaging, lookup.user_ids, lookup.tokens, topics, subscribe=subscribe, on_chunk=on_chunk
+    )
+    
+    # Record the outcome with batched writes under {userId}_{topic} ids
+    if subscribe:
+        status_fields = {'status': 'subscribed', 'subscribedAt': firestore.SERVER_TIMESTAMP}
+    else:
+        status_fields = {'status': 'unsubscribed', 'unsubscribedAt': firestore.SERVER_TIMESTAMP}
+    records = []
+    summary = {}
+    for topic, result in results.items():
+        for user_id, fcm_token in result['succeeded']:
+            records.append(dict(status_fields, userId=user_id, topic=topic, fcmToken=fcm_token))
+        for error in result['errors']:
+            if error['reason'] in INVALID_TOKEN_REASONS:
+                token_cache.invalidate(error['userId'], error['fcmToken'])
+            if error['reason'] in STALE_TOPIC_REASONS:
+                token_pruner.enqueue((error['userId'], error['fcmToken'], STALE_TOPIC_REASONS[error['reason']]))
+        summary[topic] = {
+            'successCount': len(result['succeeded']),
+            'failureCount': len(result['errors']),
+            'errors': [{'userId': e['userId'], 'reason': e['reason']} for e in result['errors']]
+        }
+    write_subscription_records(db, records)
+    
+    action = 'subscribed to' if subscribe else 'unsubscribed from'
+    print(f"Bulk {action} {len(topics)} topics for {len(lookup.user_ids)} users")
+    return {
+        "success": True,
+        "message": f"Users {action} topics",
+        "topics": summary,
+        "userCount": len(lookup.user_ids),
+        "successCount": sum(t['successCount'] for t in summary.values()),
+        "failureCount": sum(t['failureCount'] for t in summary.values()),
+        "missingUserIds": lookup.missing,
+        "usersWithoutToken": lookup.without_token
+    }, 200
+
+def dispatch_bulk_topic_subscription(subscribe):
+    """Validate a bulk topic request and queue it as a job"""
+    data = request.get_json()
+    user_ids = data.get('userIds', [])
+    topics = data.get('topics') or ([data['topic']] if data.get('topic') else [])
+    
+    if not user_ids or not topics or not isinstance(user_ids, list) or not isinstance(topics, list):
+        return jsonify({"error": "userIds and topics are required lists"}), 400
+    
+    if len(user_ids) > MAX_BULK_TOPIC_USERS or len(topics) > MAX_BULK_TOPICS:
+        return jsonify({
+            "error": f"At most {MAX_BULK_TOPIC_USERS} userIds and {MAX_BULK_TOPICS} topics per request"
+        }), 400
+    
+    invalid = [topic for topic in topics if not is_valid_topic(topic)]
+    if invalid:
+        return jsonify({"error": f"Invalid topic names: {', '.join(map(str, invalid))}"}), 400
+    
+    return dispatch_job('bulk-topic-subscription', {
+        'userIds': user_ids,
+        'topics': list(dict.fromkeys(topics)),
+        'subscribe': subscribe
+    })
+
+@app.route('/bulk-subscribe-to-topics', methods=['POST'])
+def bulk_subscribe_to_topics():
+    """Subscribe many users to one or more FCM topics"""
+    try:
+        return dispatch_bulk_topic_subscription(True)
+    except Exception as e:
+        print(f"Error in bulk topic subscribe: {e}")
+        return error_response(e)
+
+@app.route('/bulk-unsubscribe-from-topics', methods=['POST'])
+def bulk_unsubscribe_from_topics():
+    """Unsubscribe many users from one or more FCM topics"""
+    try:
+        return dispatch_bulk_topic_subscription(False)
+    except Exception as e:
+        print(f"Error in bulk topic unsubscribe: {e}")
+        return error_response(e)
+
+def run_bulk_user_import(payload, progress=None):
+    """Import a spooled NDJSON/CSV upload into users; returns (response body, HTTP status)"""
+    on_progress = None
+    if progress is not None:
+        progress.update(rows=0, imported=0, invalid=0, failed=0)
+        
+        def on_progress(counts):
+            progress.update(rows=counts['rowCount'], imported=counts['importedCount'],
+                            invalid=counts['invalidCount'], failed=counts['failedCount'])
+    
+    path = payload['path']
+    if not os.path.exists(path):
+        return {"error": "The upload is no longer available; upload it again"}, 410
+    try:
+        with open(path, 'rb') as f:
+            summary = import_users(db, parse_rows(f, payload['format']),
+                                   max_ops_per_second=BULK_IMPORT_MAX_OPS_PER_SECOND, on_progress=on_progress)
+    except InvalidUpload as e:
+        os.remove(path)
+        return {"error": f"Unreadable {payload['format']} upload: {e}"}, 400
+    # Kept until the import finishes, so a retried job can read it again
+    os.remove(path)
+    bulk_user_rows.inc('import', 'imported', amount=summary['importedCount'])
+    bulk_user_rows.inc('import', 'invalid', amount=summary['invalidCount'])
+    bulk_user_rows.inc('import', 'failed', amount=summary['failedCount'])
+    
+    print(f"Bulk import of {summary['rowCount']} rows: {summary['importedCount']} imported, "
+          f"{summary['invalidCount']} invalid, {summary['failedCount']} failed")
+    return {"success": True, "message": "Bulk user import finished", **summary}, 200
+
+@app.route('/bulk/users', methods=['POST'])
+def bulk_import_users():
+    """Import users from an NDJSON or CSV body, streamed to disk and written by a background job"""
+    try:
+        content_type = (request.mimetype or '').lower()
+        upload_format = request.args.get('format') or UPLOAD_CONTENT_TYPES.get(content_type, NDJSON)
+        if upload_format not in FORMATS:
+            return jsonify({"error": f"format must be one of {', '.join(FORMATS)}"}), 400
+        if request.content_length is not None and request.content_length > MAX_BULK_UPLOAD_BYTES:
+            return jsonify({"error": f"Uploads are limited to {MAX_BULK_UPLOAD_BYTES} bytes"}), 413
+        
+        os.makedirs(BULK_UPLOAD_DIR, exist_ok=True)
+        path = os.path.join(BULK_UPLOAD_DIR, f"{uuid.uuid4().hex}.{upload_format}")
+        size = 0
+        try:
+            # The body is copied a chunk at a time, never held whole in memory
+            with open(path, 'wb') as f:
+                while True:
+                    chunk = request.stream.read(BULK_UPLOAD_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > MAX_BULK_UPLOAD_BYTES:
+                        raise OverflowError
+                    f.write(chunk)
+        except OverflowError:
+            os.remove(path)
+            return jsonify({"error": f"Uploads are limited to {MAX_BULK_UPLOAD_BYTES} bytes"}), 413
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        if size == 0:
+            os.remove(path)
+            return jsonify({"error": "The upload is empty"}), 400
+        
+        return dispatch_job('bulk-user-import', {'path': path, 'format': upload_format, 'bytes': size})
+    except Exception as e:
+        print(f"Error receiving bulk user import: {e}")
+        return error_response(e)
+
+@app.route('/bulk/users', methods=['GET'])
+def bulk_export_users():
+    """Stream every user as NDJSON in the format /bulk/users imports; fcmToken only with includeTokens=true"""
+    include_tokens = request.args.get('includeTokens', '').lower() in ('1', 'true', 'yes')
+    
+    def generate():
+        exported = 0
+        try:
+            for record in export_users(db, include_tokens=include_tokens):
+                yield to_ndjson(record)
+                exported += 1
+                bulk_user_rows.inc('export', 'exported')
+        finally:
+            print(f"Bulk export streamed {exported} users")
+    
+    # Errors after the first line can only cut the stream short; ones before it answer 500
+    lines = generate()
+    try:
+        first = next(lines, '')
+    except Exception as e:
+        print(f"Error exporting users: {e}")
+        return error_response(e)
+    
+    def stream():
+        yield first
+        yield from lines
+    
+    return Response(stream_with_context(stream()), mimetype='application/x-ndjson')
+
+def run_token_sweep(payload, progress=None):
+    """Dry-run every stored FCM token and prune the dead ones; returns (response body, HTTP status)"""
+    on_page = None
+    if progress is not None:
+        progress.update(checked=0, stale=0)
+        
+        def on_page(checked, stale):
+            progress.increment(checked=checked, stale=stale)
+    
+    checked, stale = sweep_tokens(db, messaging, on_page=on_page)
+    pruned = token_pruner.prune(stale) if payload.get('prune', True) and stale else 0
+    
+    print(f"Token sweep checked {checked} tokens, {len(stale)} stale, {pruned} pruned")
+    return {
+        "success": True,
+        "message": "Token sweep finished",
+        "checkedCount": checked,
+        "staleCount": len(stale),
+        "prunedCount": pruned,
+        "reasons": {reason: sum(1 for e in stale if e[2] == reason) for reason in {e[2] for e in stale}}
+    }, 200
+
+@app.route('/token-sweep', methods=['POST'])
+def token_sweep():
+    """Validate every stored FCM token with dry-run sends and prune the dead ones"""
+    try:
+        data = request.get_json(silent=True) or {}
+        return dispatch_job('token-sweep', {'prune': bool(data.get('prune', True))})
+    except Exception as e:
+        print(f"Error starting token sweep: {e}")
+        return error_response(e)
+
+@app.route('/token-hygiene-stats', methods=['GET'])
+def token_hygiene_stats():
+    """Pruned, skipped and unsubscribed counts of the stale token pruner"""
+    return jsonify({"success": True, "stats": token_pruner.stats()})
+
+def schedule_token_sweeps(interval_seconds, stop_event):
+    """Queue a token sweep job every interval_seconds until stop_event is set"""
+    while not stop_event.wait(interval_seconds):
+        try:
+            job_queue.submit('token-sweep', {'prune': True})
+        except Exception as e:
+            print(f"Error scheduling token sweep: {e}")
+
+def run_notification_rollup(payload, progress=None):
+    """Roll up finished hours of notification logs and archive old ones; returns (response body, HTTP status)"""
+    on_hour = on_page = None
+    if progress is not None:
+        progress.update(hours=0, rolledUp=0, archived=0)
+        
+        def on_hour(count):
+            progress.increment(hours=1, rolledUp=count)
+        
+        def on_page(count):
+            progress.increment(archived=count)
+    
+    hours, rolled_up = rollup_notifications(db, on_hour=on_hour)
+    archived = 0
+    if payload.get('archive', True) and NOTIFICATION_RETENTION_DAYS > 0:
+        older_than = datetime.now(timezone.utc) - timedelta(days=NOTIFICATION_RETENTION_DAYS)
+        archived = archive_notifications(db, NOTIFICATION_ARCHIVE_DIR, older_than, on_page=on_page)
+    
+    print(f"Notification rollup counted {rolled_up} logs in {hours} hours, archived {archived}")
+    return {
+        "success": True,
+        "message": "Notification rollup finished",
+        "hourCount": hours,
+        "rolledUpCount": rolled_up,
+        "archivedCount": archived
+    }, 200
+
+@app.route('/notification-rollup', methods=['POST'])
+def notification_rollup():
+    """Roll up notification logs into stats buckets and archive the ones past retention"""
+    try:
+        data = request.get_json(silent=True) or {}
+        return dispatch_job('notification-rollup', {'archive': bool(data.get('archive', True))})
+    except Exception as e:
+        print(f"Error starting notification rollup: {e}")
+        return error_response(e)
+
+def parse_stats_time(value):
+    """Parse an ISO date or datetime query parameter, taking naive values as UTC"""
+    moment = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    return moment if moment.tzinfo is not None else moment.replace(tzinfo=timezone.utc)
+
+def format_stats_bucket(bucket):
+    bucket = {key: value for key, value in bucket.items() if key != 'granularity'}
+    for key in ('bucketStart', 'rolledUpAt'):
+        if hasattr(bucket.get(key), 'isoformat'):
+            bucket[key] = bucket[key].isoformat()
+    return bucket
+
+@app.route('/notification-stats', methods=['GET'])
+def notification_stats():
+    """Sent/failed counts by type, topic, blood type and urgency per hour or day, read from the rollups"""
+    try:
+        granularity = request.args.get('granularity', DAY)
+        if granularity not in GRANULARITIES:
+            return jsonify({"error": f"granularity must be one of {', '.join(GRANULARITIES)}"}), 400
+        try:
+            end = parse_stats_time(request.args['to']) if request.args.get('to') else datetime.now(timezone.utc)
+            start = (parse_stats_time(request.args['from']) if request.args.get('from')
+                     else end - DEFAULT_STATS_RANGE[granularity])
+        except ValueError as e:
+            return jsonify({"error": f"Invalid from/to: {e}"}), 400
+        if start >= end:
+            return jsonify({"error": "from must be before to"}), 400
+        if (end - start) / BUCKET_SPANS[granularity] > MAX_STATS_BUCKETS[granularity]:
+            return jsonify({"error": f"At most {MAX_STATS_BUCKETS[granularity]} {granularity} buckets per request"}), 400
+        
+        buckets = read_stats(db, granularity, start, end)
+        totals = new_aggregate()
+        for bucket in buckets:
+            merge_aggregates(totals, bucket)
+        watermark = rolled_up_until(db)
+        return jsonify({
+            "success": True,
+            "granularity": granularity,
+            "from": start.isoformat(),
+            "to": end.isoformat(),
+            "buckets": [format_stats_bucket(bucket) for bucket in buckets],
+            "totals": totals,
+            # Logs sent after this are not counted yet
+            "rolledUpUntil": watermark.isoformat() if watermark is not None else None
+        })
+    except Exception as e:
+        print(f"Error reading notification stats: {e}")
+        return error_response(e)
+
+def schedule_notification_rollups(interval_seconds, stop_event):
+    """Queue a notification rollup job every interval_seconds until stop_event is set"""
+    while not stop_event.wait(interval_seconds):
+        try:
+            job_queue.submit('notification-rollup', {'archive': True})
+        except Exception as e:
+            print(f"Error scheduling notification rollup: {e}")
+
+def schedule_donor_snapshots(interval_seconds, stop_event):
+    """Snapshot the donor table every interval_seconds until stop_event is set"""
+    while not stop_event.wait(interval_seconds):
+        try:
+            take_donor_snapshot()
+        except Exception as e:
+            print(f"Error writing donor snapshot: {e}")
+
+def with_job_deadline(handler):
+    """Wrap a job handler to run under the deadline its request stored in deadlineAt, if any"""
+    def run(payload, progress=None):
+        deadline_at = payload.get('deadlineAt')
+        if deadline_at is None:
+            return handler(payload, progress)
+        remaining = deadline_at - time.time()
+        if remaining <= 0:
+            return {"error": "Request deadline passed before the job ran", "deadlineAt": deadline_at}, 504
+        with deadline_scope(remaining):
+            return handler(payload, progress)
+    return run
+
+# Register job handlers before the workers start claiming persisted jobs
+for kind, handler in (
+    ('send-notification', run_send_notification),
+    ('send-notification-to-multiple', run_send_notification_to_multiple),
+    ('send-notification-by-topic', run_send_notification_by_topic),
+    ('blood-request-notification', run_blood_request_notification),
+    ('bulk-topic-subscription', run_bulk_topic_subscription),
+    ('token-sweep', run_token_sweep),
+    ('match-donors', run_match_donors),
+    ('blood-request-wave', run_blood_request_wave),
+    ('notification-rollup', run_notification_rollup),
+    ('bulk-user-import', run_bulk_user_import),
+):
+    job_queue.register(kind, metrics.traced_job(kind, with_job_deadline(handler)))
+
+metrics.gauge('notification_log_queue_depth', 'Notification logs waiting to be written',
+              lambda: log_writer.stats()['queueDepth'] if log_writer is not None else 0)
+metrics.gauge('token_cache_size', 'Cached FCM tokens', lambda: token_cache.stats()['size'])
+metrics.gauge('token_prune_queue_depth', 'Stale FCM tokens waiting to be pruned',
+              lambda: token_pruner.stats()['queueDepth'] if token_pruner is not None else 0)
+metrics.gauge('donor_index_size', 'Donors in the geohash index', lambda: len(donor_index))
+metrics.gauge('donor_table_size', 'Donors in the columnar match table', lambda: len(donor_table))
+metrics.gauge('open_requests', 'Open blood requests in the nearby-requests index', lambda: len(request_index))
+metrics.gauge('view_age_seconds', 'Seconds since each in-memory view last applied a change',
+              lambda: {(v.collection,): v.stats()['ageSeconds'] or 0 for v in (users_view, requests_view)},
+              ('collection',))
+metrics.gauge('view_resyncs', 'Times each view resubscribed after its listener died',
+              lambda: {(v.collection,): v.resyncs for v in (users_view, requests_view)}, ('collection',))
+metrics.gauge('backend_breaker_open', 'Whether each dependency\'s circuit breaker is failing calls fast',
+              lambda: {(name,): int(d.breaker.state == OPEN) for name, d in dependencies.items()}, ('backend',))
+metrics.gauge('backend_concurrency_limit', 'Adaptive concurrency limit of each dependency',
+              lambda: {(name,): d.limit.limit for name, d in dependencies.items()}, ('backend',))
+metrics.gauge('backend_in_flight', 'Calls in flight to each dependency',
+              lambda: {(name,): d.limit.in_flight for name, d in dependencies.items()}, ('backend',))
+metrics.gauge('backend_calls_rejected', 'Backend calls failed fast, by dependency and reason',
+              lambda: {(name, reason): count for name, d in dependencies.items()
+                       for reason, count in d.stats()['rejected'].items()}, ('backend', 'reason'))
+metrics.gauge('jobs', 'Persisted jobs by status',
+              lambda: {(status,): count for status, count in job_queue.store.counts().items()}, ('status',))
+metrics.gauge('wave_dispatches', 'Escalating blood request dispatches by status',
+              lambda: {(status,): count for status, count in wave_store.counts().items()}, ('status',))
+# Set by the periodic schedulers' threads to stop them
+schedulers_stop = threading.Event()
+background_started = False
+
+def start_background():
+    """Connect the default backend unless one is set, then start the job workers, schedulers and watchdog
+
+    Importing this module starts no threads; servers call this once per
+    process, and tests call it after init_backend() with the stand-ins.
+    """
+    global background_started
+    if background_started:
+        return
+    background_started = True
+    donor_table.restore_notified(notified_counts.load())
+    if db is None:
+        init_default_backend()
+    if os.environ.get('PROFILER_ENABLED', '').lower() in ('1', 'true', 'yes'):
+        profiler.start()
+    view_watchdog.start()
+    
+    job_queue.store.prune(JOB_RETENTION_SECONDS)
+    prune_uploads(BULK_UPLOAD_DIR, JOB_RETENTION_SECONDS)
+    job_queue.start()
+    
+    # Resume wave dispatches persisted before a restart
+    for wave_id, next_at in wave_store.pending():
+        wave_scheduler.schedule(wave_id, next_at)
+    wave_scheduler.start()
+    
+    for name, target, interval in (
+        ('token-sweep-scheduler', schedule_token_sweeps, TOKEN_SWEEP_INTERVAL_HOURS * 3600),
+        ('notification-rollup-scheduler', schedule_notification_rollups, NOTIFICATION_ROLLUP_INTERVAL_HOURS * 3600),
+        ('donor-snapshot-scheduler', schedule_donor_snapshots, DONOR_SNAPSHOT_INTERVAL_SECONDS),
+    ):
+        if interval > 0:
+            threading.Thread(target=target, args=(interval, schedulers_stop), name=name, daemon=True).start()
+    atexit.register(stop_background)
+
+def stop_background():
+    """Stop what start_background() started and flush the backend's queued writes"""
+    schedulers_stop.set()
+    view_watchdog.stop()
+    wave_scheduler.stop()
+    job_queue.stop()
+    profiler.stop()
+    stop_backend()
 
 if __name__ == '__main__':
     print("Starting Flask notification server...")
     print("Make sure you have firebase-service-account.json in the same directory")
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    start_background()
+    # The reloader would run a second copy of the background threads
+    app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
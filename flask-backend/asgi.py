@@ -0,0 +1,297 @@
+"""
+Asyncio (ASGI) serving mode for the notification server.
+
+Connections are held on the event loop, so one process can keep thousands
+of requests in flight. The Flask routes in app.py handle every request;
+their blocking Firestore and FCM calls run on a thread pool guarded by a
+semaphore of ASGI_MAX_CONCURRENCY slots, so a burst of slow backend calls
+queues on the loop instead of exhausting threads. A slot is only held while
+the route runs or produces a response chunk: request bodies of up to
+ASGI_MAX_BUFFERED_BODY_BYTES are read on the loop first, and chunks are sent
+to the client after the slot is released. Larger uploads are streamed to the
+route as it reads them, on one of ASGI_MAX_STREAMING_UPLOADS threads of
+their own, so slow uploaders cannot take the backend slots.
+
+Run with:  gunicorn -c gunicorn.conf.py asgi:application
+      or:  python asgi.py
+"""
+
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app as flask_app, metrics, start_background, stop_background
+
+MAX_CONCURRENCY = int(os.environ.get('ASGI_MAX_CONCURRENCY', 64))
+MAX_BUFFERED_BODY_BYTES = int(os.environ.get('ASGI_MAX_BUFFERED_BODY_BYTES', 1024 * 1024))
+MAX_STREAMING_UPLOADS = int(os.environ.get('ASGI_MAX_STREAMING_UPLOADS', 4))
+# Routes that never touch Firestore, FCM or SQLite are answered directly on the event loop
+LOOP_ROUTES = {('GET', '/health'), ('GET', '/resilience')}
+
+_END = object()
+
+
+class ReceiveStream(io.RawIOBase):
+    """wsgi.input reading the request body from an ASGI receive channel, one message at a time
+
+    Reads run on a backend thread and wait for the event loop to deliver
+    the next http.request message, so the body is never held whole.
+    """
+
+    def __init__(self, receive, loop, initial=b''):
+        self._receive = receive
+        self._loop = loop
+        # Body already read on the loop before the route started
+        self._chunk = initial
+        self._more = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk and self._more:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                raise ConnectionError('Client disconnected before sending the whole body')
+            self._chunk = message.get('body', b'')
+            self._more = message.get('more_body', False)
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+def build_environ(scope, body):
+    """Translate an ASGI HTTP scope and a binary request body stream into a WSGI environ"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # The stream ends with the body, so chunked uploads without Content-Length can be read too
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin1').lower()
+        value = raw_value.decode('latin1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class AsyncServer:
+    """ASGI application serving the Flask routes with bounded backend concurrency"""
+
+    def __init__(self, wsgi_app, max_concurrency=MAX_CONCURRENCY, max_buffered_body=MAX_BUFFERED_BODY_BYTES,
+                 max_streaming_uploads=MAX_STREAMING_UPLOADS, on_startup=None, on_shutdown=None):
+        self.wsgi_app = wsgi_app
+        self.on_startup = on_startup
+        self.on_shutdown = on_shutdown
+        self.max_concurrency = max_concurrency
+        self.max_buffered_body = max_buffered_body
+        self.max_streaming_uploads = max_streaming_uploads
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='asgi-backend')
+        self._upload_executor = ThreadPoolExecutor(max_workers=max_streaming_uploads, thread_name_prefix='asgi-upload')
+        self._semaphore = None
+        self._upload_semaphore = None
+        self.in_flight = 0
+        self.waiting = 0
+        self.streaming_uploads = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._create_semaphores()
+                if self.on_startup is not None:
+                    await asyncio.get_running_loop().run_in_executor(self._executor, self.on_startup)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=True)
+                self._upload_executor.shutdown(wait=True)
+                if self.on_shutdown is not None:
+                    self.on_shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _create_semaphores(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._upload_semaphore = asyncio.Semaphore(self.max_streaming_uploads)
+
+    async def _http(self, scope, receive, send):
+        if self._semaphore is None:
+            self._create_semaphores()
+        if (scope['method'], scope['path']) in LOOP_ROUTES:
+            # Reading the body here would block the loop it waits on; these GET routes take none
+            status, headers, chunks = self._call_wsgi(build_environ(scope, io.BytesIO()))
+            await self._send_response(send, status, headers, chunks)
+            return
+
+        loop = asyncio.get_running_loop()
+        body, more = await self._read_body(scope, receive)
+        if body is None:
+            return
+        if more:
+            environ = build_environ(scope, io.BufferedReader(ReceiveStream(receive, loop, body)))
+            self.streaming_uploads += 1
+            try:
+                async with self._upload_semaphore:
+                    status, headers, iterator = await loop.run_in_executor(
+                        self._upload_executor, self._start_wsgi, environ
+                    )
+            finally:
+                self.streaming_uploads -= 1
+        else:
+            status, headers, iterator = await self._run_backend(self._start_wsgi, build_environ(scope, io.BytesIO(body)))
+
+        try:
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            # Pull the body chunk by chunk so streamed responses stay streamed; the slot is
+            # only held while a chunk is produced, not while the client receives it
+            while True:
+                chunk = await self._run_backend(next, iterator, _END)
+                if chunk is _END:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                await loop.run_in_executor(self._executor, close)
+
+    async def _read_body(self, scope, receive):
+        """Read a request body on the loop; returns (body, more), more if it is longer than max_buffered_body
+
+        A longer body is left for the route to stream, after the part read
+        here. Returns (None, False) if the client disconnected.
+        """
+        for name, value in scope.get('headers', []):
+            if name.lower() == b'content-length' and value.isdigit() and int(value) > self.max_buffered_body:
+                return b'', True
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None, False
+            chunk = message.get('body', b'')
+            chunks.append(chunk)
+            size += len(chunk)
+            if not message.get('more_body', False):
+                return b''.join(chunks), False
+            if size > self.max_buffered_body:
+                return b''.join(chunks), True
+
+    async def _run_backend(self, fn, *args):
+        """Run fn(*args) on the backend pool once a concurrency slot is free"""
+        self.waiting += 1
+        async with self._semaphore:
+            self.waiting -= 1
+            self.in_flight += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+            finally:
+                self.in_flight -= 1
+
+    def _start_wsgi(self, environ):
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers]
+            return lambda data: None
+
+        result = self.wsgi_app(environ, start_response)
+        iterator = iter(result)
+        # WSGI apps may defer start_response until the first chunk is produced
+        first = next(iterator, _END)
+        chunks = iter(()) if first is _END else _prepend(first, iterator)
+        if hasattr(result, 'close'):
+            chunks = _Closing(chunks, result.close)
+        return response['status'], response['headers'], chunks
+
+    def _call_wsgi(self, environ):
+        status, headers, chunks = self._start_wsgi(environ)
+        body = list(chunks)
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        return status, headers, body
+
+    async def _send_response(self, send, status, headers, chunks):
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''.join(chunks), 'more_body': False})
+
+    def stats(self):
+        return {
+            'maxConcurrency': self.max_concurrency,
+            'inFlight': self.in_flight,
+            'waiting': self.waiting,
+            'streamingUploads': self.streaming_uploads,
+        }
+
+
+def _prepend(first, iterator):
+    yield first
+    yield from iterator
+
+
+class _Closing:
+    """Iterator wrapper that forwards close() to the original WSGI response"""
+
+    def __init__(self, iterator, close):
+        self._iterator = iterator
+        self.close = close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._iterator)
+
+
+# The background threads start with the server's lifespan, not on import
+application = AsyncServer(flask_app, on_startup=start_background, on_shutdown=stop_background)
+metrics.gauge('asgi_requests_in_flight', 'Requests holding a backend slot', lambda: application.in_flight)
+metrics.gauge('asgi_requests_waiting', 'Requests queued for a backend slot', lambda: application.waiting)
+metrics.gauge('asgi_streaming_uploads', 'Requests streaming a large body to their route',
+              lambda: application.streaming_uploads)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(
+        'asgi:application',
+        host=os.environ.get('HOST', '0.0.0.0'),
+        port=int(os.environ.get('PORT', 5000)),
+        workers=int(os.environ.get('WEB_CONCURRENCY', 1)),
+        timeout_keep_alive=int(os.environ.get('KEEP_ALIVE', 5)),
+        backlog=int(os.environ.get('BACKLOG', 2048)),
+    )
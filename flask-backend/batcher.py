@@ -0,0 +1,92 @@
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+
+_STOP = object()
+
+
+class BackgroundBatcher(ABC):
+    """Bounded queue drained by a worker thread that hands items to _flush() in batches
+
+    enqueue()/enqueue_many() return immediately. The worker flushes once a
+    batch holds batch_size items or flush_interval seconds after its first
+    item arrived; stop() flushes whatever is queued. Items arriving after
+    stop() or while the queue is full are dropped and counted. Subclasses
+    implement _flush().
+    """
+
+    thread_name = 'background-batcher'
+    # Names the worker in log lines
+    label = 'Background batcher'
+
+    def __init__(self, batch_size, flush_interval, max_queue_size=100000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+        self.failed_count = 0
+        self.dropped_count = 0
+
+    def start(self):
+        """Start the worker thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=10.0):
+        """Flush everything queued so far and stop the worker thread"""
+        if self._thread is None or self._stopped:
+            return
+        self._stopped = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def enqueue(self, item):
+        """Queue one item for the worker"""
+        if self._stopped:
+            print(f"{self.label} stopped, dropping record")
+            with self._lock:
+                self.dropped_count += 1
+            return False
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            print(f"{self.label} queue full, dropping record")
+            with self._lock:
+                self.dropped_count += 1
+            return False
+
+    def enqueue_many(self, items):
+        """Queue several items for the worker"""
+        return sum(1 for item in items if self.enqueue(item))
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            items = []
+            deadline = None
+            while len(items) < self.batch_size:
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                items.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if items:
+                self._flush(items)
+
+    @abstractmethod
+    def _flush(self, items):
+        """Write one batch of items; runs on the worker thread"""
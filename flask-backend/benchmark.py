@@ -0,0 +1,406 @@
+"""
+Load-testing benchmark for the notification server.
+
+Drives each endpoint in-process at a fixed concurrency against the
+in-memory Firestore/FCM stand-ins from local_backend.py and prints one
+JSON document with p50/p95/p99 latency, throughput and Firestore/FCM
+calls per request for every scenario. Send endpoints run with
+?wait=true so the measured latency covers the whole fan-out.
+
+Run with:  python benchmark.py --requests 500 --concurrency 16 --output run.json
+Compare:   python benchmark.py --baseline main.json --max-regression 0.2
+Restarts:  python benchmark.py --warm-start 100000,1000000
+"""
+
+import argparse
+import contextlib
+import gc
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from blood_compat import BLOOD_GROUPS
+
+# Area the seeded donors are spread over, roughly one metro region
+CENTER_LAT = 13.0827
+CENTER_LON = 80.2707
+SPREAD_DEGREES = 0.3
+NOTIFICATIONS_PER_USER = 120
+USERS_WITH_HISTORY = 20
+MULTICAST_SIZE = 200
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def user_id_list(user_count):
+    """Ids of the seeded users"""
+    return [f"user{i:06d}" for i in range(user_count)]
+
+
+def seed_data(firestore_client, user_count, rng):
+    """Fill the local Firestore with donors and a notification history; returns the user ids"""
+    user_ids = user_id_list(user_count)
+    users = {}
+    for user_id in user_ids:
+        users[user_id] = {
+            'email': f"{user_id}@example.com",
+            'fcmToken': f"token-{user_id}",
+            'bloodGroup': rng.choice(BLOOD_GROUPS),
+            'isAvailable': rng.random() < 0.9,
+            'location': {
+                'latitude': CENTER_LAT + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+                'longitude': CENTER_LON + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+            },
+        }
+    firestore_client.seed('users', users)
+
+    now = datetime.now(timezone.utc)
+    notifications = {}
+    for user_id in user_ids[:USERS_WITH_HISTORY]:
+        for n in range(NOTIFICATIONS_PER_USER):
+            notifications[f"{user_id}-n{n:04d}"] = {
+                'userId': user_id,
+                'title': 'Blood needed',
+                'body': f"Request {n}",
+                'fcmToken': f"token-{user_id}",
+                'status': 'sent',
+                'sentAt': now - timedelta(minutes=n),
+            }
+    firestore_client.seed('notifications', notifications)
+    return user_ids
+
+
+def donor_documents(user_count, rng):
+    """Yield (user id, users document) pairs spread like seed_data, a third with a past donation"""
+    now = datetime.now(timezone.utc)
+    for user_id in user_id_list(user_count):
+        data = {
+            'fcmToken': f"token-{user_id}",
+            'bloodGroup': rng.choice(BLOOD_GROUPS),
+            'isAvailable': rng.random() < 0.9,
+            'location': {
+                'latitude': CENTER_LAT + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+                'longitude': CENTER_LON + rng.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+            },
+        }
+        if rng.random() < 0.3:
+            data['lastDonation'] = now - timedelta(days=rng.randint(1, 400))
+        yield user_id, data
+
+
+def benchmark_warm_start(donor_count, directory, seed):
+    """Time building the donor views from a full users scan against loading them from a snapshot
+
+    The scan applies every document in-process the way the users listener's
+    first snapshot does, so it leaves out the Firestore transfer a real cold
+    start also waits for.
+    """
+    from blood_compat import CompatibilityIndex
+    from donor_index import DonorIndex
+    from donor_match import DonorTable
+    from snapshot import load_donor_snapshot, write_donor_snapshot
+
+    documents = list(donor_documents(donor_count, random.Random(seed)))
+    table, index, compat = DonorTable(), DonorIndex(), CompatibilityIndex()
+    started = time.perf_counter()
+    for user_id, data in documents:
+        table.upsert(user_id, data)
+        index.upsert(user_id, data)
+        compat.apply_user(user_id, data)
+    cold_seconds = time.perf_counter() - started
+    del documents
+
+    path = os.path.join(directory, f"donors-{donor_count}.snapshot")
+    started = time.perf_counter()
+    size = write_donor_snapshot(path, table.export(), time.time())
+    write_seconds = time.perf_counter() - started
+    del table, index, compat
+    gc.collect()
+
+    started = time.perf_counter()
+    load_donor_snapshot(path, DonorTable(), DonorIndex(), CompatibilityIndex())
+    load_seconds = time.perf_counter() - started
+    return {
+        'donors': donor_count,
+        'coldScanSeconds': round(cold_seconds, 3),
+        'snapshotWriteSeconds': round(write_seconds, 3),
+        'snapshotLoadSeconds': round(load_seconds, 3),
+        'snapshotBytes': size,
+        'speedup': round(cold_seconds / load_seconds, 1) if load_seconds else None,
+    }
+
+
+def build_scenarios(user_ids):
+    """Map scenario name to a function(rng) returning (method, path, json body)"""
+    history_ids = user_ids[:USERS_WITH_HISTORY]
+
+    def pick(rng):
+        return rng.choice(user_ids)
+
+    def blood_request(rng, **extra):
+        body = {
+            'bloodType': rng.choice(BLOOD_GROUPS),
+            'location': 'Chennai',
+            'requesterName': 'Benchmark',
+            # A distinct hospital per request keeps the dedupe window from collapsing the sends
+            'hospitalName': f"Hospital {rng.getrandbits(32)}",
+        }
+        body.update(extra)
+        return 'POST', '/blood-request-notification?wait=true', body
+
+    return {
+        'health': lambda rng: ('GET', '/health', None),
+        'save-fcm-token': lambda rng: ('POST', '/save-fcm-token', {
+            'userId': pick(rng), 'fcmToken': f"token-{rng.getrandbits(32)}"
+        }),
+        'send-notification': lambda rng: ('POST', '/send-notification?wait=true', {
+            'userId': pick(rng), 'title': 'Hello', 'body': 'Benchmark'
+        }),
+        'send-notification-to-multiple': lambda rng: ('POST', '/send-notification-to-multiple?wait=true', {
+            'userIds': rng.sample(user_ids, min(MULTICAST_SIZE, len(user_ids))), 'title': 'Hello', 'body': 'Benchmark'
+        }),
+        'send-notification-by-topic': lambda rng: ('POST', '/send-notification-by-topic?wait=true', {
+            'topic': 'blood_type_opos', 'title': 'Hello', 'body': 'Benchmark'
+        }),
+        'get-user-notifications': lambda rng: (
+            'GET', f"/get-user-notifications?userId={rng.choice(history_ids)}&limit=50", None
+        ),
+        'blood-request-nearby': lambda rng: blood_request(rng, coordinates={
+            'latitude': CENTER_LAT + rng.uniform(-0.1, 0.1), 'longitude': CENTER_LON + rng.uniform(-0.1, 0.1)
+        }, radiusKm=10, maxRecipients=100),
+        'match-donors': lambda rng: ('POST', '/match-donors', {
+            'bloodGroup': rng.choice(BLOOD_GROUPS), 'radiusKm': 50, 'limit': 100,
+            'coordinates': {'latitude': CENTER_LAT, 'longitude': CENTER_LON},
+        }),
+        'blood-request-compatible': lambda rng: blood_request(rng, includeCompatible=True),
+        'blood-request-topic': lambda rng: blood_request(rng, includeCompatible=False),
+        'blood-request-duplicate': lambda rng: ('POST', '/blood-request-notification?wait=true', {
+            'bloodType': 'O+', 'location': 'Chennai', 'hospitalName': 'General Hospital', 'includeCompatible': False
+        }),
+        'subscribe-to-topic': lambda rng: ('POST', '/subscribe-to-topic', {
+            'userId': pick(rng), 'topic': 'blood_type_opos'
+        }),
+        'bulk-subscribe-to-topics': lambda rng: ('POST', '/bulk-subscribe-to-topics?wait=true', {
+            'userIds': rng.sample(user_ids, min(MULTICAST_SIZE, len(user_ids))),
+            'topics': ['blood_type_opos', 'donors_chennai']
+        }),
+    }
+
+
+def drive(flask_app, make_request, total, concurrency, seed):
+    """Issue total requests from concurrency threads; returns (latencies in ms, status counts, wall seconds)"""
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    remaining = [total]
+
+    def worker(index):
+        client = flask_app.test_client()
+        rng = random.Random(seed * 1000 + index)
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            method, path, body = make_request(rng)
+            started = time.perf_counter()
+            response = client.open(path, method=method, json=body)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with lock:
+                latencies.append(elapsed_ms)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, time.perf_counter() - started
+
+
+def per_request(calls, requests):
+    return {op: round(count / requests, 3) for op, count in sorted(calls.items())} if requests else {}
+
+
+def run_scenario(app_module, make_backend, make_request, args):
+    # Every scenario starts from the same seeded data, so results do not depend on scenario order
+    firestore_client, messaging_client = make_backend()
+    # Warm up, then restart the backend so warm-up log writes are flushed before counting
+    app_module.init_backend(firestore_client, messaging_client)
+    if args.warmup:
+        drive(app_module.app, make_request, args.warmup, args.concurrency, args.seed + 1)
+    app_module.init_backend(firestore_client, messaging_client)
+    firestore_client.reset_stats()
+    messaging_client.reset_stats()
+
+    latencies, statuses, elapsed = drive(app_module.app, make_request, args.requests, args.concurrency, args.seed)
+    # Stopping flushes the notification logs queued by this scenario, so their commits are counted
+    app_module.stop_backend()
+
+    firestore_stats = firestore_client.stats()
+    messaging_stats = messaging_client.stats()
+    errors = sum(count for status, count in statuses.items() if status >= 500)
+    return {
+        'requests': len(latencies),
+        'concurrency': args.concurrency,
+        'errors': errors,
+        'statusCodes': {str(status): count for status, count in sorted(statuses.items())},
+        'durationSeconds': round(elapsed, 3),
+        'throughputRps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'latencyMs': {
+            'p50': round(percentile(latencies, 50), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+            'max': round(max(latencies), 3) if latencies else 0.0,
+        },
+        'firestoreCallsPerRequest': per_request(firestore_stats['calls'], len(latencies)),
+        'fcmCallsPerRequest': per_request(messaging_stats['calls'], len(latencies)),
+        'fcmMessagesPerRequest': round(messaging_stats['delivered'] / len(latencies), 3) if latencies else 0.0,
+        'fcmFailuresPerRequest': round(messaging_stats['failures'] / len(latencies), 3) if latencies else 0.0,
+    }
+
+
+def compare(results, baseline, max_regression):
+    """Compare p95 latency and throughput with a previous run; returns the list of regressions"""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous is None:
+            continue
+        if current['latencyMs']['p95'] > previous['latencyMs']['p95'] * (1 + max_regression):
+            regressions.append({
+                'scenario': name, 'metric': 'latencyMs.p95',
+                'baseline': previous['latencyMs']['p95'], 'current': current['latencyMs']['p95']
+            })
+        if current['throughputRps'] < previous['throughputRps'] * (1 - max_regression):
+            regressions.append({
+                'scenario': name, 'metric': 'throughputRps',
+                'baseline': previous['throughputRps'], 'current': current['throughputRps']
+            })
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the notification server against local stand-ins')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--users', type=int, default=5000, help='seeded users')
+    parser.add_argument('--scenarios', help='comma separated scenario names (default: all)')
+    parser.add_argument('--firestore-latency-ms', type=float, default=2.0)
+    parser.add_argument('--fcm-latency-ms', type=float, default=5.0)
+    parser.add_argument('--fcm-failure-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON report of a previous run to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='allowed fractional p95/throughput regression against the baseline')
+    parser.add_argument('--warm-start', help='comma separated donor counts to compare cold scan and snapshot load '
+                                             'at, instead of running the endpoint scenarios')
+    return parser.parse_args(argv)
+
+
+def warm_start_main(args):
+    directory = tempfile.mkdtemp(prefix='benchmark-snapshots-')
+    try:
+        results = []
+        for count in (int(value) for value in args.warm_start.split(',')):
+            print(f"Comparing cold scan and snapshot load at {count} donors", file=sys.stderr)
+            results.append(benchmark_warm_start(count, directory, args.seed))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    output = json.dumps({'generatedAt': datetime.now(timezone.utc).isoformat(), 'warmStart': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.warm_start:
+        return warm_start_main(args)
+    # The server must come up on the local backend with its job store out of the way
+    os.environ['NOTIFICATION_BACKEND'] = 'local'
+    jobs_dir = tempfile.mkdtemp(prefix='benchmark-jobs-')
+    os.environ.setdefault('JOBS_DB_PATH', os.path.join(jobs_dir, 'jobs.sqlite3'))
+    # Scenarios resend to the same donors far more often than the per-donor push budget allows
+    os.environ.setdefault('DONOR_PUSH_BURST', '1000000')
+    os.environ.setdefault('TOPIC_PUSH_BURST', '1000000')
+
+    # Route chatter goes to stderr so stdout carries only the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        import app as app_module
+        from local_backend import LocalFirestore, LocalMessaging
+
+        def make_backend():
+            firestore_client = LocalFirestore(latency=args.firestore_latency_ms / 1000)
+            seed_data(firestore_client, args.users, random.Random(args.seed))
+            messaging_client = LocalMessaging(
+                latency=args.fcm_latency_ms / 1000, failure_rate=args.fcm_failure_rate, seed=args.seed
+            )
+            return firestore_client, messaging_client
+
+        scenarios = build_scenarios(user_id_list(args.users))
+        selected = args.scenarios.split(',') if args.scenarios else list(scenarios)
+        unknown = [name for name in selected if name not in scenarios]
+        if unknown:
+            raise SystemExit(f"Unknown scenarios: {', '.join(unknown)}")
+
+        # Job workers run wave dispatches; each scenario then points them at its own backend
+        app_module.start_background()
+        results = {}
+        for name in selected:
+            print(f"Running scenario {name}")
+            results[name] = run_scenario(app_module, make_backend, scenarios[name], args)
+        app_module.stop_background()
+
+    report = {
+        'generatedAt': datetime.now(timezone.utc).isoformat(),
+        'config': {
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'users': args.users,
+            'firestoreLatencyMs': args.firestore_latency_ms,
+            'fcmLatencyMs': args.fcm_latency_ms,
+            'fcmFailureRate': args.fcm_failure_rate,
+            'seed': args.seed,
+        },
+        'scenarios': results,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        report['regressions'] = regressions
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
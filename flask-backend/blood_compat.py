@@ -0,0 +1,131 @@
+import threading
+import time
+
+from donor_index import normalize_blood_group
+
+BLOOD_GROUPS = ('O-', 'O+', 'A-', 'A+', 'B-', 'B+', 'AB-', 'AB+')
+BLOOD_GROUP_CODES = {group: code for code, group in enumerate(BLOOD_GROUPS)}
+
+_ANTIGEN_A = 1
+_ANTIGEN_B = 2
+_ANTIGEN_RH = 4
+
+
+def _antigens(group):
+    abo = group.rstrip('+-')
+    antigens = 0
+    if 'A' in abo:
+        antigens |= _ANTIGEN_A
+    if 'B' in abo:
+        antigens |= _ANTIGEN_B
+    if group.endswith('+'):
+        antigens |= _ANTIGEN_RH
+    return antigens
+
+
+def _build_masks():
+    # A donor is compatible when the recipient carries every antigen the donor does
+    can_donate_to = [0] * len(BLOOD_GROUPS)
+    can_receive_from = [0] * len(BLOOD_GROUPS)
+    for donor_code, donor in enumerate(BLOOD_GROUPS):
+        for recipient_code, recipient in enumerate(BLOOD_GROUPS):
+            if _antigens(donor) & ~_antigens(recipient) == 0:
+                can_donate_to[donor_code] |= 1 << recipient_code
+                can_receive_from[recipient_code] |= 1 << donor_code
+    return tuple(can_donate_to), tuple(can_receive_from)
+
+
+# Bit r of CAN_DONATE_TO[d] is set when group d can donate to group r
+CAN_DONATE_TO, CAN_RECEIVE_FROM = _build_masks()
+
+ELIGIBLE_DONOR_GROUPS = {
+    recipient: frozenset(BLOOD_GROUPS[d] for d in range(len(BLOOD_GROUPS)) if CAN_RECEIVE_FROM[r] >> d & 1)
+    for r, recipient in enumerate(BLOOD_GROUPS)
+}
+
+
+def blood_group_code(value):
+    """Return the 0-7 code of a blood group string, or None if unknown"""
+    return BLOOD_GROUP_CODES.get(normalize_blood_group(value))
+
+
+def is_compatible(donor_group, recipient_group):
+    """Check whether donor_group can donate to recipient_group"""
+    donor = blood_group_code(donor_group)
+    recipient = blood_group_code(recipient_group)
+    if donor is None or recipient is None:
+        return False
+    return bool(CAN_DONATE_TO[donor] >> recipient & 1)
+
+
+def eligible_donor_groups(recipient_group):
+    """Return the frozenset of groups that can donate to recipient_group"""
+    return ELIGIBLE_DONOR_GROUPS.get(normalize_blood_group(recipient_group), frozenset())
+
+
+class CompatibilityIndex:
+    """Per-blood-group donor id sets answering eligibility queries by set union"""
+
+    def __init__(self):
+        self._donors_by_code = [set() for _ in BLOOD_GROUPS]
+        self._code_by_user = {}
+        self._lock = threading.Lock()
+        self.ready = False
+        self.last_update = None
+
+    def __len__(self):
+        return len(self._code_by_user)
+
+    def upsert(self, user_id, blood_group, available=True):
+        """Record a donor's blood group; unavailable or unknown groups are dropped"""
+        code = blood_group_code(blood_group) if available else None
+        with self._lock:
+            previous = self._code_by_user.pop(user_id, None)
+            if previous is not None:
+                self._donors_by_code[previous].discard(user_id)
+            if code is not None:
+                self._donors_by_code[code].add(user_id)
+                self._code_by_user[user_id] = code
+            self.last_update = time.time()
+
+    def remove(self, user_id):
+        self.upsert(user_id, None)
+
+    def load_codes(self, codes_by_user):
+        """Replace every donor with {user_id: blood group code} of available donors"""
+        donors_by_code = [set() for _ in BLOOD_GROUPS]
+        for user_id, code in codes_by_user.items():
+            donors_by_code[code].add(user_id)
+        with self._lock:
+            self._donors_by_code = donors_by_code
+            self._code_by_user = dict(codes_by_user)
+            self.last_update = time.time()
+
+    def apply_user(self, user_id, data):
+        """Update the index from a users document, or remove it when data is None"""
+        if data is None:
+            self.remove(user_id)
+        else:
+            self.upsert(user_id, data.get('bloodGroup'), data.get('isAvailable', True) is not False)
+
+    def eligible_donors(self, recipient_group):
+        """Return the set of donor ids whose group can donate to recipient_group"""
+        recipient = blood_group_code(recipient_group)
+        if recipient is None:
+            return set()
+        mask = CAN_RECEIVE_FROM[recipient]
+        with self._lock:
+            return set().union(*(
+                donors for code, donors in enumerate(self._donors_by_code) if mask >> code & 1
+            ))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self.ready,
+                'donors': len(self._code_by_user),
+                'byBloodGroup': {
+                    group: len(self._donors_by_code[code]) for code, group in enumerate(BLOOD_GROUPS)
+                },
+                'lastUpdate': self.last_update,
+            }
@@ -0,0 +1,337 @@
+import csv
+import io
+import json
+import math
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+from firebase_admin import firestore
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions, SendMode
+
+from blood_compat import BLOOD_GROUPS
+from donor_index import normalize_blood_group
+from donor_match import parse_donation_time
+from geo import parse_coordinates
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+FORMATS = (NDJSON, CSV)
+
+# users fields a bulk import may write, as RegisterScreen and /save-fcm-token store them
+USER_FIELDS = (
+    'name', 'email', 'phoneNumber', 'bloodGroup', 'age', 'weight', 'lastDonation', 'medicalConditions',
+    'location', 'isAvailable', 'donationCount', 'fcmToken'
+)
+# CSV has no nesting, so location comes as latitude and longitude columns
+CSV_COLUMNS = ('userId',) + tuple(field for field in USER_FIELDS if field != 'location') + ('latitude', 'longitude')
+MAX_USER_ID_BYTES = 1500
+MAX_STRING_LENGTH = 4096
+MAX_LINE_BYTES = 64 * 1024
+_BOOLEANS = {'true': True, 'yes': True, '1': True, 'false': False, 'no': False, '0': False}
+# CSV bytes that are not UTF-8 are decoded to these lone surrogates, so a bad row does not stop the rest
+_UNDECODABLE = re.compile('[\udc80-\udcff]')
+
+# Rows are handed to the BulkWriter and flushed in chunks, so memory stays flat whatever the upload size
+IMPORT_CHUNK_SIZE = 1000
+# BulkWriter starts at 500 writes/s and ramps up by half every 5 minutes, never past this
+DEFAULT_MAX_OPS_PER_SECOND = 500
+# Writes failing with these gRPC codes are retried; anything else is reported against its row
+RETRYABLE_WRITE_CODES = {4, 8, 10, 13, 14}
+DEFAULT_WRITE_ATTEMPTS = 5
+MAX_REPORTED_ERRORS = 100
+EXPORT_PAGE_SIZE = 500
+
+
+class InvalidUpload(ValueError):
+    """An upload that cannot be imported at all, such as a CSV with an unusable header"""
+
+
+def parse_ndjson(stream):
+    """Yield (line number, row, error) for every non-blank line of a binary NDJSON stream, one line at a time"""
+    line_number = 0
+    while True:
+        line = stream.readline(MAX_LINE_BYTES + 1)
+        if not line:
+            return
+        line_number += 1
+        if len(line) > MAX_LINE_BYTES and not line.endswith(b'\n'):
+            # Skip the rest of an overlong line without holding it
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(MAX_LINE_BYTES + 1)
+            yield line_number, None, f"Line is longer than {MAX_LINE_BYTES} bytes"
+            continue
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_number, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(row, dict):
+            yield line_number, None, "Each line must be a JSON object"
+            continue
+        yield line_number, row, None
+
+
+def parse_csv(stream):
+    """Yield (line number, row, error) for every record of a binary CSV stream with a header row
+
+    Empty cells are left out of the row, and a row that is not valid UTF-8
+    is reported as an error. Raises InvalidUpload for a header that is not
+    UTF-8, lacks userId or has columns that are not users fields.
+    """
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', errors='surrogateescape', newline=''))
+    if reader.fieldnames is None:
+        return
+    columns = [column.strip() for column in reader.fieldnames]
+    if any(_UNDECODABLE.search(column) for column in columns):
+        raise InvalidUpload("CSV header is not valid UTF-8")
+    unknown = [column for column in columns if column not in CSV_COLUMNS]
+    if unknown:
+        raise InvalidUpload(f"Unknown CSV column(s): {', '.join(unknown)}")
+    if 'userId' not in columns:
+        raise InvalidUpload("CSV header must include userId")
+    reader.fieldnames = columns
+    while True:
+        try:
+            record = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield reader.line_num, None, f"Invalid CSV: {e}"
+            continue
+        if None in record:
+            yield reader.line_num, None, "Row has more cells than the header"
+            continue
+        if any(value is not None and _UNDECODABLE.search(value) for value in record.values()):
+            yield reader.line_num, None, "Row is not valid UTF-8"
+            continue
+        row = {column: value for column, value in record.items() if value is not None and value.strip() != ''}
+        if 'latitude' in row or 'longitude' in row:
+            row['location'] = {'latitude': row.pop('latitude', None), 'longitude': row.pop('longitude', None)}
+        yield reader.line_num, row, None
+
+
+def parse_rows(stream, format):
+    """Row parser for an upload in one of FORMATS"""
+    if format == CSV:
+        return parse_csv(stream)
+    return parse_ndjson(stream)
+
+
+def _string(field, value):
+    if not isinstance(value, str):
+        raise ValueError(f"{field} must be a string")
+    if len(value) > MAX_STRING_LENGTH:
+        raise ValueError(f"{field} must be at most {MAX_STRING_LENGTH} characters")
+    return value.strip()
+
+
+def _blood_group(field, value):
+    group = normalize_blood_group(value) if isinstance(value, str) else None
+    if group not in BLOOD_GROUPS:
+        raise ValueError(f"{field} must be one of {', '.join(BLOOD_GROUPS)}")
+    return group
+
+
+def _number(field, value, integer=False):
+    try:
+        number = float(value) if not isinstance(value, bool) else math.nan
+    except (TypeError, ValueError):
+        number = math.nan
+    if not math.isfinite(number) or number < 0 or (integer and not number.is_integer()):
+        raise ValueError(f"{field} must be a non-negative {'whole ' if integer else ''}number")
+    return int(number) if number.is_integer() else number
+
+
+def _boolean(field, value):
+    if isinstance(value, str):
+        value = _BOOLEANS.get(value.strip().lower(), value)
+    if not isinstance(value, bool):
+        raise ValueError(f"{field} must be true or false")
+    return value
+
+
+def _date(field, value):
+    if not isinstance(value, str) or parse_donation_time(value) is None:
+        raise ValueError(f"{field} must be an ISO date such as 2026-05-01")
+    return value.strip()
+
+
+def _location(field, value):
+    coordinates = parse_coordinates(value)
+    if coordinates is None:
+        raise ValueError(f"{field} needs a latitude within ±90 and a longitude within ±180, other than 0,0")
+    return {'latitude': coordinates[0], 'longitude': coordinates[1]}
+
+
+_FIELD_PARSERS = {
+    'name': _string,
+    'email': _string,
+    'phoneNumber': _string,
+    'medicalConditions': _string,
+    'fcmToken': _string,
+    'bloodGroup': _blood_group,
+    'age': _number,
+    'weight': _number,
+    'donationCount': lambda field, value: _number(field, value, integer=True),
+    'isAvailable': _boolean,
+    'lastDonation': _date,
+    'location': _location,
+}
+
+
+def validate_user_row(row):
+    """Check one imported row; returns (user id, fields to merge into its users document) or raises ValueError"""
+    row = dict(row)
+    user_id = row.pop('userId', None)
+    if not isinstance(user_id, str) or not user_id.strip():
+        raise ValueError("userId is required")
+    user_id = user_id.strip()
+    if ('/' in user_id or user_id in ('.', '..') or (user_id.startswith('__') and user_id.endswith('__'))
+            or len(user_id.encode('utf-8')) > MAX_USER_ID_BYTES):
+        raise ValueError(f"userId {user_id!r} is not a valid document id")
+    unknown = sorted(field for field in row if field not in _FIELD_PARSERS)
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}")
+    fields = {field: _FIELD_PARSERS[field](field, value) for field, value in row.items() if value is not None}
+    if fields.get('fcmToken'):
+        fields['lastTokenUpdate'] = firestore.SERVER_TIMESTAMP
+    fields['updatedAt'] = firestore.SERVER_TIMESTAMP
+    return user_id, fields
+
+
+def import_users(db, rows, chunk_size=IMPORT_CHUNK_SIZE, max_ops_per_second=DEFAULT_MAX_OPS_PER_SECOND,
+                 max_attempts=DEFAULT_WRITE_ATTEMPTS, on_progress=None):
+    """Validate (line number, row, error) tuples and merge the valid rows into users with a BulkWriter
+
+    Writes go out in parallel batches at the writer's ramped rate, and the
+    writer is flushed every chunk_size rows so only one chunk is in flight.
+    Returns the counts and up to MAX_REPORTED_ERRORS row errors with their
+    line numbers; on_progress(counts) is called after every chunk.
+    """
+    lock = threading.Lock()
+    summary = {'rowCount': 0, 'importedCount': 0, 'invalidCount': 0, 'failedCount': 0}
+    errors = []
+    truncated = [False]
+    lines = {}
+
+    def report(line, user_id, message):
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({'line': line, 'userId': user_id, 'error': message})
+        else:
+            truncated[0] = True
+
+    def on_result(reference, result, writer):
+        with lock:
+            summary['importedCount'] += 1
+
+    def on_error(failure, writer):
+        if failure.code in RETRYABLE_WRITE_CODES and failure.attempts < max_attempts:
+            return True
+        reference = failure.operation.reference
+        with lock:
+            summary['failedCount'] += 1
+            report(lines.get(reference.path), reference.id, failure.message)
+        return False
+
+    writer = db.bulk_writer(options=BulkWriterOptions(
+        initial_ops_per_second=min(DEFAULT_MAX_OPS_PER_SECOND, max_ops_per_second),
+        max_ops_per_second=max_ops_per_second,
+        mode=SendMode.parallel,
+    ))
+    writer.on_write_result(on_result)
+    writer.on_write_error(on_error)
+    users = db.collection('users')
+
+    def flush():
+        writer.flush()
+        lines.clear()
+        if on_progress is not None:
+            with lock:
+                counts = dict(summary)
+            on_progress(counts)
+
+    pending = 0
+    try:
+        for line, row, error in rows:
+            summary['rowCount'] += 1
+            if error is None:
+                try:
+                    user_id, fields = validate_user_row(row)
+                except ValueError as e:
+                    error = str(e)
+            if error is not None:
+                row_id = row.get('userId') if isinstance(row, dict) else None
+                with lock:
+                    summary['invalidCount'] += 1
+                    report(line, row_id if isinstance(row_id, str) else None, error)
+                continue
+            reference = users.document(user_id)
+            lines[reference.path] = line
+            writer.set(reference, fields, merge=True)
+            pending += 1
+            if pending >= chunk_size:
+                flush()
+                pending = 0
+        flush()
+    finally:
+        writer.close()
+    summary['errors'] = errors
+    summary['errorsTruncated'] = truncated[0]
+    return summary
+
+
+def _exportable(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    # A GeoPoint written by another client exports as the map the import takes
+    if hasattr(value, 'latitude') and hasattr(value, 'longitude'):
+        return {'latitude': value.latitude, 'longitude': value.longitude}
+    return value
+
+
+def export_users(db, include_tokens=False, page_size=EXPORT_PAGE_SIZE):
+    """Yield an import-compatible record per users document, reading one page of the fields at a time in id order
+
+    FCM tokens are left out unless include_tokens is set.
+    """
+    fields = [field for field in USER_FIELDS if include_tokens or field != 'fcmToken']
+    query = db.collection('users').select(fields).order_by('__name__').limit(page_size)
+    last = None
+    while True:
+        page = list((query.start_after(last) if last is not None else query).stream())
+        for doc in page:
+            record = {'userId': doc.id}
+            for field, value in (doc.to_dict() or {}).items():
+                if value is not None:
+                    record[field] = _exportable(value)
+            yield record
+        if len(page) < page_size:
+            return
+        last = page[-1]
+
+
+def to_ndjson(record):
+    return json.dumps(record, ensure_ascii=False, default=str) + '\n'
+
+
+def prune_uploads(directory, older_than_seconds):
+    """Remove spooled uploads left behind by imports that never finished; returns how many were removed"""
+    if not os.path.isdir(directory):
+        return 0
+    cutoff = time.time() - older_than_seconds
+    removed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
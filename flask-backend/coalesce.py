@@ -0,0 +1,175 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class IdempotencyConflict(Exception):
+    """An Idempotency-Key was reused with a different request body"""
+
+
+def request_fingerprint(kind, payload, ignore=()):
+    """Stable hash of a job kind and payload, leaving out volatile fields such as timestamps"""
+    body = {key: value for key, value in payload.items() if key not in ignore}
+    encoded = json.dumps([kind, body], sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode('utf8')).hexdigest()
+
+
+class TTLStore:
+    """Bounded mapping whose entries expire ttl seconds after they were stored
+
+    Entries are kept in insertion order, so expired ones are swept from the
+    front and the oldest entry is evicted when the store is full.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= now:
+            return None
+        return entry[0]
+
+    def put(self, key, value, now):
+        self._entries.pop(key, None)
+        self._entries[key] = (value, now + self.ttl)
+        self._sweep(now)
+
+    def pop(self, key):
+        self._entries.pop(key, None)
+
+    def _sweep(self, now):
+        while self._entries:
+            key, (_, expires_at) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_size:
+                break
+            del self._entries[key]
+            if expires_at > now:
+                self.evictions += 1
+
+
+class _Call:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.outcome = None
+        self.error = None
+
+
+class RequestCoalescer:
+    """Runs one request per idempotency or coalescing key and hands its outcome to every duplicate
+
+    A duplicate arriving while the first request is still running waits for
+    it and shares its outcome. Outcomes are then remembered for window
+    seconds under the coalescing key (any request with the same key is a
+    duplicate) and for idempotency_ttl seconds under the client's
+    Idempotency-Key (the same key with a different body is a conflict).
+    is_reusable(outcome) decides whether a remembered outcome may be handed
+    out, so failed sends are retried instead of replayed.
+    """
+
+    def __init__(self, window=300.0, max_keys=10000, idempotency_ttl=86400.0, max_idempotency_keys=100000,
+                 is_reusable=None):
+        self._recent = TTLStore(max_keys, window)
+        self._idempotent = TTLStore(max_idempotency_keys, idempotency_ttl)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._is_reusable = is_reusable or (lambda outcome: True)
+        self.executed = 0
+        self.joined = 0
+        self.replayed = 0
+        self.conflicts = 0
+
+    def execute(self, fn, fingerprint, coalesce_key=None, idempotency_key=None):
+        """Return (outcome, how) where how is None if fn ran, else 'joined' or 'replayed'"""
+        keys = []
+        if idempotency_key:
+            keys.append((self._idempotent, ('idempotency', idempotency_key), True))
+        if coalesce_key:
+            keys.append((self._recent, ('coalesce', coalesce_key), False))
+
+        with self._lock:
+            now = time.monotonic()
+            call = None
+            for store, key, strict in keys:
+                entry = store.get(key, now)
+                if entry is not None:
+                    stored_fingerprint, outcome = entry
+                    if strict and stored_fingerprint != fingerprint:
+                        self.conflicts += 1
+                        raise IdempotencyConflict("Idempotency-Key was already used for a different request")
+                    if self._is_reusable(outcome):
+                        self.replayed += 1
+                        self._remember(keys, fingerprint, outcome, now)
+                        return outcome, 'replayed'
+                    store.pop(key)
+                call = self._in_flight.get(key)
+                if call is not None:
+                    if strict and call.fingerprint != fingerprint:
+                        self.conflicts += 1
+                        raise IdempotencyConflict("Idempotency-Key is in use by a different request")
+                    break
+            if call is None:
+                leader = _Call(fingerprint)
+                for _, key, _ in keys:
+                    self._in_flight[key] = leader
+
+        if call is not None:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            with self._lock:
+                self.joined += 1
+                if self._is_reusable(call.outcome):
+                    self._remember(keys, fingerprint, call.outcome, time.monotonic())
+            return call.outcome, 'joined'
+
+        try:
+            leader.outcome = fn()
+        except Exception as e:
+            leader.error = e
+            raise
+        finally:
+            with self._lock:
+                now = time.monotonic()
+                self.executed += 1
+                for _, key, _ in keys:
+                    self._in_flight.pop(key, None)
+                if leader.error is None and self._is_reusable(leader.outcome):
+                    self._remember(keys, fingerprint, leader.outcome, now)
+            leader.done.set()
+        return leader.outcome, None
+
+    def clear(self):
+        """Forget remembered outcomes; requests already running still finish and hand theirs to their waiters"""
+        with self._lock:
+            self._recent = TTLStore(self._recent.max_size, self._recent.ttl)
+            self._idempotent = TTLStore(self._idempotent.max_size, self._idempotent.ttl)
+
+    def _remember(self, keys, fingerprint, outcome, now):
+        # Called with the lock held; a replay also binds the caller's Idempotency-Key to the outcome
+        for store, key, _ in keys:
+            if store.get(key, now) is None:
+                store.put(key, (fingerprint, outcome), now)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'windowSeconds': self._recent.ttl,
+                'idempotencyTtlSeconds': self._idempotent.ttl,
+                'recentKeys': len(self._recent),
+                'idempotencyKeys': len(self._idempotent),
+                'inFlight': len(set(map(id, self._in_flight.values()))),
+                'executed': self.executed,
+                'joined': self.joined,
+                'replayed': self.replayed,
+                'conflicts': self.conflicts,
+            }
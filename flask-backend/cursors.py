@@ -0,0 +1,20 @@
+import base64
+import json
+
+
+def encode_cursor(values):
+    """Encode a dict of keyset values as an opaque URL-safe cursor token"""
+    raw = json.dumps(values, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Decode a cursor token back into its dict; raises ValueError if it is malformed"""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError):
+        raise ValueError("malformed cursor token")
+    if not isinstance(values, dict):
+        raise ValueError("malformed cursor token")
+    return values
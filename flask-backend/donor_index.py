@@ -0,0 +1,171 @@
+import heapq
+import threading
+import time
+
+from geo import encode_geohash, estimate_cell_count, geohash_cells_covering, haversine_km, parse_coordinates
+
+# Donors are bucketed at several geohash lengths so both small and large
+# radius queries touch a bounded number of cells (5 ~ 4.9km, 3 ~ 156km)
+INDEX_PRECISIONS = (3, 4, 5)
+MAX_QUERY_CELLS = 256
+
+
+def query_precision(lat, radius_km):
+    """Finest index precision whose cells cover a radius query in at most MAX_QUERY_CELLS"""
+    for precision in reversed(INDEX_PRECISIONS):
+        if estimate_cell_count(lat, radius_km, precision) <= MAX_QUERY_CELLS:
+            return precision
+    return INDEX_PRECISIONS[0]
+
+
+def normalize_blood_group(value):
+    """Normalize a blood group string such as ' ab+ ' to 'AB+'"""
+    if not value:
+        return None
+    return str(value).strip().upper().replace(' ', '')
+
+
+class Donor:
+    """Compact in-memory record of an indexed donor"""
+
+    __slots__ = ('user_id', 'lat', 'lon', 'blood_group', 'fcm_token', 'available', 'cells')
+
+    def __init__(self, user_id, lat, lon, blood_group, fcm_token, available, cells=None):
+        self.user_id = user_id
+        self.lat = lat
+        self.lon = lon
+        self.blood_group = blood_group
+        self.fcm_token = fcm_token
+        self.available = available
+        self.cells = cells or tuple(encode_geohash(lat, lon, p) for p in INDEX_PRECISIONS)
+
+
+def donor_from_user(user_id, data):
+    """Build a Donor from a users document, or None if it has no usable location"""
+    coordinates = parse_coordinates((data or {}).get('location'))
+    if coordinates is None:
+        return None
+    return Donor(
+        user_id,
+        coordinates[0],
+        coordinates[1],
+        normalize_blood_group(data.get('bloodGroup')),
+        data.get('fcmToken'),
+        data.get('isAvailable', True) is not False,
+    )
+
+
+class DonorIndex:
+    """Geohash-bucketed spatial index over donors from the users collection"""
+
+    def __init__(self):
+        self._donors = {}
+        self._buckets = {precision: {} for precision in INDEX_PRECISIONS}
+        self._lock = threading.RLock()
+        self.ready = False
+        self.last_update = None
+
+    def __len__(self):
+        return len(self._donors)
+
+    def upsert(self, user_id, data):
+        """Add or refresh a donor from its users document data"""
+        donor = donor_from_user(user_id, data)
+        with self._lock:
+            self._remove_locked(user_id)
+            if donor is not None:
+                self._donors[user_id] = donor
+                for precision, cell in zip(INDEX_PRECISIONS, donor.cells):
+                    self._buckets[precision].setdefault(cell, {})[user_id] = donor
+            self.last_update = time.time()
+
+    def remove(self, user_id):
+        """Drop a donor from the index"""
+        with self._lock:
+            self._remove_locked(user_id)
+            self.last_update = time.time()
+
+    def _remove_locked(self, user_id):
+        donor = self._donors.pop(user_id, None)
+        if donor is None:
+            return
+        for precision, cell in zip(INDEX_PRECISIONS, donor.cells):
+            bucket = self._buckets[precision].get(cell)
+            if bucket is not None:
+                bucket.pop(user_id, None)
+                if not bucket:
+                    del self._buckets[precision][cell]
+
+    def load(self, snapshots):
+        """Rebuild the index from an iterable of users document snapshots"""
+        with self._lock:
+            self._donors.clear()
+            for buckets in self._buckets.values():
+                buckets.clear()
+            for snapshot in snapshots:
+                if snapshot.exists:
+                    self.upsert(snapshot.id, snapshot.to_dict())
+            self.ready = True
+            self.last_update = time.time()
+
+    def load_donors(self, donors):
+        """Replace every donor with the given Donor records"""
+        donors = {donor.user_id: donor for donor in donors}
+        buckets = {precision: {} for precision in INDEX_PRECISIONS}
+        for position, precision in enumerate(INDEX_PRECISIONS):
+            cells = buckets[precision]
+            for user_id, donor in donors.items():
+                cell = donor.cells[position]
+                bucket = cells.get(cell)
+                if bucket is None:
+                    bucket = cells[cell] = {}
+                bucket[user_id] = donor
+        with self._lock:
+            self._donors = donors
+            self._buckets = buckets
+            self.last_update = time.time()
+
+    def apply_user(self, user_id, data):
+        """Update the index from a users document, or remove it when data is None"""
+        if data is None:
+            self.remove(user_id)
+        else:
+            self.upsert(user_id, data)
+
+    def nearest(self, lat, lon, radius_km, limit, blood_groups=None, exclude=None, require_token=True):
+        """Return up to limit (distance_km, Donor) pairs within radius_km, closest first
+
+        Only available donors are returned; blood_groups restricts the
+        result to those groups and exclude skips the given user ids.
+        """
+        if limit <= 0:
+            return []
+        precision = query_precision(lat, radius_km)
+        cells = geohash_cells_covering(lat, lon, radius_km, precision)
+        candidates = []
+        with self._lock:
+            buckets = self._buckets[precision]
+            for cell in cells:
+                bucket = buckets.get(cell)
+                if not bucket:
+                    continue
+                for donor in bucket.values():
+                    if not donor.available or (require_token and not donor.fcm_token):
+                        continue
+                    if blood_groups is not None and donor.blood_group not in blood_groups:
+                        continue
+                    if exclude and donor.user_id in exclude:
+                        continue
+                    distance = haversine_km(lat, lon, donor.lat, donor.lon)
+                    if distance <= radius_km:
+                        candidates.append((distance, donor))
+        return heapq.nsmallest(limit, candidates, key=lambda item: item[0])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self.ready,
+                'donors': len(self._donors),
+                'cells': {str(p): len(b) for p, b in self._buckets.items()},
+                'lastUpdate': self.last_update,
+            }
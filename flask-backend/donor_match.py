@@ -0,0 +1,347 @@
+import sqlite3
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import datetime, timezone
+
+import numpy as np
+
+from blood_compat import BLOOD_GROUPS, CAN_RECEIVE_FROM, blood_group_code
+from geo import EARTH_RADIUS_KM, parse_coordinates
+
+# Donors must wait this long after a donation before they are matched again
+DONATION_INTERVAL_DAYS = 90
+# Score = DISTANCE_WEIGHT * closeness within the radius + RESPONSIVENESS_WEIGHT * accept rate
+DISTANCE_WEIGHT = 0.6
+RESPONSIVENESS_WEIGHT = 0.4
+# Accept rates are smoothed towards PRIOR_ACCEPTS / PRIOR_REQUESTS so new donors are not ranked last
+PRIOR_ACCEPTS = 1.0
+PRIOR_REQUESTS = 4.0
+# Rows for unknown blood groups use this code, which no recipient accepts
+UNKNOWN_GROUP_CODE = len(BLOOD_GROUPS)
+INITIAL_CAPACITY = 1024
+
+DonorMatch = namedtuple('DonorMatch', ['user_id', 'fcm_token', 'distance_km', 'accept_rate', 'score'])
+
+
+def _accepting_groups(recipient_code, exact_group=False):
+    # Boolean lookup indexed by donor group code: True where the donor can give to the recipient
+    accepts = np.zeros(UNKNOWN_GROUP_CODE + 1, dtype=bool)
+    if exact_group:
+        accepts[recipient_code] = True
+        return accepts
+    for code in range(len(BLOOD_GROUPS)):
+        accepts[code] = bool(CAN_RECEIVE_FROM[recipient_code] >> code & 1)
+    return accepts
+
+
+def parse_donation_time(value):
+    """Epoch seconds of a lastDonation value (Timestamp, datetime or 'YYYY-MM-DD'), or None"""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def request_donor_ids(data):
+    """User ids of the donors who accepted a requests document; entries are ids or {userId, units}"""
+    donor_ids = set()
+    for donor in (data or {}).get('donors') or []:
+        user_id = donor.get('userId') if isinstance(donor, dict) else donor
+        if isinstance(user_id, str) and user_id:
+            donor_ids.add(user_id)
+    return donor_ids
+
+
+class DonorTable:
+    """Columnar NumPy table of donors, ranked for a blood request in a few vectorized passes
+
+    Each donor occupies one row of parallel arrays holding position in
+    radians, blood group code, last donation time and accept history.
+    Rows are filled from the users listener; accept counts come from the
+    requests listener and notified counts from blood request sends, restored
+    from NotifiedCounts on a restart.
+    """
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self._rows = {}
+        self._free = []
+        self._size = 0
+        self._user_ids = []
+        self._tokens = []
+        self._history = {}
+        self._request_donors = {}
+        self._lock = threading.Lock()
+        self._allocate(capacity)
+        self.ready = False
+        self.last_update = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _allocate(self, capacity):
+        self.capacity = capacity
+        self._lat = np.zeros(capacity)
+        self._lon = np.zeros(capacity)
+        self._cos_lat = np.zeros(capacity)
+        self._group = np.full(capacity, UNKNOWN_GROUP_CODE, dtype=np.int8)
+        self._last_donation = np.full(capacity, np.nan)
+        self._accepted = np.zeros(capacity, dtype=np.float32)
+        self._notified = np.zeros(capacity, dtype=np.float32)
+        self._available = np.zeros(capacity, dtype=bool)
+        self._active = np.zeros(capacity, dtype=bool)
+
+    def _grow(self):
+        columns = (
+            '_lat', '_lon', '_cos_lat', '_group', '_last_donation', '_accepted', '_notified', '_available', '_active'
+        )
+        old = {name: getattr(self, name) for name in columns}
+        self._allocate(self.capacity * 2)
+        for name, values in old.items():
+            getattr(self, name)[:len(values)] = values
+
+    def upsert(self, user_id, data):
+        """Add or refresh a donor from its users document data"""
+        coordinates = parse_coordinates((data or {}).get('location'))
+        with self._lock:
+            if coordinates is None:
+                self._remove_locked(user_id)
+            else:
+                row = self._rows.get(user_id)
+                if row is None:
+                    row = self._claim_row(user_id)
+                lat, lon = np.radians(coordinates)
+                code = blood_group_code(data.get('bloodGroup'))
+                donated_at = parse_donation_time(data.get('lastDonation'))
+                accepted, notified = self._history.get(user_id, (0, 0))
+                self._lat[row] = lat
+                self._lon[row] = lon
+                self._cos_lat[row] = np.cos(lat)
+                self._group[row] = UNKNOWN_GROUP_CODE if code is None else code
+                self._last_donation[row] = np.nan if donated_at is None else donated_at
+                self._accepted[row] = accepted
+                self._notified[row] = notified
+                self._tokens[row] = data.get('fcmToken')
+                self._available[row] = data.get('isAvailable', True) is not False
+                self._active[row] = bool(data.get('fcmToken')) and self._available[row]
+            self.last_update = time.time()
+
+    def _claim_row(self, user_id):
+        if self._free:
+            row = self._free.pop()
+            self._user_ids[row] = user_id
+        else:
+            if self._size == self.capacity:
+                self._grow()
+            row = self._size
+            self._size += 1
+            self._user_ids.append(user_id)
+            self._tokens.append(None)
+        self._rows[user_id] = row
+        return row
+
+    def remove(self, user_id):
+        """Drop a donor from the table"""
+        with self._lock:
+            self._remove_locked(user_id)
+            self.last_update = time.time()
+
+    def _remove_locked(self, user_id):
+        row = self._rows.pop(user_id, None)
+        if row is None:
+            return
+        self._active[row] = False
+        self._user_ids[row] = None
+        self._tokens[row] = None
+        self._free.append(row)
+
+    def export(self):
+        """Copy out every donor as (user_ids, tokens, columns), with coordinates in degrees"""
+        with self._lock:
+            user_ids = list(self._rows)
+            rows = np.fromiter(self._rows.values(), dtype=np.int64, count=len(user_ids))
+            tokens = [self._tokens[row] for row in rows.tolist()]
+            columns = {
+                'lat': np.degrees(self._lat[rows]),
+                'lon': np.degrees(self._lon[rows]),
+                'group': self._group[rows],
+                'last_donation': self._last_donation[rows],
+                'available': self._available[rows],
+            }
+        return user_ids, tokens, columns
+
+    def load(self, user_ids, tokens, columns):
+        """Replace every donor with ones exported earlier, keeping the accept history counted so far"""
+        count = len(user_ids)
+        has_token = np.fromiter((bool(token) for token in tokens), dtype=bool, count=count)
+        with self._lock:
+            capacity = INITIAL_CAPACITY
+            while capacity < count:
+                capacity *= 2
+            self._allocate(capacity)
+            self._lat[:count] = np.radians(columns['lat'])
+            self._lon[:count] = np.radians(columns['lon'])
+            self._cos_lat[:count] = np.cos(self._lat[:count])
+            self._group[:count] = columns['group']
+            self._last_donation[:count] = columns['last_donation']
+            self._available[:count] = columns['available']
+            self._active[:count] = self._available[:count] & has_token
+            self._user_ids = list(user_ids)
+            self._tokens = list(tokens)
+            self._rows = dict(zip(self._user_ids, range(count)))
+            self._free = []
+            self._size = count
+            for user_id, (accepted, notified) in self._history.items():
+                row = self._rows.get(user_id)
+                if row is not None:
+                    self._accepted[row] = accepted
+                    self._notified[row] = notified
+            self.last_update = time.time()
+
+    def apply_user(self, user_id, data):
+        """Update the table from a users document, or remove it when data is None"""
+        if data is None:
+            self.remove(user_id)
+        else:
+            self.upsert(user_id, data)
+
+    def apply_request(self, request_id, data):
+        """Count acceptances from a requests document, or forget it when data is None"""
+        donor_ids = request_donor_ids(data)
+        with self._lock:
+            previous = self._request_donors.pop(request_id, set())
+            if donor_ids:
+                self._request_donors[request_id] = donor_ids
+            for user_id in donor_ids - previous:
+                self._add_history(user_id, 1, 0)
+            for user_id in previous - donor_ids:
+                self._add_history(user_id, -1, 0)
+
+    def record_notified(self, user_ids):
+        """Count a blood request push to each of user_ids"""
+        with self._lock:
+            for user_id in user_ids:
+                self._add_history(user_id, 0, 1)
+
+    def restore_notified(self, counts):
+        """Add notified counts kept by an earlier process, a dict of userId -> pushes"""
+        with self._lock:
+            for user_id, notified in counts.items():
+                self._add_history(user_id, 0, notified)
+
+    def _add_history(self, user_id, accepted, notified):
+        total_accepted, total_notified = self._history.get(user_id, (0, 0))
+        total_accepted += accepted
+        total_notified += notified
+        self._history[user_id] = (total_accepted, total_notified)
+        row = self._rows.get(user_id)
+        if row is not None:
+            self._accepted[row] = total_accepted
+            self._notified[row] = total_notified
+
+    def match(self, lat, lon, radius_km, recipient_group, limit, now=None, exclude=None, exact_group=False):
+        """Return up to limit DonorMatch tuples for a request, best score first
+
+        Candidates are available donors with a token whose group can give to
+        recipient_group, who are outside the donation interval and within
+        radius_km. Closeness and the smoothed accept rate make up the score.
+        exact_group limits candidates to recipient_group itself.
+        """
+        recipient = blood_group_code(recipient_group)
+        if recipient is None or limit <= 0:
+            return []
+        now = time.time() if now is None else now
+        lat0, lon0 = np.radians((lat, lon))
+        donated_before = now - DONATION_INTERVAL_DAYS * 86400
+        with self._lock:
+            n = self._size
+            lat_column = self._lat[:n]
+            # Cheap filters first: availability, compatibility, eligibility and a latitude band
+            candidates = self._active[:n] & _accepting_groups(recipient, exact_group)[self._group[:n]]
+            candidates &= ~(self._last_donation[:n] > donated_before)
+            candidates &= np.abs(lat_column - lat0) <= radius_km / EARTH_RADIUS_KM
+            rows = np.flatnonzero(candidates)
+
+            # Haversine distance over the remaining rows
+            a = (np.sin((lat_column[rows] - lat0) / 2) ** 2
+                 + np.cos(lat0) * self._cos_lat[rows] * np.sin((self._lon[rows] - lon0) / 2) ** 2)
+            distance = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+            inside = distance <= radius_km
+            rows = rows[inside]
+            distance = distance[inside]
+
+            accept_rate = np.minimum(
+                (self._accepted[rows] + PRIOR_ACCEPTS) / (self._notified[rows] + PRIOR_REQUESTS), 1.0
+            )
+            score = DISTANCE_WEIGHT * (1.0 - distance / radius_km) + RESPONSIVENESS_WEIGHT * accept_rate
+
+            if exclude:
+                keep = np.array([self._user_ids[row] not in exclude for row in rows], dtype=bool)
+                rows, distance, accept_rate, score = rows[keep], distance[keep], accept_rate[keep], score[keep]
+            if len(rows) > limit:
+                top = np.argpartition(-score, limit - 1)[:limit]
+            else:
+                top = np.arange(len(rows))
+            top = top[np.argsort(-score[top], kind='stable')]
+            return [
+                DonorMatch(self._user_ids[rows[i]], self._tokens[rows[i]], float(distance[i]),
+                           float(accept_rate[i]), float(score[i]))
+                for i in top
+            ]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self.ready,
+                'donors': len(self._rows),
+                'active': int(self._active[:self._size].sum()),
+                'capacity': self.capacity,
+                'memoryBytes': sum(column.nbytes for column in (
+                    self._lat, self._lon, self._cos_lat, self._group, self._last_donation,
+                    self._accepted, self._notified, self._available, self._active
+                )),
+                'trackedRequests': len(self._request_donors),
+                'lastUpdate': self.last_update,
+            }
+
+
+class NotifiedCounts:
+    """SQLite table of blood request pushes per donor, so accept rates survive a restart
+
+    Accept counts are rebuilt from the requests collection on every start,
+    but pushes are only seen as they are sent; without this table a restarted
+    process would rate every donor against no pushes at all.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS donor_notified (user_id TEXT PRIMARY KEY, count INTEGER NOT NULL)'
+            )
+
+    def add(self, user_ids):
+        """Count one push to each of user_ids"""
+        counts = Counter(user_ids)
+        if not counts:
+            return
+        with self._lock:
+            self._conn.executemany(
+                'INSERT INTO donor_notified (user_id, count) VALUES (?, ?) '
+                'ON CONFLICT (user_id) DO UPDATE SET count = count + excluded.count',
+                list(counts.items())
+            )
+
+    def load(self):
+        """Every donor's push count, as a dict of userId -> count"""
+        with self._lock:
+            return dict(self._conn.execute('SELECT user_id, count FROM donor_notified').fetchall())
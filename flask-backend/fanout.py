@@ -0,0 +1,97 @@
+import contextvars
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from firebase_admin import exceptions, messaging as fcm
+
+# FCM rejects multicast messages with more than 500 tokens
+FCM_MULTICAST_LIMIT = 500
+# Upper bound on concurrent send_each_for_multicast calls for one fan-out
+FANOUT_MAX_WORKERS = 8
+
+# Errors worth retrying: the service was unavailable or throttled, not the request invalid
+TRANSIENT_FCM_ERRORS = (
+    exceptions.UnavailableError,
+    exceptions.InternalError,
+    exceptions.DeadlineExceededError,
+    exceptions.ResourceExhaustedError,
+    exceptions.UnknownError,
+    fcm.QuotaExceededError,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def is_transient_error(error):
+    """Check whether an FCM or network error is worth retrying"""
+    return isinstance(error, TRANSIENT_FCM_ERRORS)
+
+
+def backoff_delay(attempt, base_delay=0.5, max_delay=30.0):
+    """Exponential backoff with jitter for the given 1-based retry attempt"""
+    delay = min(max_delay, base_delay * (2 ** (attempt - 1)))
+    return delay + random.uniform(0, delay * 0.1)
+
+
+def map_in_context(pool, fn, items):
+    """pool.map(fn, items), with each call run in a copy of the caller's context so its request deadline applies"""
+    futures = [pool.submit(contextvars.copy_context().run, fn, item) for item in items]
+    return [future.result() for future in futures]
+
+
+def _send_batch(messaging, tokens, notification, data, retries=0, dry_run=False):
+    """Send one multicast batch; a failed call marks every token in it as failed"""
+    message = messaging.MulticastMessage(
+        notification=notification,
+        data=data,
+        tokens=tokens,
+    )
+    # Only pass dry_run when set, so plain senders need not accept it
+    options = {'dry_run': True} if dry_run else {}
+    attempt = 0
+    while True:
+        try:
+            return messaging.send_each_for_multicast(message, **options).responses
+        except Exception as e:
+            if attempt < retries and is_transient_error(e):
+                attempt += 1
+                time.sleep(backoff_delay(attempt))
+                continue
+            print(f"Multicast batch of {len(tokens)} tokens failed: {e}")
+            return [messaging.SendResponse(None, e) for _ in tokens]
+
+
+def send_multicast_batched(messaging, tokens, notification, data=None,
+                           batch_size=FCM_MULTICAST_LIMIT, max_workers=FANOUT_MAX_WORKERS,
+                           retries=0, on_batch=None, dry_run=False):
+    """Send a multicast notification to any number of tokens
+
+    Tokens are split into batches of at most batch_size and sent in
+    parallel. The merged BatchResponse keeps responses in the same
+    order as tokens, so responses[i] always belongs to tokens[i].
+    A batch call failing with a transient error is retried up to
+    retries times; on_batch(index, total, responses) is called as
+    each batch finishes. With dry_run FCM validates the tokens without
+    delivering anything.
+    """
+    batch_size = min(batch_size, FCM_MULTICAST_LIMIT)
+    batches = [tokens[i:i + batch_size] for i in range(0, len(tokens), batch_size)]
+
+    def send(indexed_batch):
+        index, batch = indexed_batch
+        responses = _send_batch(messaging, batch, notification, data, retries, dry_run)
+        if on_batch is not None:
+            on_batch(index, len(batches), responses)
+        return responses
+
+    if len(batches) <= 1:
+        results = [send(item) for item in enumerate(batches)]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as pool:
+            results = map_in_context(pool, send, enumerate(batches))
+
+    responses = []
+    for batch_responses in results:
+        responses.extend(batch_responses)
+    return messaging.BatchResponse(responses)
@@ -0,0 +1,144 @@
+import math
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE_LAT = 111.32
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points in kilometres"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def encode_geohash(lat, lon, precision):
+    """Encode a coordinate as a geohash string of the given length"""
+    lat_lo, lat_hi = -90.0, 90.0
+    lon_lo, lon_hi = -180.0, 180.0
+    chars = []
+    value = 0
+    bits = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lon_lo + lon_hi) / 2
+            if lon >= mid:
+                value = value * 2 + 1
+                lon_lo = mid
+            else:
+                value *= 2
+                lon_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                value = value * 2 + 1
+                lat_lo = mid
+            else:
+                value *= 2
+                lat_hi = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[value])
+            value = 0
+            bits = 0
+    return ''.join(chars)
+
+
+def encode_geohash_array(lat, lon, precision):
+    """Encode arrays of coordinates as an array of geohash byte strings, bisecting like encode_geohash"""
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    lat_lo, lat_hi = np.full(lat.shape, -90.0), np.full(lat.shape, 90.0)
+    lon_lo, lon_hi = np.full(lon.shape, -180.0), np.full(lon.shape, 180.0)
+    alphabet = np.frombuffer(_BASE32.encode(), dtype=np.uint8)
+    chars = np.zeros(lat.shape + (precision,), dtype=np.uint8)
+    even = True
+    for position in range(precision):
+        value = np.zeros(lat.shape, dtype=np.uint8)
+        for _ in range(5):
+            if even:
+                mid = (lon_lo + lon_hi) / 2
+                bit = lon >= mid
+                lon_lo = np.where(bit, mid, lon_lo)
+                lon_hi = np.where(bit, lon_hi, mid)
+            else:
+                mid = (lat_lo + lat_hi) / 2
+                bit = lat >= mid
+                lat_lo = np.where(bit, mid, lat_lo)
+                lat_hi = np.where(bit, lat_hi, mid)
+            value = value * 2 + bit
+            even = not even
+        chars[..., position] = alphabet[value]
+    return chars.view(f'S{precision}').reshape(lat.shape)
+
+
+def geohash_cell_size(precision):
+    """Return (lat_degrees, lon_degrees) covered by one geohash cell"""
+    total_bits = 5 * precision
+    lon_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def _radius_degrees(lat, radius_km):
+    dlat = radius_km / KM_PER_DEGREE_LAT
+    dlon = radius_km / (KM_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 0.01))
+    return dlat, dlon
+
+
+def estimate_cell_count(lat, radius_km, precision):
+    """Rough number of geohash cells covering a circle, used to pick a precision"""
+    dlat, dlon = _radius_degrees(lat, radius_km)
+    cell_lat, cell_lon = geohash_cell_size(precision)
+    lon_cells = min(2 * dlon / cell_lon + 2, 360.0 / cell_lon)
+    return (2 * dlat / cell_lat + 2) * lon_cells
+
+
+def geohash_cells_covering(lat, lon, radius_km, precision):
+    """Return the set of geohash cells overlapping the bounding box of a circle"""
+    dlat, dlon = _radius_degrees(lat, radius_km)
+    cell_lat, cell_lon = geohash_cell_size(precision)
+    lat_cells = int(round(180.0 / cell_lat))
+    lon_cells = int(round(360.0 / cell_lon))
+
+    lat_start = max(0, int(math.floor((lat - dlat + 90.0) / cell_lat)))
+    lat_end = min(lat_cells - 1, int(math.floor((lat + dlat + 90.0) / cell_lat)))
+    if 2 * dlon >= 360.0:
+        lon_indexes = range(lon_cells)
+    else:
+        lon_start = int(math.floor((lon - dlon + 180.0) / cell_lon))
+        lon_end = int(math.floor((lon + dlon + 180.0) / cell_lon))
+        lon_indexes = sorted({j % lon_cells for j in range(lon_start, lon_end + 1)})
+
+    cells = set()
+    for i in range(lat_start, lat_end + 1):
+        center_lat = -90.0 + (i + 0.5) * cell_lat
+        for j in lon_indexes:
+            center_lon = -180.0 + (j + 0.5) * cell_lon
+            cells.add(encode_geohash(center_lat, center_lon, precision))
+    return cells
+
+
+def parse_coordinates(value):
+    """Return (lat, lon) from a {latitude, longitude} mapping, or None if invalid"""
+    if not isinstance(value, dict):
+        return None
+    try:
+        lat = float(value.get('latitude'))
+        lon = float(value.get('longitude'))
+    except (TypeError, ValueError):
+        return None
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+        return None
+    # RegisterScreen falls back to 0,0 when location permission is denied
+    if lat == 0.0 and lon == 0.0:
+        return None
+    return lat, lon
@@ -0,0 +1,18 @@
+# Production launcher for the asyncio serving mode:
+#   gunicorn -c gunicorn.conf.py asgi:application
+import os
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', 5000)}"
+worker_class = 'uvicorn.workers.UvicornWorker'
+# One worker holds thousands of connections on its event loop. Each worker also runs its own job
+# workers, Firestore listeners, wave scheduler, request coalescer, push rate limiter and token cache,
+# so more than one duplicates them; only raise this with that in mind
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+keepalive = int(os.environ.get('KEEP_ALIVE', 5))
+backlog = int(os.environ.get('BACKLOG', 2048))
+timeout = int(os.environ.get('WORKER_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+# Recycle workers periodically to bound memory growth of the in-process caches
+max_requests = int(os.environ.get('MAX_REQUESTS', 100000))
+max_requests_jitter = int(os.environ.get('MAX_REQUESTS_JITTER', 10000))
+accesslog = '-'
@@ -0,0 +1,317 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+from fanout import backoff_delay, is_transient_error
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    progress TEXT,
+    result TEXT,
+    http_status INTEGER,
+    error TEXT,
+    run_after REAL NOT NULL,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, run_after);
+"""
+
+
+class JobStore:
+    """SQLite-backed job table; claims use a lease so crashed jobs are picked up again
+
+    Workers renew the leases of the jobs they are running, so only a job
+    whose process died is reclaimed; one that has used all its attempts
+    is failed instead.
+    """
+
+    def __init__(self, path, lease_seconds=300):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(_SCHEMA)
+
+    def insert(self, kind, payload, max_attempts):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO jobs (id, kind, payload, status, max_attempts, run_after, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, kind, json.dumps(payload), QUEUED, max_attempts, now, now, now)
+            )
+        return job_id
+
+    def claim(self):
+        """Atomically take the next runnable job, or return None"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute(
+                    'UPDATE jobs SET status = ?, error = ?, lease_until = NULL, updated_at = ? '
+                    'WHERE status = ? AND lease_until < ? AND attempts >= max_attempts',
+                    (FAILED, 'Worker stopped while running the last attempt', now, RUNNING, now)
+                )
+                row = self._conn.execute(
+                    'SELECT * FROM jobs WHERE (status = ? AND run_after <= ?) OR (status = ? AND lease_until < ?) '
+                    'ORDER BY run_after, created_at LIMIT 1',
+                    (QUEUED, now, RUNNING, now)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        'UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, updated_at = ? WHERE id = ?',
+                        (RUNNING, now + self.lease_seconds, now, row['id'])
+                    )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        job = dict(row)
+        job['attempts'] += 1
+        return job
+
+    def renew(self, job_ids):
+        """Extend the leases of running jobs so they are not reclaimed while still being worked on"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                'UPDATE jobs SET lease_until = ? WHERE id = ? AND status = ?',
+                [(now + self.lease_seconds, job_id, RUNNING) for job_id in job_ids]
+            )
+
+    def next_run_after(self):
+        """Earliest time a queued job becomes runnable, or None"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT MIN(run_after) FROM jobs WHERE status = ?', (QUEUED,)
+            ).fetchone()
+        return row[0]
+
+    def update_progress(self, job_id, progress):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'UPDATE jobs SET progress = ?, lease_until = ?, updated_at = ? WHERE id = ?',
+                (json.dumps(progress), now + self.lease_seconds, now, job_id)
+            )
+
+    def finish(self, job_id, status, result=None, http_status=None, error=None):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE jobs SET status = ?, result = ?, http_status = ?, error = ?, lease_until = NULL, '
+                'updated_at = ? WHERE id = ?',
+                (status, json.dumps(result) if result is not None else None, http_status, error, time.time(), job_id)
+            )
+
+    def retry_later(self, job_id, run_after, error):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE jobs SET status = ?, run_after = ?, error = ?, lease_until = NULL, updated_at = ? WHERE id = ?',
+                (QUEUED, run_after, error, time.time(), job_id)
+            )
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def counts(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
+
+    def prune(self, older_than_seconds):
+        """Delete finished jobs last updated more than older_than_seconds ago"""
+        cutoff = time.time() - older_than_seconds
+        with self._lock:
+            cursor = self._conn.execute(
+                'DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?', (SUCCEEDED, FAILED, cutoff)
+            )
+        return cursor.rowcount
+
+
+class JobProgress:
+    """Progress reporter handed to job handlers"""
+
+    def __init__(self, store, job_id):
+        self._store = store
+        self._job_id = job_id
+        self._lock = threading.Lock()
+        self.data = {}
+
+    def update(self, **fields):
+        with self._lock:
+            self.data.update(fields)
+            self._store.update_progress(self._job_id, self.data)
+
+    def increment(self, **deltas):
+        with self._lock:
+            for key, delta in deltas.items():
+                self.data[key] = self.data.get(key, 0) + delta
+            self._store.update_progress(self._job_id, self.data)
+
+
+class JobQueue:
+    """Pool of worker threads executing persisted jobs with retries on transient errors
+
+    Handlers are registered per job kind and called as handler(payload, progress);
+    they return (result, http_status). Transient errors are retried with
+    exponential backoff until max_attempts is reached.
+    """
+
+    def __init__(self, store, workers=4, max_attempts=5, base_delay=1.0, max_delay=60.0, poll_interval=1.0):
+        self.store = store
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self._handlers = {}
+        self._threads = []
+        self._wakeup = threading.Condition()
+        self._stopping = False
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def register(self, kind, handler):
+        self._handlers[kind] = handler
+
+    def handler(self, kind):
+        return self._handlers[kind]
+
+    def submit(self, kind, payload, max_attempts=None):
+        """Persist a job and wake a worker; returns the job id"""
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind {kind}")
+        job_id = self.store.insert(kind, payload, max_attempts or self.max_attempts)
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=10.0):
+        """Stop taking new jobs; running jobs finish or are reclaimed after a restart"""
+        self._stopping = True
+        self._stopped.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def status(self, job_id):
+        """Return the public view of a job, or None if unknown"""
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        return {
+            'jobId': job['id'],
+            'kind': job['kind'],
+            'status': job['status'],
+            'attempts': job['attempts'],
+            'maxAttempts': job['max_attempts'],
+            'progress': json.loads(job['progress']) if job['progress'] else {},
+            'result': json.loads(job['result']) if job['result'] else None,
+            'httpStatus': job['http_status'],
+            'error': job['error'],
+            'createdAt': job['created_at'],
+            'updatedAt': job['updated_at'],
+            'nextAttemptAt': job['run_after'] if job['status'] == QUEUED else None,
+        }
+
+    def stats(self):
+        return {'workers': self.workers, 'jobs': self.store.counts()}
+
+    def _wait_for_work(self):
+        next_run = self.store.next_run_after()
+        timeout = self.poll_interval
+        if next_run is not None:
+            timeout = min(timeout, max(0.0, next_run - time.time()))
+        with self._wakeup:
+            if not self._stopping:
+                self._wakeup.wait(timeout)
+
+    def _heartbeat(self):
+        # Renew leases well before they run out, so a slow handler keeps its job
+        interval = self.store.lease_seconds / 3
+        while not self._stopped.wait(interval):
+            with self._running_lock:
+                job_ids = list(self._running)
+            if job_ids:
+                try:
+                    self.store.renew(job_ids)
+                except Exception as e:
+                    print(f"Error renewing job leases: {e}")
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                job = self.store.claim()
+            except Exception as e:
+                print(f"Error claiming job: {e}")
+                job = None
+            if job is None:
+                self._wait_for_work()
+                continue
+            with self._running_lock:
+                self._running.add(job['id'])
+            try:
+                self._execute(job)
+            finally:
+                with self._running_lock:
+                    self._running.discard(job['id'])
+
+    def _execute(self, job):
+        handler = self._handlers.get(job['kind'])
+        if handler is None:
+            self.store.finish(job['id'], FAILED, error=f"No handler for job kind {job['kind']}")
+            return
+        progress = JobProgress(self.store, job['id'])
+        try:
+            result, http_status = handler(json.loads(job['payload']), progress)
+        except Exception as e:
+            if is_transient_error(e) and job['attempts'] < job['max_attempts']:
+                delay = backoff_delay(job['attempts'], self.base_delay, self.max_delay)
+                # A dependency failing calls fast says how long it needs
+                delay = max(delay, getattr(e, 'retry_after', 0) or 0)
+                print(f"Job {job['id']} attempt {job['attempts']} failed, retrying in {delay:.1f}s: {e}")
+                self.store.retry_later(job['id'], time.time() + delay, str(e))
+            else:
+                print(f"Job {job['id']} failed: {e}")
+                self.store.finish(job['id'], FAILED, error=str(e))
+            return
+        status = SUCCEEDED if http_status < 400 else FAILED
+        error = result.get('error') if isinstance(result, dict) else None
+        self.store.finish(job['id'], status, result=result, http_status=http_status, error=error)
@@ -0,0 +1,614 @@
+import copy
+import itertools
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter, namedtuple
+from datetime import timezone
+
+from firebase_admin import exceptions, firestore, messaging as fcm
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from google.api_core.exceptions import DeadlineExceeded, FailedPrecondition, NotFound, ServiceUnavailable
+from google.cloud.firestore_v1.bulk_writer import (BulkWriteFailure, BulkWriterCreateOperation,
+                                                   BulkWriterDeleteOperation, BulkWriterSetOperation,
+                                                   BulkWriterUpdateOperation)
+from google.cloud.firestore_v1.watch import ChangeType
+
+from fanout import FCM_MULTICAST_LIMIT
+from notification_log import MAX_BATCH_WRITES
+from topics import FCM_TOPIC_BATCH_LIMIT
+
+DocumentChange = namedtuple('DocumentChange', ['type', 'document'])
+WriteResult = namedtuple('WriteResult', ['update_time'])
+
+# BulkWriter sends writes in non-atomic batches of this many
+BULK_WRITER_BATCH_SIZE = 20
+# gRPC status codes a failed bulk write reports
+_NOT_FOUND = 5
+_ALREADY_EXISTS = 6
+_INTERNAL = 13
+
+
+def _resolve_sentinels(data, now):
+    resolved = {}
+    for key, value in data.items():
+        if value is firestore.DELETE_FIELD:
+            resolved[key] = firestore.DELETE_FIELD
+        elif value is firestore.SERVER_TIMESTAMP:
+            resolved[key] = now
+        elif isinstance(value, dict):
+            resolved[key] = _resolve_sentinels(value, now)
+        else:
+            resolved[key] = copy.deepcopy(value)
+    return resolved
+
+
+def _merge(target, data):
+    for key, value in data.items():
+        if value is firestore.DELETE_FIELD:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+
+
+class _Stats:
+    """Thread-safe per-operation call counter"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = Counter()
+
+    def record(self, op, count=1):
+        with self._lock:
+            self._calls[op] += count
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._calls)
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+
+
+class LocalDocumentSnapshot:
+    def __init__(self, reference, data, update_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.update_time = update_time
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return copy.deepcopy(self._data.get(field)) if self._data is not None else None
+
+
+class LocalDocumentReference:
+    def __init__(self, client, collection, doc_id):
+        self._client = client
+        self.collection = collection
+        self.id = doc_id
+
+    @property
+    def path(self):
+        return f"{self.collection}/{self.id}"
+
+    def get(self, field_paths=None, timeout=None):
+        self._client._rpc('get', timeout)
+        return self._client._snapshot(self, field_paths)
+
+    def set(self, data, merge=False, timeout=None):
+        self._client._rpc('set', timeout)
+        self._client._apply([('set', self, data, merge)])
+
+    def update(self, data, timeout=None):
+        self._client._rpc('update', timeout)
+        self._client._apply([('update', self, data, False)])
+
+    def delete(self, timeout=None):
+        self._client._rpc('delete', timeout)
+        self._client._apply([('delete', self, None, False)])
+
+
+class LocalQuery:
+    """Immutable query over one collection supporting the filters and cursors the routes use"""
+
+    _OPERATORS = {
+        '==': lambda a, b: a == b,
+        '!=': lambda a, b: a != b,
+        '<': lambda a, b: a < b,
+        '<=': lambda a, b: a <= b,
+        '>': lambda a, b: a > b,
+        '>=': lambda a, b: a >= b,
+        'in': lambda a, b: a in b,
+        'array_contains': lambda a, b: isinstance(a, list) and b in a,
+    }
+
+    def __init__(self, client, collection, filters=(), orders=(), limit_count=None, start=None, fields=None):
+        self._client = client
+        self._collection = collection
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit_count
+        self._start = start
+        self._fields = fields
+
+    def _copy(self, **changes):
+        state = {
+            'filters': self._filters, 'orders': self._orders, 'limit_count': self._limit,
+            'start': self._start, 'fields': self._fields,
+        }
+        state.update(changes)
+        return LocalQuery(self._client, self._collection, **state)
+
+    def where(self, field, op, value):
+        if op not in self._OPERATORS:
+            raise ValueError(f"Unsupported operator {op}")
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def order_by(self, field, direction=firestore.Query.ASCENDING):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def limit(self, count):
+        return self._copy(limit_count=count)
+
+    def start_after(self, values):
+        if isinstance(values, LocalDocumentSnapshot):
+            values = dict(values.to_dict(), __name__=values.id)
+        return self._copy(start=values)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def _value(self, doc_id, data, field):
+        return doc_id if field == '__name__' else data.get(field)
+
+    def _after_start(self, doc_id, data):
+        for field, direction in self._orders:
+            value = self._value(doc_id, data, field)
+            start = self._start.get(field)
+            if value == start:
+                continue
+            return value < start if direction == firestore.Query.DESCENDING else value > start
+        return False
+
+    def stream(self, timeout=None):
+        self._client._rpc('query', timeout)
+        matches = [
+            (doc_id, data) for doc_id, data in self._client._documents(self._collection, copy_data=False)
+            if all(field in data and self._OPERATORS[op](data[field], value) for field, op, value in self._filters)
+            and all(field == '__name__' or field in data for field, _ in self._orders)
+        ]
+        for field, direction in reversed(self._orders):
+            matches.sort(key=lambda item: self._value(item[0], item[1], field),
+                         reverse=direction == firestore.Query.DESCENDING)
+        if self._start is not None:
+            matches = [item for item in matches if self._after_start(*item)]
+        if self._limit is not None:
+            matches = matches[:self._limit]
+        for doc_id, data in matches:
+            reference = LocalDocumentReference(self._client, self._collection, doc_id)
+            if self._fields is not None:
+                data = {field: data[field] for field in self._fields if field in data}
+            yield LocalDocumentSnapshot(reference, copy.deepcopy(data))
+
+    def get(self, timeout=None):
+        return list(self.stream(timeout))
+
+
+class LocalCollectionReference(LocalQuery):
+    def __init__(self, client, name):
+        super().__init__(client, name)
+        self.id = name
+
+    def document(self, doc_id=None):
+        return LocalDocumentReference(self._client, self.id, doc_id or uuid.uuid4().hex[:20])
+
+    def add(self, data, document_id=None, timeout=None):
+        reference = self.document(document_id)
+        reference.set(data, timeout=timeout)
+        return DatetimeWithNanoseconds.now(timezone.utc), reference
+
+    def on_snapshot(self, callback):
+        return self._client._listen(self.id, callback)
+
+
+class LocalWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+        # Update time each document must still have, from last_update_time write options
+        self._preconditions = {}
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(('set', reference, data, merge))
+
+    def update(self, reference, data, option=None):
+        if option is not None:
+            self._preconditions[(reference.collection, reference.id)] = option._last_update_time
+        self._writes.append(('update', reference, data, False))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference, None, False))
+
+    def commit(self, timeout=None):
+        if len(self._writes) > MAX_BATCH_WRITES:
+            raise ValueError(f"A write batch can contain at most {MAX_BATCH_WRITES} writes")
+        self._client._rpc('commit', timeout)
+        self._client._apply(self._writes, self._preconditions)
+        self._writes = []
+        self._preconditions = {}
+
+
+class LocalBulkWriter:
+    """BulkWriter stand-in: writes queue until flush() and are applied one by one, BULK_WRITER_BATCH_SIZE per commit
+
+    Each write succeeds or fails on its own. Failures go to the
+    on_write_error callback, which returns True to retry the write, as with
+    the real BulkWriter; by default a write is tried 15 times.
+    """
+
+    def __init__(self, client, options=None):
+        self._client = client
+        self.options = options
+        self._operations = []
+        self._closed = False
+        self._on_result = lambda reference, result, writer: None
+        self._on_error = lambda failure, writer: failure.attempts < 15
+
+    def on_write_result(self, callback):
+        self._on_result = callback
+
+    def on_write_error(self, callback):
+        self._on_error = callback
+
+    def set(self, reference, document_data, merge=False, attempts=0):
+        self._enqueue(BulkWriterSetOperation(reference, document_data, merge, attempts))
+
+    def create(self, reference, document_data, attempts=0):
+        self._enqueue(BulkWriterCreateOperation(reference, document_data, attempts))
+
+    def update(self, reference, field_updates, option=None, attempts=0):
+        self._enqueue(BulkWriterUpdateOperation(reference, field_updates, option, attempts))
+
+    def delete(self, reference, option=None, attempts=0):
+        self._enqueue(BulkWriterDeleteOperation(reference, option, attempts))
+
+    def flush(self):
+        while self._operations:
+            batch, self._operations = (self._operations[:BULK_WRITER_BATCH_SIZE],
+                                       self._operations[BULK_WRITER_BATCH_SIZE:])
+            self._client._rpc('bulk_commit')
+            for operation in batch:
+                self._write(operation)
+
+    def close(self):
+        self.flush()
+        self._closed = True
+
+    def _enqueue(self, operation):
+        if self._closed:
+            raise Exception('BulkWriter is closed and cannot accept new operations')
+        self._operations.append(operation)
+
+    def _write(self, operation):
+        reference = operation.reference
+        while True:
+            operation.attempts += 1
+            if isinstance(operation, BulkWriterCreateOperation) and self._client._snapshot(reference).exists:
+                code, message = _ALREADY_EXISTS, f"Document already exists: {reference.path}"
+            else:
+                try:
+                    if isinstance(operation, BulkWriterDeleteOperation):
+                        self._client._apply([('delete', reference, None, False)])
+                    elif isinstance(operation, BulkWriterUpdateOperation):
+                        self._client._apply([('update', reference, operation.field_updates, False)])
+                    else:
+                        self._client._apply([('set', reference, operation.document_data,
+                                              getattr(operation, 'merge', False))])
+                except NotFound as e:
+                    code, message = _NOT_FOUND, str(e)
+                except Exception as e:
+                    code, message = _INTERNAL, str(e)
+                else:
+                    self._on_result(reference, WriteResult(self._client._snapshot(reference).update_time), self)
+                    return
+            if not self._on_error(BulkWriteFailure(operation, code, message), self):
+                return
+
+
+class _Watch:
+    def __init__(self, client, collection, callback):
+        self._client = client
+        self.collection = collection
+        self.callback = callback
+        self.is_active = True
+
+    def unsubscribe(self):
+        self.is_active = False
+        self._client._unlisten(self)
+
+    def close(self, reason=None):
+        """Stop delivering changes, as a listener whose stream failed does"""
+        self.unsubscribe()
+
+
+class LocalFirestore:
+    """In-memory stand-in for the Firestore client with per-RPC latency, injected faults and call counts
+
+    Every round trip (document get, get_all, query, write, batch commit,
+    listen) sleeps latency seconds and is counted in stats(). A call fails
+    with ServiceUnavailable with probability failure_rate, and one given a
+    timeout shorter than latency fails with DeadlineExceeded once the
+    timeout is up. latency and failure_rate may be changed while running.
+    Listeners get the initial snapshot and later changes on the writing
+    thread.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._collections = {}
+        # Last write time of every stored document, keyed by (collection, id)
+        self._update_times = {}
+        self._lock = threading.RLock()
+        self._watches = []
+        self._stats = _Stats()
+
+    def collection(self, name):
+        return LocalCollectionReference(self, name)
+
+    def batch(self):
+        return LocalWriteBatch(self)
+
+    def bulk_writer(self, options=None):
+        return LocalBulkWriter(self, options)
+
+    def get_all(self, references, field_paths=None, transaction=None, timeout=None):
+        self._rpc('get_all', timeout)
+        for reference in list(references):
+            yield self._snapshot(reference, field_paths)
+
+    def seed(self, collection, documents):
+        """Load {doc_id: data} without counting calls or notifying listeners"""
+        now = DatetimeWithNanoseconds.now(timezone.utc)
+        with self._lock:
+            store = self._collections.setdefault(collection, {})
+            for doc_id, data in documents.items():
+                store[doc_id] = copy.deepcopy(data)
+                self._update_times[(collection, doc_id)] = now
+
+    def stats(self):
+        with self._lock:
+            documents = {name: len(docs) for name, docs in self._collections.items()}
+        counts = self._stats.snapshot()
+        return {
+            'calls': {op: count for op, count in counts.items() if op not in ('failures', 'timeouts')},
+            'failures': counts.get('failures', 0),
+            'timeouts': counts.get('timeouts', 0),
+            'documents': documents,
+        }
+
+    def reset_stats(self):
+        self._stats.reset()
+
+    def _rpc(self, op, timeout=None):
+        self._stats.record(op)
+        latency = self.latency
+        if timeout is not None and latency > timeout:
+            time.sleep(max(timeout, 0))
+            self._stats.record('timeouts')
+            raise DeadlineExceeded(f"Simulated Firestore {op} timed out after {timeout:.3f}s")
+        if latency > 0:
+            time.sleep(latency)
+        if self.failure_rate > 0:
+            with self._random_lock:
+                failed = self._random.random() < self.failure_rate
+            if failed:
+                self._stats.record('failures')
+                raise ServiceUnavailable(f"Simulated Firestore {op} failure")
+
+    def _documents(self, collection, copy_data=True):
+        # Stored documents are replaced on write, never mutated, so uncopied reads stay consistent
+        with self._lock:
+            documents = list(self._collections.get(collection, {}).items())
+        if copy_data:
+            documents = [(doc_id, copy.deepcopy(data)) for doc_id, data in documents]
+        return documents
+
+    def _snapshot(self, reference, field_paths=None):
+        with self._lock:
+            data = self._collections.get(reference.collection, {}).get(reference.id)
+            update_time = self._update_times.get((reference.collection, reference.id))
+            if data is not None:
+                data = copy.deepcopy(data)
+                if field_paths is not None:
+                    data = {field: data[field] for field in field_paths if field in data}
+        return LocalDocumentSnapshot(reference, data, update_time)
+
+    def _apply(self, writes, preconditions=None):
+        now = DatetimeWithNanoseconds.now(timezone.utc)
+        changes = []
+        with self._lock:
+            for kind, reference, data, merge in writes:
+                store = self._collections.setdefault(reference.collection, {})
+                existing = store.get(reference.id)
+                if kind == 'update' and existing is None:
+                    raise NotFound(f"No document to update: {reference.path}")
+                key = (reference.collection, reference.id)
+                if preconditions and key in preconditions and self._update_times.get(key) != preconditions[key]:
+                    raise FailedPrecondition(f"Document was updated after the given time: {reference.path}")
+            for kind, reference, data, merge in writes:
+                store = self._collections.setdefault(reference.collection, {})
+                existing = store.get(reference.id)
+                if kind == 'delete':
+                    if store.pop(reference.id, None) is not None:
+                        self._update_times.pop((reference.collection, reference.id), None)
+                        changes.append((reference, ChangeType.REMOVED, None))
+                    continue
+                resolved = _resolve_sentinels(data, now)
+                if existing is not None and (merge or kind == 'update'):
+                    updated = copy.deepcopy(existing)
+                    _merge(updated, resolved)
+                else:
+                    updated = {}
+                    _merge(updated, resolved)
+                store[reference.id] = updated
+                self._update_times[(reference.collection, reference.id)] = now
+                change_type = ChangeType.MODIFIED if existing is not None else ChangeType.ADDED
+                changes.append((reference, change_type, copy.deepcopy(updated)))
+            watches = list(self._watches)
+        for watch in watches:
+            watched = [
+                DocumentChange(change_type, LocalDocumentSnapshot(reference, data, now))
+                for reference, change_type, data in changes if reference.collection == watch.collection
+            ]
+            if watched:
+                watch.callback([change.document for change in watched], watched, now)
+
+    def _listen(self, collection, callback):
+        self._rpc('listen')
+        watch = _Watch(self, collection, callback)
+        with self._lock:
+            self._watches.append(watch)
+            documents = self._documents(collection)
+            update_times = [self._update_times.get((collection, doc_id)) for doc_id, _ in documents]
+        changes = [
+            DocumentChange(ChangeType.ADDED, LocalDocumentSnapshot(
+                LocalDocumentReference(self, collection, doc_id), data, update_time
+            ))
+            for (doc_id, data), update_time in zip(documents, update_times)
+        ]
+        callback([change.document for change in changes], changes, DatetimeWithNanoseconds.now(timezone.utc))
+        return watch
+
+    def _unlisten(self, watch):
+        with self._lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+
+
+class LocalMessaging:
+    """In-memory stand-in for firebase_admin.messaging with latency and a random failure rate
+
+    Message classes and error types come from the real module, so code
+    written against firebase_admin.messaging runs unchanged. Each API call
+    sleeps latency seconds; each token fails with UnavailableError with
+    probability failure_rate, and tokens in invalid_tokens always fail as
+    unregistered. While outage is set every call raises UnavailableError.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=None, invalid_tokens=(), outage=False):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.outage = outage
+        self.invalid_tokens = set(invalid_tokens)
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._stats = _Stats()
+
+    def __getattr__(self, name):
+        return getattr(fcm, name)
+
+    def send(self, message, dry_run=False, app=None):
+        self._rpc('send')
+        if message.token in self.invalid_tokens:
+            self._stats.record('failures')
+            raise fcm.UnregisteredError('Requested entity was not found.')
+        if self._fails():
+            self._stats.record('failures')
+            raise exceptions.UnavailableError('Simulated FCM failure')
+        if not dry_run:
+            self._stats.record('delivered')
+        return self._message_id()
+
+    def send_each_for_multicast(self, multicast_message, dry_run=False, app=None):
+        self._rpc('send_each_for_multicast')
+        if len(multicast_message.tokens) > FCM_MULTICAST_LIMIT:
+            raise ValueError(f"tokens must not contain more than {FCM_MULTICAST_LIMIT} tokens")
+        responses = []
+        for token in multicast_message.tokens:
+            if token in self.invalid_tokens:
+                responses.append(fcm.SendResponse(None, fcm.UnregisteredError('Requested entity was not found.')))
+            elif self._fails():
+                responses.append(fcm.SendResponse(None, exceptions.UnavailableError('Simulated FCM failure')))
+            else:
+                responses.append(fcm.SendResponse({'name': self._message_id()}, None))
+        failed = sum(1 for response in responses if not response.success)
+        # A dry run validates the tokens without delivering anything
+        if not dry_run:
+            self._stats.record('delivered', len(responses) - failed)
+        self._stats.record('failures', failed)
+        return fcm.BatchResponse(responses)
+
+    def subscribe_to_topic(self, tokens, topic, app=None):
+        return self._manage_topic('subscribe_to_topic', tokens)
+
+    def unsubscribe_from_topic(self, tokens, topic, app=None):
+        return self._manage_topic('unsubscribe_from_topic', tokens)
+
+    def stats(self):
+        counts = self._stats.snapshot()
+        return {
+            'calls': {op: count for op, count in counts.items() if op not in ('delivered', 'failures')},
+            'delivered': counts.get('delivered', 0),
+            'failures': counts.get('failures', 0),
+        }
+
+    def reset_stats(self):
+        self._stats.reset()
+
+    def _manage_topic(self, op, tokens):
+        self._rpc(op)
+        if isinstance(tokens, str):
+            tokens = [tokens]
+        if len(tokens) > FCM_TOPIC_BATCH_LIMIT:
+            raise ValueError(f"Tokens list must not have more than {FCM_TOPIC_BATCH_LIMIT} items")
+        results = [
+            {'error': 'NOT_FOUND'} if token in self.invalid_tokens else {'error': 'INTERNAL'} if self._fails() else {}
+            for token in tokens
+        ]
+        return fcm.TopicManagementResponse({'results': results})
+
+    def _rpc(self, op):
+        self._stats.record(op)
+        if self.latency > 0:
+            time.sleep(self.latency)
+        if self.outage:
+            self._stats.record('failures')
+            raise exceptions.UnavailableError('Simulated FCM outage')
+
+    def _fails(self):
+        if self.failure_rate <= 0:
+            return False
+        with self._random_lock:
+            return self._random.random() < self.failure_rate
+
+    def _message_id(self):
+        return f"projects/local/messages/{next(self._ids)}"
+
+
+def local_backend_from_env():
+    """Build (LocalFirestore, LocalMessaging) from the LOCAL_* environment variables"""
+    firestore_client = LocalFirestore(
+        latency=float(os.environ.get('LOCAL_FIRESTORE_LATENCY_MS', 0)) / 1000,
+        failure_rate=float(os.environ.get('LOCAL_FIRESTORE_FAILURE_RATE', 0)),
+    )
+    messaging_client = LocalMessaging(
+        latency=float(os.environ.get('LOCAL_FCM_LATENCY_MS', 0)) / 1000,
+        failure_rate=float(os.environ.get('LOCAL_FCM_FAILURE_RATE', 0)),
+    )
+    return firestore_client, messaging_client
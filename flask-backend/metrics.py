@@ -0,0 +1,449 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from firebase_admin import messaging as fcm
+from flask.json.provider import DefaultJSONProvider
+
+# Latency buckets in seconds, from a cached token lookup up to a large fan-out
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# FCM error codes for the messaging exceptions that do not carry them in .code
+FCM_ERROR_CODES = {
+    fcm.UnregisteredError: 'UNREGISTERED',
+    fcm.SenderIdMismatchError: 'SENDER_ID_MISMATCH',
+    fcm.QuotaExceededError: 'QUOTA_EXCEEDED',
+    fcm.ThirdPartyAuthError: 'THIRD_PARTY_AUTH_ERROR',
+}
+
+
+def fcm_error_code(error):
+    """FCM error code of a send exception, e.g. UNREGISTERED or UNAVAILABLE"""
+    for error_type, code in FCM_ERROR_CODES.items():
+        if isinstance(error, error_type):
+            return code
+    return getattr(error, 'code', None) or type(error).__name__
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        with self._lock:
+            return self._values.get(labelvalues, 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for labelvalues, value in values:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a bisect and three additions under a lock"""
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def summary(self, *labelvalues):
+        """Return (count, sum) for one label set"""
+        with self._lock:
+            series = self._series.get(labelvalues)
+            return (series[2], series[1]) if series else (0, 0.0)
+
+    def render(self):
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self._series.items())
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labelvalues, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, labelvalues, ('le', _format_value(float(bound))))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Gauge:
+    """Gauge whose samples are read from a callback at scrape time"""
+
+    def __init__(self, name, help_text, callback, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        try:
+            samples = self.callback()
+        except Exception as e:
+            print(f"Error reading gauge {self.name}: {e}")
+            return lines
+        if not isinstance(samples, dict):
+            samples = {(): samples}
+        for labelvalues, value in sorted(samples.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}')
+        return lines
+
+
+class Metrics:
+    """Request, backend call, FCM error and job metrics rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+        self.requests = self.histogram(
+            'http_request_duration_seconds', 'Request latency by route', ('method', 'route', 'status'))
+        self.backend_calls = self.histogram(
+            'backend_call_duration_seconds', 'Firestore, FCM and JSON call latency', ('backend', 'operation'))
+        self.backend_errors = self.counter(
+            'backend_call_errors_total', 'Firestore and FCM calls that raised', ('backend', 'operation'))
+        self.fcm_tokens = self.counter(
+            'fcm_tokens_total', 'Tokens sent to or managed through FCM by outcome', ('operation', 'outcome'))
+        self.fcm_errors = self.counter(
+            'fcm_errors_total', 'Per-token FCM errors by error code', ('operation', 'code'))
+        self.deduplicated = self.counter(
+            'requests_deduplicated_total', 'Send requests answered from an earlier send', ('kind', 'how'))
+        self.jobs = self.histogram(
+            'job_duration_seconds', 'Background job run time by kind', ('kind', 'status'))
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, callback, labelnames=()):
+        metric = Gauge(name, help_text, callback, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    @contextmanager
+    def span(self, backend, operation):
+        """Time a block as one backend call"""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.backend_errors.inc(backend, operation)
+            raise
+        finally:
+            self.backend_calls.observe(time.perf_counter() - started, backend, operation)
+
+    def traced_iter(self, backend, operation, iterator):
+        """Yield from a lazy backend iterator, timing only the time spent inside it"""
+        elapsed = 0.0
+        iterator = iter(iterator)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                except Exception:
+                    self.backend_errors.inc(backend, operation)
+                    raise
+                finally:
+                    elapsed += time.perf_counter() - started
+                yield item
+        finally:
+            self.backend_calls.observe(elapsed, backend, operation)
+
+    def record_fcm_error(self, operation, error):
+        self.fcm_errors.inc(operation, fcm_error_code(error))
+
+    def traced_job(self, kind, handler):
+        """Wrap a job handler so each run is timed by kind and outcome"""
+        def run(payload, progress):
+            started = time.perf_counter()
+            status = 'error'
+            try:
+                result, http_status = handler(payload, progress)
+                status = str(http_status)
+                return result, http_status
+            finally:
+                self.jobs.observe(time.perf_counter() - started, kind, status)
+        return run
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+_END = object()
+
+
+def _unwrap(reference):
+    return getattr(reference, '_wrapped', reference)
+
+
+class _Traced:
+    # Firestore calls take a timeout, so the time left before the request deadline is passed on
+    passes_timeout = True
+
+    def __init__(self, wrapped, metrics, guard=None):
+        self._wrapped = wrapped
+        self._metrics = metrics
+        self._guard = guard
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+
+    def _wrap(self, cls, wrapped):
+        return cls(wrapped, self._metrics, self._guard)
+
+    def _call(self, backend, operation, function, *args, **kwargs):
+        """Time one backend call, made through the dependency guard when there is one"""
+        if self._guard is None:
+            with self._metrics.span(backend, operation):
+                return function(*args, **kwargs)
+        with self._guard.call() as remaining:
+            if remaining is not None and self.passes_timeout:
+                kwargs.setdefault('timeout', remaining)
+            with self._metrics.span(backend, operation):
+                return function(*args, **kwargs)
+
+    def _iter(self, backend, operation, function, *args, **kwargs):
+        """Lazily time a streaming call; the guard covers it up to the first result
+
+        Callers often make other calls while they consume a stream, so it
+        must not keep its slot for that long.
+        """
+        if self._guard is None:
+            yield from self._metrics.traced_iter(backend, operation, function(*args, **kwargs))
+            return
+        with self._guard.call() as remaining:
+            if remaining is not None and self.passes_timeout:
+                kwargs.setdefault('timeout', remaining)
+            iterator = self._metrics.traced_iter(backend, operation, function(*args, **kwargs))
+            first = next(iterator, _END)
+        if first is _END:
+            return
+        yield first
+        yield from iterator
+
+
+class TracedQuery(_Traced):
+    """Query or collection reference whose stream/get/add calls are timed as Firestore calls"""
+
+    def where(self, *args, **kwargs):
+        return self._wrap(TracedQuery, self._wrapped.where(*args, **kwargs))
+
+    def order_by(self, *args, **kwargs):
+        return self._wrap(TracedQuery, self._wrapped.order_by(*args, **kwargs))
+
+    def limit(self, count):
+        return self._wrap(TracedQuery, self._wrapped.limit(count))
+
+    def start_after(self, values):
+        return self._wrap(TracedQuery, self._wrapped.start_after(_unwrap(values)))
+
+    def select(self, field_paths):
+        return self._wrap(TracedQuery, self._wrapped.select(field_paths))
+
+    def stream(self, *args, **kwargs):
+        return self._iter('firestore', 'query', self._wrapped.stream, *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        return list(self.stream(*args, **kwargs))
+
+    def document(self, *args):
+        return self._wrap(TracedDocument, self._wrapped.document(*args))
+
+    def add(self, *args, **kwargs):
+        return self._call('firestore', 'add', self._wrapped.add, *args, **kwargs)
+
+
+class TracedDocument(_Traced):
+    def get(self, *args, **kwargs):
+        return self._call('firestore', 'get', self._wrapped.get, *args, **kwargs)
+
+    def set(self, *args, **kwargs):
+        return self._call('firestore', 'set', self._wrapped.set, *args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        return self._call('firestore', 'update', self._wrapped.update, *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._call('firestore', 'delete', self._wrapped.delete, *args, **kwargs)
+
+
+class TracedBatch(_Traced):
+    def set(self, reference, *args, **kwargs):
+        return self._wrapped.set(_unwrap(reference), *args, **kwargs)
+
+    def update(self, reference, *args, **kwargs):
+        return self._wrapped.update(_unwrap(reference), *args, **kwargs)
+
+    def delete(self, reference, *args, **kwargs):
+        return self._wrapped.delete(_unwrap(reference), *args, **kwargs)
+
+    def commit(self, *args, **kwargs):
+        return self._call('firestore', 'commit', self._wrapped.commit, *args, **kwargs)
+
+
+class TracedBulkWriter(_Traced):
+    """BulkWriter taking traced references; flush and close, which wait for the writes, are timed
+
+    BulkWriter throttles and retries its own writes, so it is not put behind the guard.
+    """
+
+    def set(self, reference, *args, **kwargs):
+        return self._wrapped.set(_unwrap(reference), *args, **kwargs)
+
+    def create(self, reference, *args, **kwargs):
+        return self._wrapped.create(_unwrap(reference), *args, **kwargs)
+
+    def update(self, reference, *args, **kwargs):
+        return self._wrapped.update(_unwrap(reference), *args, **kwargs)
+
+    def delete(self, reference, *args, **kwargs):
+        return self._wrapped.delete(_unwrap(reference), *args, **kwargs)
+
+    def flush(self):
+        with self._metrics.span('firestore', 'bulk_flush'):
+            return self._wrapped.flush()
+
+    def close(self):
+        with self._metrics.span('firestore', 'bulk_flush'):
+            return self._wrapped.close()
+
+
+class TracedFirestore(_Traced):
+    """Firestore client wrapper timing every read, write and query as a backend span
+
+    With a guard (a resilience.Dependency) every call also goes through its
+    circuit breaker and concurrency limit and gets the request's deadline.
+    """
+
+    def collection(self, *args):
+        return self._wrap(TracedQuery, self._wrapped.collection(*args))
+
+    def batch(self):
+        return self._wrap(TracedBatch, self._wrapped.batch())
+
+    def bulk_writer(self, *args, **kwargs):
+        return self._wrap(TracedBulkWriter, self._wrapped.bulk_writer(*args, **kwargs))
+
+    def get_all(self, references, *args, **kwargs):
+        references = [_unwrap(reference) for reference in references]
+        return self._iter('firestore', 'get_all', self._wrapped.get_all, references, *args, **kwargs)
+
+
+def _token_operation(operation, args, kwargs):
+    # Dry runs only validate tokens, so they are counted apart from pushes that were sent
+    dry_run = kwargs.get('dry_run', args[0] if args else False)
+    return f"{operation}_dry_run" if dry_run else operation
+
+
+class TracedMessaging(_Traced):
+    """FCM messaging wrapper timing sends and topic calls and counting per-token error codes"""
+
+    # The Admin SDK's messaging calls take no per-call timeout
+    passes_timeout = False
+
+    def send(self, message, *args, **kwargs):
+        operation = _token_operation('send', args, kwargs)
+        try:
+            message_id = self._call('fcm', 'send', self._wrapped.send, message, *args, **kwargs)
+        except Exception as e:
+            self._metrics.fcm_tokens.inc(operation, 'failure')
+            self._metrics.record_fcm_error(operation, e)
+            raise
+        self._metrics.fcm_tokens.inc(operation, 'success')
+        return message_id
+
+    def send_each_for_multicast(self, multicast_message, *args, **kwargs):
+        operation = _token_operation('send_each_for_multicast', args, kwargs)
+        response = self._call('fcm', 'send_each_for_multicast', self._wrapped.send_each_for_multicast,
+                              multicast_message, *args, **kwargs)
+        self._metrics.fcm_tokens.inc(operation, 'success', amount=response.success_count)
+        self._metrics.fcm_tokens.inc(operation, 'failure', amount=response.failure_count)
+        for item in response.responses:
+            if item.exception is not None:
+                self._metrics.record_fcm_error(operation, item.exception)
+        return response
+
+    def subscribe_to_topic(self, tokens, topic, *args, **kwargs):
+        return self._manage_topic('subscribe_to_topic', tokens, topic, *args, **kwargs)
+
+    def unsubscribe_from_topic(self, tokens, topic, *args, **kwargs):
+        return self._manage_topic('unsubscribe_from_topic', tokens, topic, *args, **kwargs)
+
+    def _manage_topic(self, operation, tokens, topic, *args, **kwargs):
+        response = self._call('fcm', operation, getattr(self._wrapped, operation), tokens, topic, *args, **kwargs)
+        self._metrics.fcm_tokens.inc(operation, 'success', amount=response.success_count)
+        self._metrics.fcm_tokens.inc(operation, 'failure', amount=response.failure_count)
+        for error in response.errors:
+            self._metrics.fcm_errors.inc(operation, error.reason)
+        return response
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that records response serialization and request parsing time"""
+
+    def __init__(self, app, metrics):
+        super().__init__(app)
+        self.metrics = metrics
+
+    def dumps(self, obj, **kwargs):
+        with self.metrics.span('json', 'dumps'):
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        with self.metrics.span('json', 'loads'):
+            return super().loads(s, **kwargs)
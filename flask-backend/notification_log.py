@@ -0,0 +1,95 @@
+import time
+
+from batcher import BackgroundBatcher
+from fanout import backoff_delay
+from resilience import BackendUnavailable, is_dependency_failure
+
+# Firestore allows at most 500 writes in one WriteBatch
+MAX_BATCH_WRITES = 500
+# A batch failing with a transient error is committed up to this many times before its records are dropped
+LOG_COMMIT_ATTEMPTS = 4
+
+
+def _is_retryable(error):
+    # An open breaker or full concurrency limit fails fast but clears up like an outage does
+    return isinstance(error, BackendUnavailable) or is_dependency_failure(error)
+
+
+class NotificationLogWriter(BackgroundBatcher):
+    """Background writer that coalesces notification log records into batched commits
+
+    Handlers call enqueue()/enqueue_many() and return immediately. A worker
+    thread commits queued records with WriteBatch, flushing once a batch is
+    full or flush_interval seconds after its first record arrived. A commit
+    failing with a transient error is retried with backoff, up to
+    commit_attempts times, under the same document ids so a commit that
+    landed despite the error is not written twice.
+    """
+
+    thread_name = 'notification-log-writer'
+    label = 'Notification log writer'
+
+    def __init__(self, db, collection='notifications', batch_size=MAX_BATCH_WRITES,
+                 flush_interval=1.0, max_queue_size=100000, commit_attempts=LOG_COMMIT_ATTEMPTS, retry_delay=0.5):
+        super().__init__(min(batch_size, MAX_BATCH_WRITES), flush_interval, max_queue_size)
+        self.db = db
+        self.collection = collection
+        self.commit_attempts = commit_attempts
+        self.retry_delay = retry_delay
+        self.written_count = 0
+        self.retried_count = 0
+        self.flush_count = 0
+        self.last_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def stats(self):
+        """Return queue depth and flush latency figures"""
+        with self._lock:
+            return {
+                'queueDepth': self._queue.qsize(),
+                'written': self.written_count,
+                'failed': self.failed_count,
+                'dropped': self.dropped_count,
+                'retried': self.retried_count,
+                'flushCount': self.flush_count,
+                'lastFlushMs': round(self.last_flush_ms, 3),
+                'avgFlushMs': round(self.total_flush_ms / self.flush_count, 3) if self.flush_count else 0.0,
+                'maxFlushMs': round(self.max_flush_ms, 3),
+            }
+
+    def _flush(self, records):
+        started = time.monotonic()
+        written = failed = 0
+        attempt = 0
+        try:
+            collection = self.db.collection(self.collection)
+            writes = [(collection.document(), record) for record in records]
+            while True:
+                attempt += 1
+                try:
+                    batch = self.db.batch()
+                    for reference, record in writes:
+                        batch.set(reference, record)
+                    batch.commit()
+                    written = len(records)
+                    break
+                except Exception as e:
+                    if attempt >= self.commit_attempts or not _is_retryable(e):
+                        raise
+                    delay = max(backoff_delay(attempt, self.retry_delay), getattr(e, 'retry_after', 0))
+                    print(f"Retrying {len(records)} notification logs in {delay:.1f}s: {e}")
+                    with self._lock:
+                        self.retried_count += 1
+                    time.sleep(delay)
+        except Exception as e:
+            failed = len(records)
+            print(f"Error writing {len(records)} notification logs after {attempt} attempts: {e}")
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self._lock:
+            self.written_count += written
+            self.failed_count += failed
+            self.flush_count += 1
+            self.last_flush_ms = elapsed_ms
+            self.total_flush_ms += elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
@@ -0,0 +1,120 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+DEFAULT_INTERVAL = 0.01
+MAX_STACK_DEPTH = 64
+# Distinct stacks kept before new ones are folded into OTHER_STACK, so a long run stays bounded in memory
+MAX_DISTINCT_STACKS = 10000
+OTHER_STACK = '(other stacks)'
+# Leaf frames of threads parked waiting for work; sampling them only adds noise
+IDLE_LEAVES = {'threading.py:wait', 'queue.py:get', 'selectors.py:select', 'socket.py:accept', 'socketserver.py:serve_forever'}
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+class SamplingProfiler:
+    """Statistical profiler sampling every thread's stack from a background thread
+
+    Costs nothing while stopped. While running it wakes every interval
+    seconds and counts each thread's stack in collapsed (flame graph)
+    form, so it can be switched on against a live server. Once
+    max_stacks distinct stacks are counted, samples of new ones are
+    counted together under OTHER_STACK.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, max_stacks=MAX_DISTINCT_STACKS):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self._stacks = Counter()
+        self._lock = threading.Lock()
+        # Serializes start() and stop(), which wait for the sampling thread outside _lock
+        self._control = threading.Lock()
+        self._thread = None
+        self._stop = None
+        self.samples = 0
+        self.folded_samples = 0
+        self.started_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=None):
+        with self._control:
+            with self._lock:
+                if interval is not None:
+                    self.interval = interval
+                if self._thread is not None:
+                    return self
+                # Each run gets its own stop event, so stopping one can never stop the next
+                self._stop = threading.Event()
+                self.started_at = time.time()
+                self._thread = threading.Thread(target=self._run, args=(self._stop,), name='sampling-profiler',
+                                                daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self):
+        with self._control:
+            with self._lock:
+                thread, stop = self._thread, self._stop
+                self._thread = None
+            if thread is not None:
+                stop.set()
+                thread.join()
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+            self.folded_samples = 0
+
+    def top(self, limit=50):
+        """Most frequent stacks as (collapsed stack, sample count), root frame first"""
+        with self._lock:
+            return self._stacks.most_common(limit)
+
+    def collapsed(self):
+        """All stacks in the collapsed format read by flamegraph.pl and speedscope"""
+        with self._lock:
+            return '\n'.join(f"{stack} {count}" for stack, count in self._stacks.most_common()) + '\n'
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self._thread is not None,
+                'intervalMs': round(self.interval * 1000, 3),
+                'samples': self.samples,
+                'distinctStacks': len(self._stacks),
+                'foldedSamples': self.folded_samples,
+                'startedAt': self.started_at,
+            }
+
+    def _sample(self):
+        own = threading.get_ident()
+        stacks = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own or _frame_label(frame) in IDLE_LEAVES:
+                continue
+            labels = []
+            while frame is not None and len(labels) < MAX_STACK_DEPTH:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            stacks.append(';'.join(reversed(labels)))
+        with self._lock:
+            for stack in stacks:
+                if stack not in self._stacks and len(self._stacks) >= self.max_stacks:
+                    stack = OTHER_STACK
+                    self.folded_samples += 1
+                self._stacks[stack] += 1
+            self.samples += 1
+
+    def _run(self, stop):
+        while not stop.wait(self.interval):
+            self._sample()
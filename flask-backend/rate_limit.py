@@ -0,0 +1,182 @@
+import threading
+import time
+from array import array
+from datetime import datetime, timedelta, timezone
+
+# Slots probed for a user id before the least recently used one is reused
+PROBE_LENGTH = 8
+
+
+def _slot_count(max_donors):
+    # Keep the table at most half full so probe sequences stay short
+    slots = 1
+    while slots < max_donors * 2:
+        slots <<= 1
+    return slots
+
+
+def _key_hash(user_id):
+    # 0 marks an empty slot; the hash is stable for the life of the process, which is all the store needs
+    return (hash(user_id) & 0xFFFFFFFFFFFFFFFF) or 1
+
+
+class QuietHours:
+    """Local-time window, e.g. 22:00-07:00, during which non-urgent pushes are held back"""
+
+    def __init__(self, start_hour, end_hour, utc_offset_minutes=0):
+        self.start_hour = start_hour
+        self.end_hour = end_hour
+        self.tz = timezone(timedelta(minutes=utc_offset_minutes))
+
+    @classmethod
+    def parse(cls, value, utc_offset_minutes=0):
+        """Build from 'START-END' hours such as '22-7'; an empty value disables quiet hours"""
+        if not value:
+            return None
+        start, end = (int(part) for part in value.split('-'))
+        if not (0 <= start < 24 and 0 <= end < 24) or start == end:
+            raise ValueError(f"Invalid quiet hours {value}")
+        return cls(start, end, utc_offset_minutes)
+
+    def active(self, now=None):
+        hour = datetime.fromtimestamp(time.time() if now is None else now, self.tz).hour
+        if self.start_hour < self.end_hour:
+            return self.start_hour <= hour < self.end_hour
+        return hour >= self.start_hour or hour < self.end_hour
+
+    def seconds_until_end(self, now=None):
+        local = datetime.fromtimestamp(time.time() if now is None else now, self.tz)
+        end = local.replace(hour=self.end_hour, minute=0, second=0, microsecond=0)
+        if end <= local:
+            end += timedelta(days=1)
+        return int((end - local).total_seconds())
+
+
+class DonorRateLimiter:
+    """Token buckets per user id in flat arrays: about 20 bytes a slot, no Python object per donor
+
+    Each donor may receive capacity pushes in a burst, refilled at
+    refill_per_hour. Buckets live in an open-addressed table of 64-bit id
+    hashes; a bucket that has refilled completely is indistinguishable from
+    a new one, so its slot is reused first when a probe sequence is full.
+    Urgent sends may overdraw a bucket by urgent_overdraft tokens and are
+    not held back by quiet hours. Buckets run on the monotonic clock
+    (mono_now) and quiet hours on the wall clock (wall_now); a push taken
+    but not delivered is given back with refund().
+    """
+
+    def __init__(self, capacity=6, refill_per_hour=6, max_donors=1000000, urgent_overdraft=None, quiet_hours=None):
+        self.capacity = float(capacity)
+        self.refill_per_second = refill_per_hour / 3600.0
+        self.urgent_overdraft = self.capacity if urgent_overdraft is None else float(urgent_overdraft)
+        self.quiet_hours = quiet_hours
+        self.slots = _slot_count(max_donors)
+        self._mask = self.slots - 1
+        self._keys = array('Q', bytes(8 * self.slots))
+        self._tokens = array('f', bytes(4 * self.slots))
+        self._updated = array('d', bytes(8 * self.slots))
+        self._lock = threading.Lock()
+        self.used_slots = 0
+        self.evictions = 0
+        self.allowed = 0
+        self.throttled = 0
+        self.quiet_held = 0
+        self.refunded = 0
+
+    def _slot(self, key, now):
+        # Find the key's slot, else claim an empty or fully refilled one, else evict the stalest
+        start = key & self._mask
+        free = None
+        stalest = None
+        for i in range(PROBE_LENGTH):
+            slot = (start + i) & self._mask
+            stored = self._keys[slot]
+            if stored == key:
+                return slot
+            if stored == 0:
+                if free is None:
+                    free = slot
+                continue
+            if free is None and self._level(slot, now) >= self.capacity:
+                free = slot
+            if stalest is None or self._updated[slot] < self._updated[stalest]:
+                stalest = slot
+        if free is None:
+            free = stalest
+            self.evictions += 1
+        if self._keys[free] == 0:
+            self.used_slots += 1
+        self._keys[free] = key
+        self._tokens[free] = self.capacity
+        self._updated[free] = now
+        return free
+
+    def _level(self, slot, now):
+        refilled = self._tokens[slot] + (now - self._updated[slot]) * self.refill_per_second
+        return min(self.capacity, refilled)
+
+    def acquire_many(self, user_ids, urgent=False, mono_now=None, wall_now=None):
+        """Take one token per user; returns a list of booleans, True where the push may be sent"""
+        if self.quiet_hours is not None and not urgent and self.quiet_hours.active(wall_now):
+            with self._lock:
+                self.quiet_held += len(user_ids)
+            return [False] * len(user_ids)
+        now = time.monotonic() if mono_now is None else mono_now
+        floor = 1.0 - self.urgent_overdraft if urgent else 1.0
+        allowed = []
+        with self._lock:
+            for user_id in user_ids:
+                slot = self._slot(_key_hash(user_id), now)
+                level = self._level(slot, now)
+                ok = level >= floor
+                self._tokens[slot] = level - 1.0 if ok else level
+                self._updated[slot] = now
+                allowed.append(ok)
+            granted = sum(allowed)
+            self.allowed += granted
+            self.throttled += len(allowed) - granted
+        return allowed
+
+    def acquire(self, user_id, urgent=False, mono_now=None, wall_now=None):
+        return self.acquire_many([user_id], urgent, mono_now, wall_now)[0]
+
+    def refund(self, user_ids, mono_now=None):
+        """Give back the token taken for each of user_ids, for pushes that were not delivered"""
+        now = time.monotonic() if mono_now is None else mono_now
+        with self._lock:
+            for user_id in user_ids:
+                slot = self._slot(_key_hash(user_id), now)
+                self._tokens[slot] = min(self.capacity, self._level(slot, now) + 1.0)
+                self._updated[slot] = now
+            self.refunded += len(user_ids)
+
+    def retry_after(self, user_id, mono_now=None, wall_now=None):
+        """Seconds until user_id may receive another non-urgent push"""
+        if self.quiet_hours is not None and self.quiet_hours.active(wall_now):
+            return self.quiet_hours.seconds_until_end(wall_now)
+        now = time.monotonic() if mono_now is None else mono_now
+        with self._lock:
+            slot = self._slot(_key_hash(user_id), now)
+            missing = 1.0 - self._level(slot, now)
+        if missing <= 0:
+            return 0
+        if self.refill_per_second <= 0:
+            return None
+        return int(missing / self.refill_per_second) + 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'capacity': self.capacity,
+                'refillPerHour': round(self.refill_per_second * 3600, 3),
+                'quietHoursActive': self.quiet_hours.active() if self.quiet_hours is not None else False,
+                'slots': self.slots,
+                'usedSlots': self.used_slots,
+                'memoryBytes': self._keys.itemsize * self.slots + self._tokens.itemsize * self.slots
+                               + self._updated.itemsize * self.slots,
+                'allowed': self.allowed,
+                'throttled': self.throttled,
+                'quietHoursHeld': self.quiet_held,
+                'refunded': self.refunded,
+                'evictions': self.evictions,
+            }
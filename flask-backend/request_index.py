@@ -0,0 +1,163 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from blood_compat import CAN_DONATE_TO, blood_group_code
+from donor_index import INDEX_PRECISIONS, normalize_blood_group, query_precision
+from geo import encode_geohash, geohash_cells_covering, haversine_km, parse_coordinates
+
+# Removals remembered for delta polls; a client further behind gets a full list instead
+MAX_TOMBSTONES = 10000
+
+
+def is_open_request(data):
+    """Check whether a requests document still needs donors"""
+    if not data or data.get('status') != 'active':
+        return False
+    try:
+        return int(data.get('unitsFulfilled') or 0) < int(data.get('units') or 1)
+    except (TypeError, ValueError):
+        return True
+
+
+def _format_time(value):
+    if value is None:
+        return None
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+class OpenRequest:
+    """Compact in-memory record of an open blood request"""
+
+    __slots__ = ('request_id', 'lat', 'lon', 'group_code', 'user_id', 'version', 'cells', 'summary')
+
+    def __init__(self, request_id, lat, lon, data, version):
+        self.request_id = request_id
+        self.lat = lat
+        self.lon = lon
+        self.group_code = blood_group_code(data.get('bloodGroup'))
+        self.user_id = data.get('userId')
+        self.version = version
+        self.cells = tuple(encode_geohash(lat, lon, p) for p in INDEX_PRECISIONS)
+        # Only what a list row needs; contact and patient details stay in Firestore
+        self.summary = {
+            'id': request_id,
+            'bloodGroup': normalize_blood_group(data.get('bloodGroup')),
+            'units': data.get('units') or 1,
+            'unitsFulfilled': data.get('unitsFulfilled') or 0,
+            'urgency': data.get('urgency'),
+            'hospital': data.get('hospital'),
+            'address': data.get('address'),
+            'location': {'latitude': lat, 'longitude': lon},
+            'userId': self.user_id,
+            'createdAt': _format_time(data.get('createdAt')),
+        }
+
+
+class RequestIndex:
+    """Geohash-bucketed index of open blood requests with a change version for delta polls
+
+    Every change bumps version and stamps the request with it; closed,
+    deleted or moved requests leave a tombstone at the position they left,
+    so a poll with an older version near it can be told which ids to drop.
+    epoch identifies this instance, since versions from another process or
+    before a restart mean nothing here.
+    """
+
+    def __init__(self, max_tombstones=MAX_TOMBSTONES):
+        self._requests = {}
+        self._buckets = {precision: {} for precision in INDEX_PRECISIONS}
+        self._tombstones = OrderedDict()
+        self._max_tombstones = max_tombstones
+        self._horizon = 0
+        self._lock = threading.RLock()
+        self.epoch = uuid.uuid4().hex[:12]
+        self.version = 0
+        self.ready = False
+        self.last_update = None
+
+    def __len__(self):
+        return len(self._requests)
+
+    def apply_request(self, request_id, data):
+        """Index an open request, or drop it once it is closed, filled or deleted"""
+        coordinates = parse_coordinates((data or {}).get('location'))
+        is_open = coordinates is not None and is_open_request(data)
+        with self._lock:
+            self.version += 1
+            previous = self._requests.get(request_id)
+            # A request updated where it is needs no tombstone; one that moved must be dropped where it was
+            moved = previous is None or not is_open or (previous.lat, previous.lon) != coordinates
+            self._remove_locked(request_id, tombstone=moved)
+            if is_open:
+                entry = OpenRequest(request_id, coordinates[0], coordinates[1], data, self.version)
+                self._requests[request_id] = entry
+                for precision, cell in zip(INDEX_PRECISIONS, entry.cells):
+                    self._buckets[precision].setdefault(cell, {})[request_id] = entry
+            self.last_update = time.time()
+
+    def _remove_locked(self, request_id, tombstone=True):
+        entry = self._requests.pop(request_id, None)
+        if entry is None:
+            return
+        for precision, cell in zip(INDEX_PRECISIONS, entry.cells):
+            bucket = self._buckets[precision].get(cell)
+            if bucket is not None:
+                bucket.pop(request_id, None)
+                if not bucket:
+                    del self._buckets[precision][cell]
+        if tombstone:
+            # Keyed by version too: a request that moved twice left two positions to clear
+            self._tombstones[(request_id, self.version)] = (self.version, entry.lat, entry.lon)
+        while len(self._tombstones) > self._max_tombstones:
+            _, (version, _, _) = self._tombstones.popitem(last=False)
+            self._horizon = version
+
+    def query(self, lat, lon, radius_km, donor_group=None, exclude_user_id=None, since=None):
+        """Return (version, [(distance_km, OpenRequest)] closest first, removed ids, full)
+
+        With since, only requests changed after that version are listed and
+        removed names the ones to drop; full is True when since is too old
+        to answer incrementally, in which case everything is listed.
+        """
+        donor = blood_group_code(donor_group) if donor_group else None
+        with self._lock:
+            full = since is None or since < self._horizon or since > self.version
+            precision = query_precision(lat, radius_km)
+            matches = []
+            removed = []
+            for cell in geohash_cells_covering(lat, lon, radius_km, precision):
+                for entry in self._buckets[precision].get(cell, {}).values():
+                    if not full and entry.version <= since:
+                        continue
+                    distance = haversine_km(lat, lon, entry.lat, entry.lon)
+                    if distance > radius_km:
+                        continue
+                    compatible = donor is None or (
+                        entry.group_code is not None and CAN_DONATE_TO[donor] >> entry.group_code & 1
+                    )
+                    if compatible and (exclude_user_id is None or entry.user_id != exclude_user_id):
+                        matches.append((distance, entry))
+                    elif not full:
+                        # Changed so it no longer matches: the client may still be showing it
+                        removed.append(entry.request_id)
+            if not full:
+                removed.extend(
+                    request_id for (request_id, _), (version, t_lat, t_lon) in self._tombstones.items()
+                    if version > since and haversine_km(lat, lon, t_lat, t_lon) <= radius_km
+                )
+            matches.sort(key=lambda item: (item[0], item[1].request_id))
+            # A request that left this area and came back, or was reopened, is listed rather than removed
+            listed = {entry.request_id for _, entry in matches}
+            return self.version, matches, sorted(set(removed) - listed), full
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self.ready,
+                'openRequests': len(self._requests),
+                'version': self.version,
+                'tombstones': len(self._tombstones),
+                'lastUpdate': self.last_update,
+            }
@@ -0,0 +1,291 @@
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from firebase_admin import exceptions
+from google.api_core import exceptions as api_exceptions
+
+from fanout import is_transient_error
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# Why a call was failed fast instead of reaching its dependency
+REJECT_OPEN = 'open'
+REJECT_OVERLOADED = 'overloaded'
+REJECT_DEADLINE = 'deadline'
+
+# Firestore errors that mean the service is struggling rather than the request being wrong
+DEPENDENCY_ERRORS = (
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.DeadlineExceeded,
+    api_exceptions.InternalServerError,
+    api_exceptions.TooManyRequests,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.RetryError,
+)
+
+# Absolute time.monotonic() by which the current request must be answered, or None
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+class BackendUnavailable(exceptions.UnavailableError):
+    """Raised instead of calling a dependency whose breaker is open, whose limit is full or whose deadline passed
+
+    It is an FCM UnavailableError, so send retries and the job queue treat
+    it as transient; retry_after is the number of seconds to wait.
+    """
+
+    def __init__(self, dependency, reason, retry_after):
+        super().__init__(f"{dependency} is unavailable ({reason}); retry after {retry_after:.1f}s")
+        self.dependency = dependency
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def is_dependency_failure(error):
+    """Check whether an error counts against its dependency's health, as timeouts and outages do"""
+    if isinstance(error, BackendUnavailable):
+        return False
+    return is_transient_error(error) or isinstance(error, DEPENDENCY_ERRORS)
+
+
+def set_deadline(seconds):
+    """Start a deadline seconds from now, or none when seconds is None; returns the token for clear_deadline"""
+    return _deadline.set(time.monotonic() + seconds if seconds is not None else None)
+
+
+def clear_deadline(token):
+    _deadline.reset(token)
+
+
+@contextmanager
+def deadline_scope(seconds):
+    """Run a block with a deadline seconds from now"""
+    token = set_deadline(seconds)
+    try:
+        yield
+    finally:
+        clear_deadline(token)
+
+
+def remaining_time():
+    """Seconds left before the current deadline, or None without one"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive dependency failures and fails calls fast while open
+
+    After reset_timeout one probe call is let through. Its success closes
+    the breaker; its failure reopens it for twice as long, up to
+    max_reset_timeout. force() holds the breaker open or closed by hand.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=10.0, max_reset_timeout=120.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.forced = False
+        self.consecutive_failures = 0
+        self.opened_count = 0
+        self._open_for = reset_timeout
+        self._opened_at = None
+        self._probing = False
+
+    def allow(self):
+        """Returns (allowed, is_probe); an allowed probe must be followed by record() or cancel_probe()"""
+        with self._lock:
+            if self.state == OPEN and not self.forced and self._clock() - self._opened_at >= self._open_for:
+                self.state = HALF_OPEN
+            if self.state == CLOSED:
+                return True, False
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True, True
+            return False, False
+
+    def cancel_probe(self):
+        with self._lock:
+            self._probing = False
+
+    def record(self, failed, probe=False):
+        with self._lock:
+            if probe:
+                self._probing = False
+            if self.forced:
+                return
+            if not failed:
+                self.consecutive_failures = 0
+                if probe or self.state == HALF_OPEN:
+                    self.state = CLOSED
+                    self._open_for = self.reset_timeout
+                return
+            self.consecutive_failures += 1
+            if probe:
+                self._open(min(self._open_for * 2, self.max_reset_timeout))
+            elif self.state == CLOSED and self.consecutive_failures >= self.failure_threshold:
+                self._open(self.reset_timeout)
+
+    def _open(self, duration):
+        self.state = OPEN
+        self._open_for = duration
+        self._opened_at = self._clock()
+        self.opened_count += 1
+
+    def force(self, state):
+        """Hold the breaker OPEN, or close it and resume automatic control with CLOSED"""
+        with self._lock:
+            if state == OPEN:
+                self.forced = True
+                self._open(self.max_reset_timeout)
+            else:
+                self.forced = False
+                self.state = CLOSED
+                self.consecutive_failures = 0
+                self._open_for = self.reset_timeout
+
+    def retry_after(self):
+        """Seconds until the breaker lets a probe through"""
+        with self._lock:
+            if self.state != OPEN:
+                return 1.0
+            if self.forced:
+                return self._open_for
+            return max(1.0, self._open_for - (self._clock() - self._opened_at))
+
+
+class AdaptiveLimit:
+    """AIMD concurrency limit: grows by one per limit's worth of fast calls, halves on a slow or failed one
+
+    A call is slow when it takes longer than latency_target. The limit is
+    cut at most once per latency_target, so one burst of slow calls that
+    were all in flight together only counts once.
+    """
+
+    def __init__(self, maximum, minimum=1, initial=None, latency_target=1.0, backoff=0.5, clock=time.monotonic):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self._clock = clock
+        self._condition = threading.Condition()
+        self.limit = float(initial if initial is not None else maximum)
+        self.in_flight = 0
+        self.decreases = 0
+        self.latency_ewma = None
+        self._last_decrease = None
+
+    def acquire(self, timeout=None):
+        """Take a slot, waiting up to timeout seconds for one; returns False if none came free"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_flight < max(1, int(self.limit)), timeout):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency, failed=False):
+        with self._condition:
+            self.in_flight -= 1
+            self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+            if failed or latency > self.latency_target:
+                now = self._clock()
+                if self._last_decrease is None or now - self._last_decrease >= self.latency_target:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self._last_decrease = now
+                    self.decreases += 1
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def reset(self):
+        with self._condition:
+            self.limit = float(self.maximum)
+            self._condition.notify_all()
+
+
+class Dependency:
+    """Circuit breaker and adaptive concurrency limit in front of one backend such as Firestore or FCM
+
+    call() is a context manager around one backend call. It fails fast
+    with BackendUnavailable while the breaker is open, when no slot frees
+    up within max_wait or the current deadline, or once the deadline has
+    passed; otherwise it yields the seconds left before the deadline.
+    """
+
+    def __init__(self, name, breaker, limit, max_wait=30.0, clock=time.monotonic):
+        self.name = name
+        self.breaker = breaker
+        self.limit = limit
+        self.max_wait = max_wait
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.rejected = {REJECT_OPEN: 0, REJECT_OVERLOADED: 0, REJECT_DEADLINE: 0}
+
+    def _reject(self, reason, retry_after):
+        with self._lock:
+            self.rejected[reason] += 1
+        raise BackendUnavailable(self.name, reason, retry_after)
+
+    @contextmanager
+    def call(self):
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            self._reject(REJECT_DEADLINE, 1.0)
+        allowed, probe = self.breaker.allow()
+        if not allowed:
+            self._reject(REJECT_OPEN, self.breaker.retry_after())
+        wait = self.max_wait if remaining is None else min(self.max_wait, remaining)
+        if not self.limit.acquire(wait):
+            if probe:
+                self.breaker.cancel_probe()
+            self._reject(REJECT_OVERLOADED, max(1.0, self.limit.latency_target))
+
+        started = self._clock()
+        failed = False
+        try:
+            yield remaining_time()
+        except Exception as e:
+            failed = is_dependency_failure(e)
+            raise
+        finally:
+            self.limit.release(self._clock() - started, failed)
+            self.breaker.record(failed, probe)
+            with self._lock:
+                self.calls += 1
+                self.failures += failed
+
+    def stats(self):
+        """Breaker state, concurrency limit and call counts"""
+        with self._lock:
+            calls, failures, rejected = self.calls, self.failures, dict(self.rejected)
+        return {
+            'state': self.breaker.state,
+            'forced': self.breaker.forced,
+            'consecutiveFailures': self.breaker.consecutive_failures,
+            'opened': self.breaker.opened_count,
+            'retryAfterSeconds': round(self.breaker.retry_after(), 3) if self.breaker.state == OPEN else None,
+            'limit': round(self.limit.limit, 2),
+            'maxLimit': self.limit.maximum,
+            'inFlight': self.limit.in_flight,
+            'limitDecreases': self.limit.decreases,
+            'latencyTargetMs': round(self.limit.latency_target * 1000, 1),
+            'latencyEwmaMs': round(self.limit.latency_ewma * 1000, 1) if self.limit.latency_ewma is not None else None,
+            'calls': calls,
+            'failures': failures,
+            'rejected': rejected,
+        }
+
+
+def retry_after_header(seconds):
+    """Retry-After value, in whole seconds, for a wait of seconds"""
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,225 @@
+import gzip
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+from firebase_admin import firestore
+
+from notification_log import MAX_BATCH_WRITES
+
+# Aggregates live in this collection under ids like hour-2026-10-17T04 and day-2026-10-17
+STATS_COLLECTION = 'notificationStats'
+STATE_DOCUMENT = 'rollupState'
+HOUR = 'hour'
+DAY = 'day'
+GRANULARITIES = (HOUR, DAY)
+BUCKET_SPANS = {HOUR: timedelta(hours=1), DAY: timedelta(days=1)}
+# An hour is rolled up this long after it ends, once the log writer has flushed it
+ROLLUP_DELAY = timedelta(minutes=15)
+ROLLUP_PAGE_SIZE = 500
+BREAKDOWNS = (('byType', 'type'), ('byTopic', 'topic'), ('byBloodType', 'bloodType'), ('byUrgency', 'urgency'))
+
+
+def bucket_start(moment, granularity):
+    """Start of the UTC hour or day containing moment"""
+    moment = moment.astimezone(timezone.utc)
+    if granularity == DAY:
+        return datetime(moment.year, moment.month, moment.day, tzinfo=timezone.utc)
+    return datetime(moment.year, moment.month, moment.day, moment.hour, tzinfo=timezone.utc)
+
+
+def bucket_id(start, granularity):
+    """Document id of the stats bucket starting at start"""
+    if granularity == DAY:
+        return f"day-{start:%Y-%m-%d}"
+    return f"hour-{start:%Y-%m-%dT%H}"
+
+
+def bucket_starts(start, end, granularity):
+    """Starts of every bucket overlapping [start, end)"""
+    starts = []
+    current = bucket_start(start, granularity)
+    while current < end:
+        starts.append(current)
+        current += BUCKET_SPANS[granularity]
+    return starts
+
+
+def new_aggregate():
+    return {'count': 0, 'sent': 0, 'failed': 0, **{name: {} for name, _ in BREAKDOWNS}}
+
+
+def add_notification(aggregate, data):
+    """Count one notification log record; a record with an error or a failed status counts as failed"""
+    aggregate['count'] += 1
+    if data.get('error') or data.get('status') == 'failed':
+        aggregate['failed'] += 1
+    else:
+        aggregate['sent'] += 1
+    for name, field in BREAKDOWNS:
+        value = data.get(field)
+        if value:
+            key = str(value)
+            aggregate[name][key] = aggregate[name].get(key, 0) + 1
+
+
+def merge_aggregates(target, other):
+    """Add the counts of other into target"""
+    for key in ('count', 'sent', 'failed'):
+        target[key] += other.get(key, 0)
+    for name, _ in BREAKDOWNS:
+        for key, count in (other.get(name) or {}).items():
+            target[name][key] = target[name].get(key, 0) + count
+    return target
+
+
+def _write_bucket(db, granularity, start, aggregate):
+    # Buckets are overwritten, never incremented, so rolling an hour up again is harmless
+    db.collection(STATS_COLLECTION).document(bucket_id(start, granularity)).set({
+        'granularity': granularity,
+        'bucketStart': start,
+        **aggregate,
+        'rolledUpAt': firestore.SERVER_TIMESTAMP,
+    })
+
+
+def _write_day(db, day):
+    references = [
+        db.collection(STATS_COLLECTION).document(bucket_id(hour, HOUR))
+        for hour in bucket_starts(day, day + BUCKET_SPANS[DAY], HOUR)
+    ]
+    aggregate = new_aggregate()
+    for snapshot in db.get_all(references):
+        if snapshot.exists:
+            merge_aggregates(aggregate, snapshot.to_dict())
+    _write_bucket(db, DAY, day, aggregate)
+
+
+def rolled_up_until(db):
+    """End of the last hour rolled up, or None before the first rollup"""
+    state = db.collection(STATS_COLLECTION).document(STATE_DOCUMENT).get().to_dict() or {}
+    return state.get('rolledUpUntil')
+
+
+def rollup_notifications(db, now=None, delay=ROLLUP_DELAY, page_size=ROLLUP_PAGE_SIZE, on_hour=None):
+    """Aggregate every complete hour of notifications since the last rollup; returns (hours, notifications)
+
+    Notifications are streamed in sentAt order one page at a time, so only
+    the hour being counted is held in memory. Each finished hour is written
+    to its bucket, its day is recomputed from the hourly buckets, and the
+    watermark moves past it. on_hour(notifications) is called per hour.
+    """
+    now = datetime.now(timezone.utc) if now is None else now
+    cutoff = bucket_start(now - delay, HOUR)
+    watermark = rolled_up_until(db)
+    state = db.collection(STATS_COLLECTION).document(STATE_DOCUMENT)
+    query = db.collection('notifications').where('sentAt', '<', cutoff)
+    if watermark is not None:
+        if watermark >= cutoff:
+            return 0, 0
+        query = query.where('sentAt', '>=', watermark)
+    query = query.order_by('sentAt').order_by('__name__').limit(page_size)
+
+    hours = notifications = 0
+    current, aggregate = None, None
+
+    def finish_hour():
+        _write_bucket(db, HOUR, current, aggregate)
+        _write_day(db, bucket_start(current, DAY))
+        state.set({'rolledUpUntil': current + BUCKET_SPANS[HOUR]}, merge=True)
+        if on_hour is not None:
+            on_hour(aggregate['count'])
+
+    last = None
+    while True:
+        page = list((query.start_after(last) if last is not None else query).stream())
+        for doc in page:
+            data = doc.to_dict()
+            hour = bucket_start(data['sentAt'], HOUR)
+            if hour != current:
+                if current is not None:
+                    finish_hour()
+                    hours += 1
+                current, aggregate = hour, new_aggregate()
+            add_notification(aggregate, data)
+            notifications += 1
+        if len(page) < page_size:
+            break
+        last = page[-1]
+    if current is not None:
+        finish_hour()
+        hours += 1
+    state.set({'rolledUpUntil': cutoff}, merge=True)
+    return hours, notifications
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _append_archive(path, records):
+    # Each page is one gzip member written with a single append, so concurrent writers never interleave
+    payload = ''.join(json.dumps(record, default=_json_default, sort_keys=True) + '\n' for record in records)
+    data = gzip.compress(payload.encode('utf-8'))
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def archive_notifications(db, archive_dir, older_than, page_size=ROLLUP_PAGE_SIZE, on_page=None):
+    """Move rolled up notifications sent before older_than to gzip JSONL files, then delete them; returns the count
+
+    Records go to notifications-YYYY-MM-DD.jsonl.gz in archive_dir by the
+    UTC day they were sent, and each page is on disk before it is deleted
+    in one batch. A page whose delete fails is archived again next time,
+    so readers should drop repeated ids.
+    """
+    watermark = rolled_up_until(db)
+    if watermark is None:
+        return 0
+    cutoff = min(older_than, watermark)
+    os.makedirs(archive_dir, exist_ok=True)
+    limit = min(page_size, MAX_BATCH_WRITES)
+    query = (db.collection('notifications').where('sentAt', '<', cutoff)
+             .order_by('sentAt').order_by('__name__').limit(limit))
+    archived = 0
+    while True:
+        # Archived documents are deleted, so the next page is always the first one left
+        page = list(query.stream())
+        if not page:
+            break
+        by_day = {}
+        for doc in page:
+            record = doc.to_dict()
+            record['id'] = doc.id
+            by_day.setdefault(f"{bucket_start(record['sentAt'], DAY):%Y-%m-%d}", []).append(record)
+        for day, records in by_day.items():
+            _append_archive(os.path.join(archive_dir, f"notifications-{day}.jsonl.gz"), records)
+        batch = db.batch()
+        for doc in page:
+            batch.delete(doc.reference)
+        batch.commit()
+        archived += len(page)
+        if on_page is not None:
+            on_page(len(page))
+        if len(page) < limit:
+            break
+    return archived
+
+
+def read_stats(db, granularity, start, end):
+    """Return the existing buckets overlapping [start, end), oldest first, with one read per bucket"""
+    starts = bucket_starts(start, end, granularity)
+    references = [db.collection(STATS_COLLECTION).document(bucket_id(s, granularity)) for s in starts]
+    buckets = {}
+    for snapshot in db.get_all(references):
+        if snapshot.exists:
+            buckets[snapshot.id] = snapshot.to_dict()
+    return [buckets[reference.id] for reference in references if reference.id in buckets]
@@ -0,0 +1,204 @@
+import gc
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+from blood_compat import BLOOD_GROUPS
+from donor_index import INDEX_PRECISIONS, Donor
+from donor_match import UNKNOWN_GROUP_CODE
+from geo import encode_geohash_array
+
+MAGIC = b'BDSNAP\x00\x01'
+FORMAT_VERSION = 1
+# Columns start on this boundary so each one maps straight onto an aligned array
+ALIGNMENT = 64
+_HEADER_LENGTH = struct.Struct('<I')
+
+# Fixed width donor columns and their on-disk dtypes; user ids and tokens are string columns
+DONOR_COLUMNS = (
+    ('lat', '<f8'),
+    ('lon', '<f8'),
+    ('group', 'i1'),
+    ('last_donation', '<f8'),
+    ('available', '?'),
+)
+
+
+class SnapshotError(Exception):
+    """Raised for a snapshot that is truncated, corrupt, of another format version or another project"""
+
+
+class Snapshot:
+    """A loaded snapshot: metadata, numeric columns that are read-only views of the mapped file, and string columns"""
+
+    def __init__(self, path, size, count, meta, columns, strings):
+        self.path = path
+        self.size = size
+        self.count = count
+        self.meta = meta
+        self.columns = columns
+        self.strings = strings
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_snapshot(path, columns, strings, meta=None):
+    """Atomically write equal length numeric and string columns to path; returns the file size
+
+    String columns are stored as UTF-8 joined by NUL bytes, with None
+    written as an empty string. Every column carries a CRC32.
+    """
+    count = None
+    entries = []
+    offset = end = 0
+    for kind, items in (('column', columns), ('strings', strings)):
+        for name, values in items.items():
+            if kind == 'column':
+                data = np.ascontiguousarray(values)
+                length = len(data)
+            else:
+                joined = '\0'.join(value or '' for value in values)
+                if joined.count('\0') != max(len(values) - 1, 0):
+                    raise ValueError(f"{name} values must not contain NUL characters")
+                data = np.frombuffer(joined.encode('utf-8'), dtype=np.uint8)
+                length = len(values)
+            if count is None:
+                count = length
+            elif length != count:
+                raise ValueError(f"Column {name} has {length} rows, expected {count}")
+            entries.append(({
+                'name': name, 'kind': kind, 'dtype': data.dtype.str, 'offset': offset,
+                'bytes': data.nbytes, 'crc32': zlib.crc32(data),
+            }, data))
+            end = offset + data.nbytes
+            offset = _aligned(end)
+    header = json.dumps({
+        'version': FORMAT_VERSION,
+        'count': count or 0,
+        'meta': meta or {},
+        'columns': [entry for entry, _ in entries],
+    }).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + _HEADER_LENGTH.size + len(header))
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(MAGIC)
+            f.write(_HEADER_LENGTH.pack(len(header)))
+            f.write(header)
+            for entry, data in entries:
+                f.seek(data_start + entry['offset'])
+                f.write(memoryview(data).cast('B'))
+            f.truncate(data_start + end)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return data_start + end
+
+
+def load_snapshot(path):
+    """Memory-map a snapshot written by write_snapshot and check it; raises SnapshotError if it is unusable"""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < len(MAGIC) + _HEADER_LENGTH.size:
+            raise SnapshotError(f"{path} is too short to be a snapshot")
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(MAGIC)] != MAGIC:
+        raise SnapshotError(f"{path} is not a snapshot")
+    (header_length,) = _HEADER_LENGTH.unpack_from(mapped, len(MAGIC))
+    header_start = len(MAGIC) + _HEADER_LENGTH.size
+    try:
+        header = json.loads(mapped[header_start:header_start + header_length].decode('utf-8'))
+    except ValueError as e:
+        raise SnapshotError(f"{path} has an unreadable header: {e}")
+    if header.get('version') != FORMAT_VERSION:
+        raise SnapshotError(f"{path} is format version {header.get('version')}, expected {FORMAT_VERSION}")
+
+    count = header['count']
+    data_start = _aligned(header_start + header_length)
+    columns = {}
+    strings = {}
+    for entry in header['columns']:
+        start = data_start + entry['offset']
+        if start + entry['bytes'] > size:
+            raise SnapshotError(f"{path} is truncated in column {entry['name']}")
+        dtype = np.dtype(entry['dtype'])
+        data = np.frombuffer(mapped, dtype=dtype, count=entry['bytes'] // dtype.itemsize, offset=start)
+        if zlib.crc32(data) != entry['crc32']:
+            raise SnapshotError(f"{path} has a corrupt column {entry['name']}")
+        if entry['kind'] == 'strings':
+            values = data.tobytes().decode('utf-8').split('\0') if count else []
+            if len(values) != count:
+                raise SnapshotError(f"{path} has {len(values)} values in {entry['name']}, expected {count}")
+            strings[entry['name']] = values
+        else:
+            if len(data) != count:
+                raise SnapshotError(f"{path} has {len(data)} values in {entry['name']}, expected {count}")
+            columns[entry['name']] = data
+    return Snapshot(path, size, count, header['meta'], columns, strings)
+
+
+def write_donor_snapshot(path, exported, read_time, source=None):
+    """Write DonorTable.export() output taken at read_time, in epoch seconds; returns the file size"""
+    user_ids, tokens, columns = exported
+    return write_snapshot(
+        path,
+        {name: np.asarray(columns[name], dtype=dtype) for name, dtype in DONOR_COLUMNS},
+        {'userIds': user_ids, 'tokens': tokens},
+        {'readTime': read_time, 'takenAt': time.time(), 'source': source},
+    )
+
+
+def snapshot_donors(user_ids, tokens, columns):
+    """Build DonorIndex records from snapshot columns, computing their geohash cells in one vectorized pass"""
+    finest = encode_geohash_array(columns['lat'], columns['lon'], max(INDEX_PRECISIONS))
+    # Coarser cells are prefixes of the finest one; astype to a shorter width truncates
+    cells = zip(*(finest.astype(f'S{precision}').astype(str).tolist() for precision in INDEX_PRECISIONS))
+    group_names = np.array(BLOOD_GROUPS + (None,), dtype=object)[columns['group']].tolist()
+    return [
+        Donor(user_id, lat, lon, group, token, available, cell)
+        for user_id, lat, lon, group, token, available, cell in zip(
+            user_ids, columns['lat'].tolist(), columns['lon'].tolist(), group_names, tokens,
+            columns['available'].tolist(), cells
+        )
+    ]
+
+
+def load_donor_snapshot(path, table, index, compat_index, source=None):
+    """Replace the donor table and indexes with a snapshot's donors; returns the Snapshot
+
+    Raises SnapshotError when the file is unusable or was taken from
+    another Firestore project, leaving the table and indexes untouched.
+    """
+    snapshot = load_snapshot(path)
+    if snapshot.meta.get('source') != source:
+        raise SnapshotError(f"{path} was taken from {snapshot.meta.get('source')}, not {source}")
+    user_ids = snapshot.strings['userIds']
+    tokens = [token or None for token in snapshot.strings['tokens']]
+    columns = snapshot.columns
+    # A million new records would otherwise set off repeated full collections that find nothing to free
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        donors = snapshot_donors(user_ids, tokens, columns)
+        listed = columns['available'] & (columns['group'] < UNKNOWN_GROUP_CODE)
+        codes = dict(zip(np.array(user_ids, dtype=object)[listed].tolist(), columns['group'][listed].tolist()))
+
+        table.load(user_ids, tokens, columns)
+        index.load_donors(donors)
+        compat_index.load_codes(codes)
+    finally:
+        if collecting:
+            gc.enable()
+    return snapshot
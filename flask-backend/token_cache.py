@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+
+from firebase_admin import exceptions, messaging
+
+# FCM errors meaning the token itself is dead and must not be served from cache
+INVALID_TOKEN_ERRORS = (
+    messaging.UnregisteredError,
+    messaging.SenderIdMismatchError,
+    exceptions.InvalidArgumentError,
+)
+
+
+def is_invalid_token_error(error):
+    """Check whether an FCM send error means the token is no longer usable"""
+    return isinstance(error, INVALID_TOKEN_ERRORS)
+
+
+class TokenCache:
+    """Bounded LRU cache of userId -> FCM token entries that expire after ttl seconds"""
+
+    def __init__(self, max_size=50000, ttl=600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        """Return the cached token for user_id, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            token, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[user_id]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return token
+
+    def get_many(self, user_ids):
+        """Return a dict of the cached tokens found for user_ids"""
+        found = {}
+        for user_id in user_ids:
+            token = self.get(user_id)
+            if token:
+                found[user_id] = token
+        return found
+
+    def put(self, user_id, token):
+        """Cache token for user_id, evicting the least recently used entry when full"""
+        if not user_id or not token:
+            return
+        with self._lock:
+            self._entries[user_id] = (token, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id, token=None):
+        """Drop user_id from the cache; with token, only if it still holds that token"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or (token is not None and entry[0] != token):
+                return False
+            del self._entries[user_id]
+            self.invalidations += 1
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return size and hit/miss/eviction counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxSize': self.max_size,
+                'ttlSeconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
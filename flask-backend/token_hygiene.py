@@ -0,0 +1,212 @@
+from firebase_admin import exceptions, firestore, messaging
+from google.api_core.exceptions import FailedPrecondition
+
+from batcher import BackgroundBatcher
+from fanout import send_multicast_batched
+from notification_log import MAX_BATCH_WRITES
+from topics import manage_topic_subscriptions, write_subscription_records
+from user_lookup import LOOKUP_CHUNK_SIZE, _chunks
+
+# Send errors meaning FCM will never deliver to the token again
+STALE_TOKEN_ERRORS = {
+    messaging.UnregisteredError: 'UNREGISTERED',
+    messaging.SenderIdMismatchError: 'SENDER_ID_MISMATCH',
+}
+# Topic management reports the same conditions as reason strings
+STALE_TOPIC_REASONS = {
+    'NOT_FOUND': 'UNREGISTERED',
+    'registration-token-not-registered': 'UNREGISTERED',
+    'INVALID_ARGUMENT': 'INVALID_ARGUMENT',
+    'invalid-argument': 'INVALID_ARGUMENT',
+    'invalid-registration-token': 'INVALID_ARGUMENT',
+}
+# Firestore 'in' filters accept at most 30 values
+MAX_IN_FILTER_VALUES = 30
+SWEEP_PAGE_SIZE = 5000
+
+
+def stale_token_reason(error, delivered_elsewhere=False):
+    """UNREGISTERED or SENDER_ID_MISMATCH for a dead-token send error, else None
+
+    INVALID_ARGUMENT can mean a malformed token or a malformed message, so it
+    is only reported when the same message was delivered to other tokens.
+    """
+    for error_type, reason in STALE_TOKEN_ERRORS.items():
+        if isinstance(error, error_type):
+            return reason
+    if delivered_elsewhere and isinstance(error, exceptions.InvalidArgumentError):
+        return 'INVALID_ARGUMENT'
+    return None
+
+
+def stale_tokens(user_ids, tokens, responses):
+    """(userId, token, reason) for every multicast response that failed on a dead token"""
+    delivered = any(response.success for response in responses)
+    stale = [
+        (user_id, token, stale_token_reason(response.exception, delivered))
+        for user_id, token, response in zip(user_ids, tokens, responses)
+        if response.exception is not None
+    ]
+    return [entry for entry in stale if entry[2] is not None]
+
+
+class TokenPruner(BackgroundBatcher):
+    """Background worker that clears dead FCM tokens from user documents and their topic subscriptions
+
+    Senders enqueue (userId, token, reason) entries. Each flush re-reads the
+    users' current tokens, skips any that were refreshed since the failed
+    send, removes fcmToken (keeping it as invalidFcmToken with the reason)
+    in batched writes and unsubscribes the token from the topics it was
+    subscribed to. Each write is conditional on the user document being
+    unchanged since it was read, so a token saved in between is never
+    cleared. on_pruned(user_id, token) is called for every token cleared.
+    """
+
+    thread_name = 'token-pruner'
+    label = 'Token pruner'
+
+    def __init__(self, db, messaging, batch_size=MAX_BATCH_WRITES, flush_interval=5.0,
+                 max_queue_size=100000, on_pruned=None):
+        super().__init__(min(batch_size, MAX_BATCH_WRITES), flush_interval, max_queue_size)
+        self.db = db
+        self.messaging = messaging
+        self.on_pruned = on_pruned
+        self.pruned_count = 0
+        self.skipped_count = 0
+        self.unsubscribed_count = 0
+
+    def prune(self, entries):
+        """Clear the given (userId, token, reason) entries now; returns the number of tokens cleared"""
+        latest = {user_id: (token, reason) for user_id, token, reason in entries}
+        users = self.db.collection('users')
+        # Keep each user's update time to make the clearing write conditional on it
+        read_at = {}
+        for chunk in _chunks(list(latest), LOOKUP_CHUNK_SIZE):
+            for snapshot in self.db.get_all([users.document(uid) for uid in chunk], field_paths=['fcmToken']):
+                if snapshot.exists and (snapshot.to_dict() or {}).get('fcmToken') == latest[snapshot.id][0]:
+                    read_at[snapshot.id] = snapshot.update_time
+        stale = [(uid, token, reason) for uid, (token, reason) in latest.items() if uid in read_at]
+
+        def clear(write, user_id, token, reason):
+            write(users.document(user_id), {
+                'fcmToken': firestore.DELETE_FIELD,
+                'invalidFcmToken': token,
+                'fcmTokenError': reason,
+                'fcmTokenInvalidAt': firestore.SERVER_TIMESTAMP,
+            }, option=firestore.Client.write_option(last_update_time=read_at[user_id]))
+
+        cleared = []
+        for start in range(0, len(stale), self.batch_size):
+            chunk = stale[start:start + self.batch_size]
+            batch = self.db.batch()
+            for entry in chunk:
+                clear(batch.update, *entry)
+            try:
+                batch.commit()
+                cleared.extend(chunk)
+                continue
+            except FailedPrecondition:
+                pass
+            # A user in the batch was written after the read, so it fails as a whole; retry one by one
+            for entry in chunk:
+                single = self.db.batch()
+                clear(single.update, *entry)
+                try:
+                    single.commit()
+                    cleared.append(entry)
+                except FailedPrecondition:
+                    print(f"Skipped pruning the FCM token of {entry[0]}, the user changed since it was read")
+        stale = cleared
+        if self.on_pruned is not None:
+            for user_id, token, _ in stale:
+                self.on_pruned(user_id, token)
+
+        unsubscribed = self._unsubscribe_topics({uid: token for uid, token, _ in stale})
+        with self._lock:
+            self.pruned_count += len(stale)
+            self.skipped_count += len(latest) - len(stale)
+            self.unsubscribed_count += unsubscribed
+        if stale:
+            print(f"Pruned {len(stale)} stale FCM tokens")
+        return len(stale)
+
+    def _unsubscribe_topics(self, tokens_by_user):
+        # Find the live subscriptions still bound to each dead token, grouped by topic
+        by_topic = {}
+        collection = self.db.collection('topic_subscriptions')
+        for chunk in _chunks(list(tokens_by_user), MAX_IN_FILTER_VALUES):
+            for doc in collection.where('userId', 'in', chunk).stream():
+                record = doc.to_dict()
+                if record.get('status') == 'subscribed' and record.get('fcmToken') == tokens_by_user[record['userId']]:
+                    by_topic.setdefault(record['topic'], []).append(record['userId'])
+
+        records = []
+        for topic, user_ids in by_topic.items():
+            tokens = [tokens_by_user[uid] for uid in user_ids]
+            # The dead token is dropped either way, so per-token errors here are expected
+            manage_topic_subscriptions(self.messaging, user_ids, tokens, [topic], subscribe=False)
+            records.extend({
+                'userId': user_id,
+                'topic': topic,
+                'status': 'unsubscribed',
+                'unsubscribedAt': firestore.SERVER_TIMESTAMP,
+                'reason': 'stale-token',
+            } for user_id in user_ids)
+        write_subscription_records(self.db, records)
+        return len(records)
+
+    def _flush(self, records):
+        try:
+            self.prune(records)
+        except Exception as e:
+            print(f"Error pruning {len(records)} stale FCM tokens: {e}")
+            with self._lock:
+                self.failed_count += len(records)
+
+    def stats(self):
+        """Return queue depth and pruning counters"""
+        with self._lock:
+            return {
+                'queueDepth': self._queue.qsize(),
+                'pruned': self.pruned_count,
+                'skipped': self.skipped_count,
+                'unsubscribed': self.unsubscribed_count,
+                'failed': self.failed_count,
+                'dropped': self.dropped_count,
+            }
+
+
+def sweep_tokens(db, messaging, page_size=SWEEP_PAGE_SIZE, on_page=None):
+    """Validate every stored token with dry-run multicasts; returns (checked, stale entries)
+
+    Users are read page by page, fetching only fcmToken, and each page is
+    validated in parallel 500-token batches. on_page(checked, stale) is
+    called after each page.
+    """
+    checked = 0
+    stale = []
+    query = db.collection('users').select(['fcmToken']).order_by('__name__').limit(page_size)
+    last = None
+    while True:
+        page = list((query.start_after(last) if last is not None else query).stream())
+        if not page:
+            break
+        last = page[-1]
+        user_ids, tokens = [], []
+        for doc in page:
+            token = (doc.to_dict() or {}).get('fcmToken')
+            if token:
+                user_ids.append(doc.id)
+                tokens.append(token)
+        if tokens:
+            response = send_multicast_batched(
+                messaging, tokens, None, {'type': 'token-check'}, retries=2, dry_run=True
+            )
+            page_stale = stale_tokens(user_ids, tokens, response.responses)
+            stale.extend(page_stale)
+            checked += len(tokens)
+            if on_page is not None:
+                on_page(len(tokens), len(page_stale))
+        if len(page) < page_size:
+            break
+    return checked, stale
@@ -0,0 +1,96 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fanout import backoff_delay, is_transient_error, map_in_context
+from notification_log import MAX_BATCH_WRITES
+
+# FCM accepts at most 1000 registration tokens per topic management call
+FCM_TOPIC_BATCH_LIMIT = 1000
+TOPIC_MAX_WORKERS = 8
+TOPIC_NAME_PATTERN = re.compile(r'^[a-zA-Z0-9\-_.~%]{1,900}$')
+# Topic management error reasons meaning the token itself is dead
+INVALID_TOKEN_REASONS = {
+    'NOT_FOUND', 'INVALID_ARGUMENT',
+    'registration-token-not-registered', 'invalid-registration-token', 'invalid-argument',
+}
+
+
+def is_valid_topic(topic):
+    return isinstance(topic, str) and bool(TOPIC_NAME_PATTERN.match(topic))
+
+
+def subscription_id(user_id, topic):
+    """Deterministic topic_subscriptions document id for a user and topic"""
+    return f"{user_id}_{topic}"
+
+
+def _call_topic_api(messaging, tokens, topic, subscribe, retries):
+    call = messaging.subscribe_to_topic if subscribe else messaging.unsubscribe_from_topic
+    attempt = 0
+    while True:
+        try:
+            return call(tokens, topic)
+        except Exception as e:
+            if attempt < retries and is_transient_error(e):
+                attempt += 1
+                time.sleep(backoff_delay(attempt))
+                continue
+            raise
+
+
+def manage_topic_subscriptions(messaging, user_ids, tokens, topics, subscribe=True,
+                               batch_size=FCM_TOPIC_BATCH_LIMIT, max_workers=TOPIC_MAX_WORKERS,
+                               retries=2, on_chunk=None):
+    """Subscribe or unsubscribe aligned user_ids/tokens to every topic in chunked parallel IID calls
+
+    Returns a dict keyed by topic with success/failure counts, the user ids
+    that succeeded and per-user errors. on_chunk(topic, succeeded, failed)
+    is called as each chunk finishes.
+    """
+    batch_size = min(batch_size, FCM_TOPIC_BATCH_LIMIT)
+    work = [(topic, start) for topic in topics for start in range(0, len(tokens), batch_size)]
+
+    def run(item):
+        topic, start = item
+        chunk = tokens[start:start + batch_size]
+        chunk_users = user_ids[start:start + batch_size]
+        try:
+            response = _call_topic_api(messaging, chunk, topic, subscribe, retries)
+            failed = {error.index: error.reason for error in response.errors}
+        except Exception as e:
+            print(f"Topic {'subscribe' if subscribe else 'unsubscribe'} of {len(chunk)} tokens to {topic} failed: {e}")
+            failed = {index: str(e) for index in range(len(chunk))}
+        if on_chunk is not None:
+            on_chunk(topic, len(chunk) - len(failed), len(failed))
+        return topic, [
+            (chunk_users[i], chunk[i], failed.get(i)) for i in range(len(chunk))
+        ]
+
+    if len(work) <= 1:
+        outcomes = [run(item) for item in work]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(work))) as pool:
+            outcomes = map_in_context(pool, run, work)
+
+    results = {topic: {'succeeded': [], 'errors': []} for topic in topics}
+    for topic, entries in outcomes:
+        for user_id, token, reason in entries:
+            if reason is None:
+                results[topic]['succeeded'].append((user_id, token))
+            else:
+                results[topic]['errors'].append({'userId': user_id, 'fcmToken': token, 'reason': reason})
+    return results
+
+
+def write_subscription_records(db, records, batch_size=MAX_BATCH_WRITES):
+    """Merge-write {userId, topic, ...} records under deterministic ids with batched commits"""
+    collection = db.collection('topic_subscriptions')
+    written = 0
+    for start in range(0, len(records), batch_size):
+        batch = db.batch()
+        for record in records[start:start + batch_size]:
+            batch.set(collection.document(subscription_id(record['userId'], record['topic'])), record, merge=True)
+        batch.commit()
+        written += len(records[start:start + batch_size])
+    return written
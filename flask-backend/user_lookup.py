@@ -0,0 +1,64 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from fanout import map_in_context
+
+# Number of document references sent in a single get_all round trip
+LOOKUP_CHUNK_SIZE = 100
+# Upper bound on concurrent get_all calls for one lookup
+LOOKUP_MAX_WORKERS = 8
+
+TokenLookup = namedtuple('TokenLookup', ['user_ids', 'tokens', 'missing', 'without_token'])
+
+
+def _chunks(items, size):
+    """Split a list into consecutive slices of at most size items"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _fetch_chunk(db, user_ids):
+    """Fetch one chunk of user documents, reading only the fcmToken field"""
+    refs = [db.collection('users').document(user_id) for user_id in user_ids]
+    found = {}
+    for snapshot in db.get_all(refs, field_paths=['fcmToken']):
+        if snapshot.exists:
+            found[snapshot.id] = (snapshot.to_dict() or {}).get('fcmToken')
+    return found
+
+
+def resolve_fcm_tokens(db, user_ids, chunk_size=LOOKUP_CHUNK_SIZE, max_workers=LOOKUP_MAX_WORKERS, cache=None):
+    """Resolve FCM tokens for many users with concurrent chunked get_all calls
+
+    Returns a TokenLookup whose user_ids/tokens are aligned and keep the
+    request order; duplicate ids are looked up once. Ids without a user
+    document are listed in missing, users with no token in without_token.
+    When a TokenCache is given, only cache misses are read from Firestore
+    and the tokens fetched are added to it.
+    """
+    unique_ids = list(dict.fromkeys(uid for uid in user_ids if uid))
+
+    found = cache.get_many(unique_ids) if cache is not None else {}
+    chunks = _chunks([uid for uid in unique_ids if uid not in found], chunk_size)
+
+    fetched = {}
+    if len(chunks) == 1:
+        fetched.update(_fetch_chunk(db, chunks[0]))
+    elif chunks:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks))) as pool:
+            for result in map_in_context(pool, lambda chunk: _fetch_chunk(db, chunk), chunks):
+                fetched.update(result)
+    if cache is not None:
+        for user_id, token in fetched.items():
+            cache.put(user_id, token)
+    found.update(fetched)
+
+    lookup = TokenLookup([], [], [], [])
+    for user_id in unique_ids:
+        if user_id not in found:
+            lookup.missing.append(user_id)
+        elif not found[user_id]:
+            lookup.without_token.append(user_id)
+        else:
+            lookup.user_ids.append(user_id)
+            lookup.tokens.append(found[user_id])
+    return lookup
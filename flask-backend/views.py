@@ -0,0 +1,196 @@
+import threading
+import time
+
+# How often the watchdog looks for listeners that died without recovering
+WATCH_CHECK_INTERVAL = 5.0
+
+LOADING = 'loading'
+LIVE = 'live'
+RESYNCING = 'resyncing'
+STOPPED = 'stopped'
+
+
+class CollectionView:
+    """Mirrors one Firestore collection into in-memory views through an on_snapshot listener
+
+    apply(doc_id, data) is called for every changed document, with None for
+    a removal, and must update the views idempotently. When the listener dies
+    it is replaced by a new one; the fresh initial snapshot is applied over
+    the existing views and ids missing from it are removed, so reads keep
+    being served from memory while the view catches up.
+
+    A view warm started from a snapshot passes the ids it already holds and
+    the read time the snapshot was taken at; the first snapshot then only
+    applies documents written after that time, plus any it did not hold.
+    """
+
+    def __init__(self, collection, apply, on_synced=None):
+        self.collection = collection
+        self.apply = apply
+        self.on_synced = on_synced
+        self._ids = set()
+        self._watch = None
+        self._db = None
+        self._synced = False
+        self._since = None
+        self._lock = threading.Lock()
+        self.state = STOPPED
+        self.changes = 0
+        self.skipped = 0
+        self.resyncs = 0
+        self.last_update = None
+        self.last_read_time = None
+        self.last_resync = None
+        self.last_error = None
+
+    def start(self, db, known_ids=(), since=None):
+        """Subscribe to the collection on db; the first snapshot loads every document
+
+        known_ids are documents the views already hold as of since, in epoch
+        seconds; the first snapshot skips those not written after it.
+        """
+        self.stop()
+        with self._lock:
+            self._db = db
+            self._synced = False
+            self._ids.update(known_ids)
+            self._since = since
+            self.state = LOADING
+        self._subscribe()
+        return self
+
+    def _subscribe(self):
+        watch = self._db.collection(self.collection).on_snapshot(self._on_snapshot)
+        with self._lock:
+            self._watch = watch
+
+    def stop(self):
+        with self._lock:
+            watch, self._watch = self._watch, None
+            self.state = STOPPED
+        if watch is not None:
+            watch.unsubscribe()
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            initial = not self._synced
+            if initial:
+                # The first snapshot of a (re)subscription lists every document; anything else is gone
+                present = {doc.id for doc in docs}
+                removed = self._ids - present
+            for change in changes:
+                doc_id = change.document.id
+                if change.type.name == 'REMOVED':
+                    self._ids.discard(doc_id)
+                    self.apply(doc_id, None)
+                elif initial and doc_id in self._ids and self._unchanged_since_snapshot(change.document):
+                    self.skipped += 1
+                else:
+                    self._ids.add(doc_id)
+                    self.apply(doc_id, change.document.to_dict())
+            if initial:
+                for doc_id in removed:
+                    self._ids.discard(doc_id)
+                    self.apply(doc_id, None)
+                self._synced = True
+                self._since = None
+                self.state = LIVE
+            self.changes += len(changes)
+            self.last_update = time.time()
+            self.last_read_time = read_time
+        if initial and self.on_synced is not None:
+            self.on_synced()
+
+    def _unchanged_since_snapshot(self, document):
+        update_time = getattr(document, 'update_time', None)
+        return self._since is not None and update_time is not None and update_time.timestamp() <= self._since
+
+    def read_consistent(self, read):
+        """Run read() with no change being applied; returns (last read time, result), or (None, None) unless live"""
+        with self._lock:
+            if self.state != LIVE:
+                return None, None
+            return self.last_read_time, read()
+
+    def check(self):
+        """Resubscribe if the listener stopped streaming; returns True when a resync started"""
+        with self._lock:
+            watch = self._watch
+            if self.state == STOPPED:
+                return False
+            # No watch outside a resync means start() is still subscribing
+            if watch is None and self.state != RESYNCING:
+                return False
+            if watch is not None and getattr(watch, 'is_active', True):
+                return False
+            self._watch = None
+            self._synced = False
+            self.state = RESYNCING
+            self.resyncs += 1
+            self.last_resync = time.time()
+        print(f"Listener on {self.collection} stopped, resubscribing")
+        if watch is not None:
+            try:
+                watch.unsubscribe()
+            except Exception:
+                pass
+        try:
+            self._subscribe()
+        except Exception as e:
+            # Left without a watch; the next check tries again
+            with self._lock:
+                self.last_error = str(e)
+            print(f"Error resubscribing to {self.collection}: {e}")
+        return True
+
+    def stats(self):
+        """Consistency metadata: state, document count, last change, last read time and resyncs"""
+        with self._lock:
+            return {
+                'collection': self.collection,
+                'state': self.state,
+                'documents': len(self._ids),
+                'changes': self.changes,
+                'skipped': self.skipped,
+                'lastUpdate': self.last_update,
+                'lastReadTime': self.last_read_time.isoformat() if self.last_read_time is not None else None,
+                'ageSeconds': round(time.time() - self.last_update, 3) if self.last_update is not None else None,
+                'resyncs': self.resyncs,
+                'lastResync': self.last_resync,
+                'lastError': self.last_error,
+            }
+
+
+class ViewWatchdog:
+    """Background thread that periodically checks every view's listener and resubscribes dead ones"""
+
+    def __init__(self, views, interval=WATCH_CHECK_INTERVAL):
+        self.views = views
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='view-watchdog', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def check(self):
+        """Check every view once; returns how many were resubscribed"""
+        resynced = 0
+        for view in self.views:
+            try:
+                resynced += view.check()
+            except Exception as e:
+                print(f"Error checking {view.collection} listener: {e}")
+        return resynced
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
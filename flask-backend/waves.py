@@ -0,0 +1,204 @@
+import heapq
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+ACTIVE = 'active'
+FILLED = 'filled'
+EXHAUSTED = 'exhausted'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+# Each wave widens the search: (radius in km, include compatible groups)
+DEFAULT_WAVE_STEPS = ((5, False), (10, True), (25, True), (50, True), (100, True), (250, True))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS waves (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    wave INTEGER NOT NULL DEFAULT 0,
+    notified TEXT NOT NULL DEFAULT '[]',
+    history TEXT NOT NULL DEFAULT '[]',
+    failures INTEGER NOT NULL DEFAULT 0,
+    next_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS waves_pending ON waves (status, next_at);
+"""
+
+
+class WaveStore:
+    """SQLite table of escalating blood request dispatches, so a restart resumes them
+
+    wave is the index of the next wave to send and next_at when it is due;
+    next_at is cleared while a wave is being sent so only one process sends it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(_SCHEMA)
+
+    def create(self, payload, next_at=None):
+        """Persist a new active dispatch; returns its id"""
+        wave_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO waves (id, payload, status, next_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (wave_id, json.dumps(payload), ACTIVE, next_at, now, now)
+            )
+        return wave_id
+
+    def get(self, wave_id):
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM waves WHERE id = ?', (wave_id,)).fetchone()
+        if row is None:
+            return None
+        wave = dict(row)
+        for field in ('payload', 'notified', 'history'):
+            wave[field] = json.loads(wave[field])
+        return wave
+
+    def take_due(self, wave_id, now=None):
+        """Claim a due wave for sending; returns its index, or None if it is not due or already taken"""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    'SELECT wave FROM waves WHERE id = ? AND status = ? AND next_at IS NOT NULL AND next_at <= ?',
+                    (wave_id, ACTIVE, now)
+                ).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        'UPDATE waves SET next_at = NULL, updated_at = ? WHERE id = ?', (time.time(), wave_id)
+                    )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return row['wave'] if row is not None else None
+
+    def record_wave(self, wave_id, wave, next_wave, notified, summary, next_at=None, status=ACTIVE):
+        """Store a sent wave and when the next one is due; returns False if wave was already recorded"""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    'SELECT history FROM waves WHERE id = ? AND wave = ? AND status = ?', (wave_id, wave, ACTIVE)
+                ).fetchone()
+                if row is not None:
+                    history = json.loads(row['history'])
+                    if summary is not None:
+                        history.append(summary)
+                    self._conn.execute(
+                        'UPDATE waves SET status = ?, wave = ?, notified = ?, history = ?, failures = 0, next_at = ?, '
+                        'updated_at = ? WHERE id = ?',
+                        (status, next_wave, json.dumps(notified), json.dumps(history), next_at, time.time(), wave_id)
+                    )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return row is not None
+
+    def reschedule(self, wave_id, wave, next_at, max_failures):
+        """Retry a wave whose send failed at next_at, or mark the dispatch failed after max_failures"""
+        with self._lock:
+            self._conn.execute(
+                'UPDATE waves SET failures = failures + 1, '
+                'status = CASE WHEN failures + 1 >= ? THEN ? ELSE status END, '
+                'next_at = CASE WHEN failures + 1 >= ? THEN NULL ELSE ? END, updated_at = ? '
+                'WHERE id = ? AND wave = ? AND status = ?',
+                (max_failures, FAILED, max_failures, next_at, time.time(), wave_id, wave, ACTIVE)
+            )
+
+    def finish(self, wave_id, status):
+        """Stop an active dispatch; returns False if it had already stopped"""
+        with self._lock:
+            cursor = self._conn.execute(
+                'UPDATE waves SET status = ?, next_at = NULL, updated_at = ? WHERE id = ? AND status = ?',
+                (status, time.time(), wave_id, ACTIVE)
+            )
+        return cursor.rowcount == 1
+
+    def pending(self):
+        """(id, next_at) of every active dispatch waiting for its next wave"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT id, next_at FROM waves WHERE status = ? AND next_at IS NOT NULL', (ACTIVE,)
+            ).fetchall()
+        return [(row['id'], row['next_at']) for row in rows]
+
+    def counts(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT status, COUNT(*) FROM waves GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
+
+
+class WaveScheduler:
+    """Min-heap of (due time, key) served by one thread that calls fire(key) when each comes due
+
+    Entries are never removed; fire must ignore keys that are no longer due,
+    which lets a key be rescheduled by pushing it again.
+    """
+
+    def __init__(self, fire):
+        self.fire = fire
+        self._heap = []
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self.fired = 0
+
+    def __len__(self):
+        with self._wakeup:
+            return len(self._heap)
+
+    def schedule(self, key, due):
+        """Call fire(key) at the epoch time due"""
+        with self._wakeup:
+            heapq.heappush(self._heap, (due, key))
+            # Only an earlier deadline than the current head needs the thread to recompute its wait
+            if self._heap[0][1] == key:
+                self._wakeup.notify()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='wave-scheduler', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=10.0):
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                while not self._stopping and (not self._heap or self._heap[0][0] > time.time()):
+                    self._wakeup.wait(self._heap[0][0] - time.time() if self._heap else None)
+                if self._stopping:
+                    return
+                due = []
+                now = time.time()
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[1])
+            for key in due:
+                try:
+                    self.fire(key)
+                    self.fired += 1
+                except Exception as e:
+                    print(f"Error firing scheduled wave {key}: {e}")
@@ -0,0 +1,292 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from firebase_admin import exceptions
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+# The server keeps its job and wave stores next to JOBS_DB_PATH; it must be set before app is imported
+os.environ['JOBS_DB_PATH'] = os.path.join(tempfile.mkdtemp(prefix='test-app-'), 'jobs.sqlite3')
+os.environ.pop('NOTIFICATION_BACKEND', None)
+for name in ('TOKEN_SWEEP_INTERVAL_HOURS', 'NOTIFICATION_ROLLUP_INTERVAL_HOURS', 'DONOR_SNAPSHOT_INTERVAL_SECONDS'):
+    os.environ[name] = '0'
+os.environ['DONOR_PUSH_BURST'] = '1000'
+
+import app as server
+from cursors import encode_cursor
+from local_backend import LocalFirestore, LocalMessaging
+from waves import CANCELLED
+
+
+@pytest.fixture(scope='module', autouse=True)
+def background():
+    # Importing app starts nothing; only an explicit start_background() runs the workers
+    assert not server.background_started
+    assert not [t for t in threading.enumerate() if t.name.startswith('job-worker')]
+    server.init_backend(LocalFirestore(), LocalMessaging())
+    server.start_background()
+    yield
+    server.stop_background()
+
+
+@pytest.fixture
+def backend():
+    fs = LocalFirestore()
+    fs.seed('users', {f'u{n}': {'name': f'Donor {n}', 'fcmToken': f't{n}'} for n in range(5)})
+    fcm = LocalMessaging()
+    server.init_backend(fs, fcm)
+    yield fs, fcm, server.app.test_client()
+    server.stop_backend()
+
+
+def wait_for_job(client, job_id, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = client.get(f'/jobs/{job_id}').get_json()['job']
+        if job['status'] in ('succeeded', 'failed'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_sends_are_queued_as_jobs_unless_the_caller_waits(backend):
+    fs, fcm, client = backend
+    body = {'userId': 'u1', 'title': 'Hello', 'body': 'There'}
+
+    queued = client.post('/send-notification', json=body)
+    assert queued.status_code == 202
+    job_id = queued.get_json()['jobId']
+    assert queued.get_json()['statusUrl'] == f'/jobs/{job_id}'
+    job = wait_for_job(client, job_id)
+    assert (job['status'], job['httpStatus'], job['attempts']) == ('succeeded', 200, 1)
+    assert job['result']['success']
+
+    inline = client.post('/send-notification?wait=true', json=body)
+    assert inline.status_code == 200 and inline.get_json()['success']
+    missing = client.post('/send-notification?wait=true', json=dict(body, userId='nobody'))
+    assert missing.status_code == 404
+    assert client.get('/jobs/does-not-exist').status_code == 404
+    assert client.post('/send-notification', json={'userId': 'u1'}).status_code == 400
+    assert fcm.stats()['calls']['send'] == 2
+
+
+def test_single_send_prunes_dead_tokens_but_not_invalid_arguments(backend, monkeypatch):
+    fs, fcm, client = backend
+    pruned = []
+    monkeypatch.setattr(server.token_pruner, 'enqueue', pruned.append)
+    body = {'userId': 'u1', 'title': 'Hello', 'body': 'There'}
+
+    # On its own, INVALID_ARGUMENT may be the message's fault rather than the token's
+    def reject(message, dry_run=False, app=None):
+        raise exceptions.InvalidArgumentError('Invalid value at message.data')
+    monkeypatch.setattr(fcm, 'send', reject)
+    assert client.post('/send-notification?wait=true', json=body).status_code >= 400
+    assert pruned == []
+
+    monkeypatch.undo()
+    monkeypatch.setattr(server.token_pruner, 'enqueue', pruned.append)
+    fcm.invalid_tokens.add('t2')
+    assert client.post('/send-notification?wait=true', json=dict(body, userId='u2')).status_code >= 400
+    assert pruned == [('u2', 't2', 'UNREGISTERED')]
+
+
+def seed_notifications(fs):
+    # Three notifications share a sentAt, so paging must fall back to the document id
+    base = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    times = [base + timedelta(minutes=n) for n in (5, 4, 3, 3, 3, 2, 1)]
+    fs.seed('notifications', {
+        f'n{n}': {'userId': 'u1', 'title': f'T{n}', 'body': 'B', 'fcmToken': 't1', 'status': 'sent',
+                  'sentAt': DatetimeWithNanoseconds.fromisoformat(sent_at.isoformat())}
+        for n, sent_at in enumerate(times)
+    })
+    other = {'userId': 'u2', 'title': 'X', 'sentAt': DatetimeWithNanoseconds.now(timezone.utc)}
+    fs.seed('notifications', {'other': other})
+
+
+def test_notification_pages_follow_the_cursor_through_sent_at_ties(backend):
+    fs, fcm, client = backend
+    seed_notifications(fs)
+
+    ids = []
+    cursor = None
+    while True:
+        query = '/get-user-notifications?userId=u1&limit=2' + (f'&cursor={cursor}' if cursor else '')
+        page = client.get(query).get_json()
+        assert page['success'] and page['count'] == len(page['notifications']) <= 2
+        assert all('fcmToken' not in n for n in page['notifications'])
+        ids += [n['id'] for n in page['notifications']]
+        cursor = page['nextCursor']
+        assert page['hasMore'] == (cursor is not None)
+        if cursor is None:
+            break
+    # Newest first, ties ordered by descending id, nothing repeated or skipped across pages
+    assert ids == ['n0', 'n1', 'n4', 'n3', 'n2', 'n5', 'n6']
+
+
+def test_notification_cursor_and_fields_are_validated(backend):
+    fs, fcm, client = backend
+    seed_notifications(fs)
+    first = client.get('/get-user-notifications?userId=u1&limit=3').get_json()
+
+    assert client.get(f"/get-user-notifications?userId=u2&cursor={first['nextCursor']}").status_code == 400
+    assert client.get('/get-user-notifications?userId=u1&cursor=not-a-cursor').status_code == 400
+    assert client.get(f"/get-user-notifications?userId=u1&cursor={encode_cursor(['u1'])}").status_code == 400
+    assert client.get(f"/get-user-notifications?userId=u1&cursor={encode_cursor({'u': 'u1'})}").status_code == 400
+
+    projected = client.get('/get-user-notifications?userId=u1&limit=2&fields=title').get_json()
+    assert [sorted(n) for n in projected['notifications']] == [['id', 'sentAt', 'title']] * 2
+    assert projected['nextCursor'] and client.get(
+        f"/get-user-notifications?userId=u1&fields=title&cursor={projected['nextCursor']}").get_json()['count'] == 5
+    assert client.get('/get-user-notifications?userId=u1&fields=title,fcmToken').status_code == 400
+
+
+def test_undelivered_pushes_are_refunded_to_the_rate_limiter(backend):
+    fs, fcm, client = backend
+    refunded = server.donor_limiter.stats()['refunded']
+    fcm.invalid_tokens.add('t2')
+
+    response = client.post('/send-notification-to-multiple?wait=true',
+                           json={'userIds': ['u1', 'u2', 'u3'], 'title': 'Hello', 'body': 'There'})
+    assert response.status_code == 200 and response.get_json()['failureCount'] == 1
+    fcm.outage = True
+    assert client.post('/send-notification?wait=true',
+                       json={'userId': 'u1', 'title': 'Hello', 'body': 'There'}).status_code >= 500
+    assert server.donor_limiter.stats()['refunded'] == refunded + 2
+
+
+def test_queued_job_keeps_the_request_timeout_its_caller_sent(backend, monkeypatch):
+    fs, fcm, client = backend
+    body = {'userId': 'u1', 'title': 'Hello', 'body': 'There'}
+    lookup = server.get_user_fcm_token
+
+    def slow_lookup(user_id):
+        time.sleep(0.05)
+        return lookup(user_id)
+    monkeypatch.setattr(server, 'get_user_fcm_token', slow_lookup)
+
+    unbounded = client.post('/send-notification', json=body).get_json()['jobId']
+    assert 'deadlineAt' not in json.loads(server.job_queue.store.get(unbounded)['payload'])
+    # The send after the slow lookup is failed fast, and the retry finds the deadline gone
+    bounded = client.post('/send-notification', json=body, headers={'Request-Timeout': '0.01'}).get_json()['jobId']
+    job = wait_for_job(client, bounded)
+    assert (job['status'], job['httpStatus'], job['attempts']) == ('failed', 504, 2)
+    assert wait_for_job(client, unbounded)['status'] == 'succeeded'
+
+    # A retry carries a later deadline but is still the same request
+    headers = {'Request-Timeout': '30', 'Idempotency-Key': 'deadline-1'}
+    first = client.post('/send-notification', json=body, headers=headers).get_json()['jobId']
+    retry = client.post('/send-notification', json=body, headers=dict(headers, **{'Request-Timeout': '20'}))
+    assert retry.status_code == 202 and retry.get_json()['jobId'] == first
+    wait_for_job(client, first)
+
+
+def test_idempotency_key_replays_the_first_job_and_rejects_another_body(backend):
+    fs, fcm, client = backend
+    body = {'userIds': ['u1', 'u2'], 'title': 'Hello', 'body': 'There'}
+    headers = {'Idempotency-Key': 'retry-1'}
+
+    first = client.post('/send-notification-to-multiple', json=body, headers=headers)
+    retry = client.post('/send-notification-to-multiple', json=body, headers=headers)
+    assert first.status_code == retry.status_code == 202
+    assert retry.get_json()['jobId'] == first.get_json()['jobId'] and retry.get_json()['deduplicated']
+    wait_for_job(client, first.get_json()['jobId'])
+
+    conflict = client.post('/send-notification-to-multiple', json=dict(body, userIds=['u3']), headers=headers)
+    assert conflict.status_code == 422
+    assert client.post('/send-notification-to-multiple', json=body,
+                       headers={'Idempotency-Key': 'k' * 1000}).status_code == 400
+    assert fcm.stats()['calls']['send_each_for_multicast'] == 1
+
+
+def wave_backend(outage=False):
+    fs = LocalFirestore()
+    fs.seed('users', {
+        f'd{n}': {'fcmToken': f'dt{n}', 'bloodGroup': 'O+',
+                  'location': {'latitude': 13 + n * 0.001, 'longitude': 80.2}}
+        for n in range(10)
+    })
+    fs.seed('requests', {'r1': {'units': 5, 'donors': [], 'status': 'active'}, 'r2': {'units': 5, 'status': 'active'}})
+    fcm = LocalMessaging(outage=outage)
+    server.init_backend(fs, fcm)
+    return fs, fcm, server.app.test_client()
+
+
+def post_wave_request(client, request_id):
+    return client.post('/blood-request-notification?wait=true', json={
+        'bloodType': 'O+', 'location': 'Chennai', 'urgency': 'critical', 'requestId': request_id,
+        'coordinates': {'latitude': 13, 'longitude': 80.2}, 'waveSize': 3, 'waveIntervalSeconds': 0.2
+    })
+
+
+def wait_for_waves(wave_id, count, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        dispatch = server.wave_store.get(wave_id)
+        if len(dispatch['history']) >= count:
+            return dispatch
+        time.sleep(0.01)
+    raise AssertionError(f"dispatch {wave_id} did not send {count} waves")
+
+
+def test_failed_first_wave_is_rescheduled_instead_of_failing_the_request():
+    fs, fcm, client = wave_backend(outage=True)
+    try:
+        response = post_wave_request(client, 'r1')
+        # A 5xx would have the client resubmit and start a second dispatch
+        assert response.status_code == 202
+        result = response.get_json()
+        assert result['status'] == 'active' and result['mode'] == 'waves' and result['retryAt'] > time.time()
+        dispatch = server.wave_store.get(result['waveId'])
+        assert (dispatch['status'], dispatch['failures'], dispatch['history']) == ('active', 1, [])
+
+        fcm.outage = False
+        dispatch = wait_for_waves(result['waveId'], 1)
+        assert dispatch['history'][0]['successCount'] == 3 and len(dispatch['notified']) == 3
+    finally:
+        server.wave_store.finish(result['waveId'], CANCELLED)
+        server.stop_backend()
+
+
+def test_wave_failing_before_the_send_is_rescheduled(monkeypatch):
+    fs, fcm, client = wave_backend()
+    try:
+        wave_id = post_wave_request(client, 'r2').get_json()['waveId']
+
+        def unavailable(request_id):
+            raise RuntimeError('requests lookup failed')
+        monkeypatch.setattr(server, 'request_fill', unavailable)
+        # The claimed second wave must not be left active with no next_at
+        deadline = time.time() + 5
+        while server.wave_store.get(wave_id)['failures'] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        dispatch = server.wave_store.get(wave_id)
+        assert (dispatch['status'], dispatch['wave'], dispatch['failures']) == ('active', 1, 1)
+        assert dispatch['next_at'] is not None
+
+        monkeypatch.undo()
+        dispatch = wait_for_waves(wave_id, 2)
+        assert dispatch['failures'] == 0 and len(dispatch['notified']) == 6
+    finally:
+        server.wave_store.finish(wave_id, CANCELLED)
+        server.stop_backend()
+
+
+def test_duplicate_blood_requests_coalesce_into_one_send(backend):
+    fs, fcm, client = backend
+    body = {'bloodType': 'O+', 'location': 'Chennai', 'hospitalName': 'General', 'includeCompatible': False}
+    replayed = server.request_coalescer.stats()['replayed']
+
+    first = client.post('/blood-request-notification?wait=true', json=body)
+    duplicate = client.post('/blood-request-notification?wait=true', json=dict(body, hospitalName=' general '))
+    other = client.post('/blood-request-notification?wait=true', json=dict(body, requestId='r2'))
+    assert first.status_code == duplicate.status_code == other.status_code == 200
+    assert duplicate.get_json()['deduplicated'] and 'deduplicated' not in other.get_json()
+    assert fcm.stats()['calls']['send'] == 2
+    assert server.request_coalescer.stats()['replayed'] == replayed + 1
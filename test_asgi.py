@@ -0,0 +1,136 @@
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+os.environ.setdefault('JOBS_DB_PATH', os.path.join(tempfile.mkdtemp(prefix='test-asgi-'), 'jobs.sqlite3'))
+
+from flask import Flask, Response, request
+
+import app as server
+from asgi import LOOP_ROUTES, AsyncServer
+
+
+def call(application, method, path, chunks=(b'',), headers=(), on_send=None, chunk_delay=0.0):
+    """Drive one ASGI request; returns (status, response body messages)"""
+    async def run():
+        queue = asyncio.Queue()
+
+        async def feed():
+            for i, chunk in enumerate(chunks):
+                await queue.put({'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1})
+                await asyncio.sleep(chunk_delay)
+
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+            if on_send is not None:
+                await on_send(message)
+
+        scope = {
+            'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+            'headers': [(name.encode(), value.encode()) for name, value in headers],
+        }
+        feeder = asyncio.ensure_future(feed())
+        await application(scope, queue.get, send)
+        await feeder
+        return messages[0]['status'], [m for m in messages[1:] if m['body'] or not m['more_body']]
+    return run()
+
+
+def toy_app():
+    app = Flask('toy')
+    app.state = {'running': 0, 'peak': 0, 'threads': []}
+    lock = threading.Lock()
+
+    @app.route('/slow', methods=['GET'])
+    def slow():
+        with lock:
+            app.state['running'] += 1
+            app.state['peak'] = max(app.state['peak'], app.state['running'])
+        time.sleep(0.05)
+        with lock:
+            app.state['running'] -= 1
+        return 'ok'
+
+    @app.route('/upload', methods=['POST'])
+    def upload():
+        app.state['threads'].append(threading.current_thread().name)
+        size = 0
+        while True:
+            chunk = request.stream.read(1000)
+            if not chunk:
+                return str(size)
+            size += len(chunk)
+
+    @app.route('/stream', methods=['GET'])
+    def stream():
+        return Response(f'chunk{n}'.encode() for n in range(3))
+
+    return app
+
+
+def test_backend_calls_are_limited_to_the_concurrency_slots():
+    app = toy_app()
+    application = AsyncServer(app, max_concurrency=2)
+
+    async def burst():
+        return await asyncio.gather(*(call(application, 'GET', '/slow') for _ in range(6)))
+    results = asyncio.run(burst())
+
+    assert [status for status, _ in results] == [200] * 6
+    assert app.state['peak'] == 2
+    assert application.stats()['inFlight'] == application.stats()['waiting'] == 0
+
+
+def test_request_bodies_are_read_before_taking_a_slot():
+    app = toy_app()
+    application = AsyncServer(app, max_concurrency=1, max_buffered_body=100)
+
+    async def run():
+        # The only slot stays free while a slow client sends its small body
+        slow_upload = asyncio.ensure_future(call(application, 'POST', '/upload', [b'x' * 10] * 5, chunk_delay=0.05))
+        await asyncio.sleep(0.02)
+        assert application.stats()['inFlight'] == 0
+        started = time.monotonic()
+        assert (await call(application, 'GET', '/slow'))[0] == 200
+        assert time.monotonic() - started < 0.2
+        # A body over the buffer limit is streamed to the route on the upload threads
+        large = await call(application, 'POST', '/upload', [b'y' * 60] * 5)
+        return await slow_upload, large
+    (status, body), (large_status, large_body) = asyncio.run(run())
+
+    assert (status, body[0]['body']) == (200, b'50')
+    assert (large_status, large_body[0]['body']) == (200, b'300')
+    assert sorted(name.split('_')[0] for name in app.state['threads']) == ['asgi-backend', 'asgi-upload']
+    assert application.stats()['streamingUploads'] == 0
+
+
+def test_streamed_responses_release_the_slot_between_chunks():
+    application = AsyncServer(toy_app(), max_concurrency=1)
+    slots_held = []
+
+    async def on_send(message):
+        slots_held.append(application.stats()['inFlight'])
+
+    status, body = asyncio.run(call(application, 'GET', '/stream', on_send=on_send))
+    assert status == 200
+    assert [m['body'] for m in body] == [b'chunk0', b'chunk1', b'chunk2', b'']
+    assert set(slots_held) == {0}
+
+
+def test_loop_routes_answer_while_every_slot_is_taken():
+    assert ('GET', '/health') in LOOP_ROUTES
+    application = AsyncServer(server.app, max_concurrency=1)
+
+    async def run():
+        application._create_semaphores()
+        await application._semaphore.acquire()
+        return await asyncio.wait_for(call(application, 'GET', '/health'), timeout=2)
+    status, body = asyncio.run(run())
+    assert status == 200 and b'healthy' in body[0]['body']
@@ -0,0 +1,48 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from blood_compat import BLOOD_GROUPS, CompatibilityIndex, eligible_donor_groups, is_compatible
+
+# Same table as bloodGroupCompatibility in src/screens/CreateRequestScreen.js
+CAN_DONATE_TO = {
+    'O-': ['O-', 'O+', 'A-', 'A+', 'B-', 'B+', 'AB-', 'AB+'],
+    'O+': ['O+', 'A+', 'B+', 'AB+'],
+    'A-': ['A-', 'A+', 'AB-', 'AB+'],
+    'A+': ['A+', 'AB+'],
+    'B-': ['B-', 'B+', 'AB-', 'AB+'],
+    'B+': ['B+', 'AB+'],
+    'AB-': ['AB-', 'AB+'],
+    'AB+': ['AB+'],
+}
+
+
+def test_matrix_matches_app_table():
+    for donor in BLOOD_GROUPS:
+        for recipient in BLOOD_GROUPS:
+            assert is_compatible(donor, recipient) == (recipient in CAN_DONATE_TO[donor])
+
+
+def test_eligible_donor_groups():
+    assert eligible_donor_groups('ab+') == frozenset(BLOOD_GROUPS)
+    assert eligible_donor_groups('O-') == frozenset({'O-'})
+    assert eligible_donor_groups('A+') == frozenset({'O-', 'O+', 'A-', 'A+'})
+    assert eligible_donor_groups('XYZ') == frozenset()
+
+
+def test_index_tracks_group_changes():
+    index = CompatibilityIndex()
+    index.apply_user('u1', {'bloodGroup': 'O-'})
+    index.apply_user('u2', {'bloodGroup': 'B+'})
+    index.apply_user('u3', {'bloodGroup': 'A+', 'isAvailable': False})
+
+    assert index.eligible_donors('B+') == {'u1', 'u2'}
+    assert index.eligible_donors('A-') == {'u1'}
+
+    index.apply_user('u2', {'bloodGroup': 'A-'})
+    index.apply_user('u1', None)
+
+    assert index.eligible_donors('B+') == set()
+    assert index.eligible_donors('AB+') == {'u2'}
+    assert index.stats()['byBloodGroup']['A-'] == 1
@@ -0,0 +1,101 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from bulk_users import (MAX_REPORTED_ERRORS, InvalidUpload, export_users, import_users, parse_csv, parse_ndjson,
+                        to_ndjson)
+from local_backend import LocalFirestore
+
+
+def ndjson(*lines):
+    return io.BytesIO('\n'.join(lines).encode('utf-8'))
+
+
+def test_parsers_stream_rows_with_line_numbers_and_validation_reports_each_bad_row():
+    db = LocalFirestore()
+    rows = parse_ndjson(ndjson(
+        '{"userId": "a", "bloodGroup": " ab- ", "location": {"latitude": 13.0, "longitude": 80.2}, "age": "31"}',
+        '',
+        '{"userId": "b", "bloodGroup": "X"}',
+        '{not json',
+        '["a list"]',
+        '{"userId": "c/d"}',
+        '{"userId": "e", "shoeSize": 9}',
+        '{"userId": "f", "isAvailable": "no", "lastDonation": "2026-05-01", "donationCount": 2.5}',
+    ))
+    summary = import_users(db, rows)
+    assert (summary['rowCount'], summary['importedCount'], summary['invalidCount']) == (7, 1, 6)
+    assert [(error['line'], error['userId']) for error in summary['errors']] == [
+        (3, 'b'), (4, None), (5, None), (6, 'c/d'), (7, 'e'), (8, 'f')
+    ]
+    assert 'donationCount' in summary['errors'][-1]['error'] and 'shoeSize' in summary['errors'][-2]['error']
+    user = db.collection('users').document('a').get().to_dict()
+    assert user['bloodGroup'] == 'AB-' and user['age'] == 31 and user['location'] == {'latitude': 13.0, 'longitude': 80.2}
+
+    csv_rows = list(parse_csv(io.BytesIO(
+        b'\xef\xbb\xbfuserId,name,isAvailable,latitude,longitude\r\nu1,Anu,yes,13.1,80.3\r\nu2,,,,\r\nu3,x,y,1,2,extra\r\n'
+        b'u4,\xff\xfe,,,\r\nu5,Bala,,,\r\n'
+    )))
+    assert csv_rows[0] == (2, {'userId': 'u1', 'name': 'Anu', 'isAvailable': 'yes',
+                               'location': {'latitude': '13.1', 'longitude': '80.3'}}, None)
+    assert csv_rows[1] == (3, {'userId': 'u2'}, None)
+    assert csv_rows[2][2] == "Row has more cells than the header"
+    # Bytes that are not UTF-8 spoil only their own row
+    assert csv_rows[3] == (5, None, "Row is not valid UTF-8")
+    assert csv_rows[4] == (6, {'userId': 'u5', 'name': 'Bala'}, None)
+    with pytest.raises(InvalidUpload):
+        list(parse_csv(io.BytesIO(b'userId,password\r\nu1,secret\r\n')))
+    with pytest.raises(InvalidUpload):
+        list(parse_csv(io.BytesIO(b'user\xffId,name\r\nu1,x\r\n')))
+
+
+def test_import_merges_in_chunks_reports_progress_and_counts_failed_writes():
+    db = LocalFirestore()
+    db.seed('users', {'u1': {'name': 'Old', 'createdAt': 'kept', 'fcmToken': 'old-token'}})
+    apply = db._apply
+
+    def failing_apply(writes):
+        if any(reference.id == 'u13' for _, reference, _, _ in writes):
+            raise RuntimeError('permission denied')
+        apply(writes)
+
+    db._apply = failing_apply
+    lines = [f'{{"userId": "u{n}", "name": "Donor {n}", "fcmToken": "t{n}"}}' for n in range(1, 26)]
+    lines += ['{"userId": ""}'] * (MAX_REPORTED_ERRORS + 5)
+    progress = []
+    summary = import_users(db, parse_ndjson(ndjson(*lines)), chunk_size=10, on_progress=progress.append)
+
+    assert (summary['importedCount'], summary['failedCount'], summary['invalidCount']) == (24, 1, MAX_REPORTED_ERRORS + 5)
+    assert summary['errors'][0] == {'line': 13, 'userId': 'u13', 'error': 'permission denied'}
+    assert len(summary['errors']) == MAX_REPORTED_ERRORS and summary['errorsTruncated']
+    assert [p['importedCount'] for p in progress] == [10, 19, 24]
+    user = db.collection('users').document('u1').get().to_dict()
+    assert (user['name'], user['createdAt'], user['fcmToken']) == ('Donor 1', 'kept', 't1')
+    assert 'lastTokenUpdate' in user and 'updatedAt' in user
+    assert db.stats()['calls']['bulk_commit'] == 3
+
+
+def test_export_pages_through_users_in_the_format_the_import_reads():
+    db = LocalFirestore()
+    db.seed('users', {
+        f'u{n:02d}': {'name': f'Donor {n}', 'bloodGroup': 'O+', 'fcmToken': f't{n}', 'lastDonation': None,
+                      'location': {'latitude': 13.0, 'longitude': 80.2}, 'isAvailable': n % 2 == 0,
+                      'lastTokenUpdate': 'not exported'}
+        for n in range(7)
+    })
+    records = list(export_users(db, page_size=3))
+    assert [record['userId'] for record in records] == [f'u{n:02d}' for n in range(7)]
+    assert records[1] == {'userId': 'u01', 'name': 'Donor 1', 'bloodGroup': 'O+', 'isAvailable': False,
+                          'location': {'latitude': 13.0, 'longitude': 80.2}}
+    assert db.stats()['calls']['query'] == 3
+
+    copy = LocalFirestore()
+    exported = ''.join(to_ndjson(record) for record in export_users(db, include_tokens=True))
+    summary = import_users(copy, parse_ndjson(io.BytesIO(exported.encode('utf-8'))))
+    assert (summary['importedCount'], summary['errors']) == (7, [])
+    restored = copy.collection('users').document('u03').get().to_dict()
+    assert (restored['fcmToken'], restored['isAvailable']) == ('t3', False)
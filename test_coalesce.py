@@ -0,0 +1,68 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+import pytest
+
+from coalesce import IdempotencyConflict, RequestCoalescer, request_fingerprint
+
+
+def test_concurrent_duplicates_share_one_execution():
+    coalescer = RequestCoalescer(window=60)
+    release = threading.Event()
+    calls = []
+
+    def send():
+        calls.append(1)
+        release.wait(5)
+        return {'status': 200}
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(coalescer.execute(send, 'fp', coalesce_key='O+|gh')))
+        for _ in range(6)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(how or 'ran' for _, how in results) == ['joined'] * 5 + ['ran']
+    assert coalescer.execute(send, 'other', coalesce_key='O+|gh') == ({'status': 200}, 'replayed')
+    assert coalescer.stats()['executed'] == 1
+
+
+def test_window_expiry_and_failed_outcomes_run_again():
+    coalescer = RequestCoalescer(window=0.05, is_reusable=lambda outcome: outcome['status'] < 500)
+    statuses = iter([500, 200, 200])
+
+    def send():
+        return {'status': next(statuses)}
+
+    assert coalescer.execute(send, 'fp', coalesce_key='k') == ({'status': 500}, None)
+    assert coalescer.execute(send, 'fp', coalesce_key='k') == ({'status': 200}, None)
+    assert coalescer.execute(send, 'fp', coalesce_key='k') == ({'status': 200}, 'replayed')
+    time.sleep(0.06)
+    assert coalescer.execute(send, 'fp', coalesce_key='k') == ({'status': 200}, None)
+    coalescer.clear()
+    assert coalescer.execute(lambda: {'status': 201}, 'fp', coalesce_key='k') == ({'status': 201}, None)
+
+
+def test_idempotency_key_replays_and_rejects_a_different_body():
+    coalescer = RequestCoalescer(window=60)
+    first = request_fingerprint('send', {'userId': 'u1', 'timestamp': '1'}, ignore=('timestamp',))
+    retry = request_fingerprint('send', {'userId': 'u1', 'timestamp': '2'}, ignore=('timestamp',))
+    other = request_fingerprint('send', {'userId': 'u2'})
+    assert first == retry != other
+
+    assert coalescer.execute(lambda: {'jobId': 'a'}, first, idempotency_key='key-1') == ({'jobId': 'a'}, None)
+    assert coalescer.execute(lambda: {'jobId': 'b'}, retry, idempotency_key='key-1') == ({'jobId': 'a'}, 'replayed')
+    with pytest.raises(IdempotencyConflict):
+        coalescer.execute(lambda: {'jobId': 'c'}, other, idempotency_key='key-1')
+    assert coalescer.stats()['conflicts'] == 1
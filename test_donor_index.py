@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from donor_index import DonorIndex
+from geo import encode_geohash, haversine_km
+
+
+def donor(lat, lon, blood_group='O+', token='tok', **extra):
+    data = {'location': {'latitude': lat, 'longitude': lon}, 'bloodGroup': blood_group, 'fcmToken': token}
+    data.update(extra)
+    return data
+
+
+def test_encode_geohash_matches_reference():
+    assert encode_geohash(57.64911, 10.40744, 11) == 'u4pruydqqvj'
+
+
+def test_nearest_returns_closest_donors_within_radius():
+    index = DonorIndex()
+    index.upsert('near', donor(13.0827, 80.2707))
+    index.upsert('mid', donor(13.1500, 80.2700))
+    index.upsert('far', donor(12.9716, 77.5946))
+    index.upsert('wrong-type', donor(13.0830, 80.2710, blood_group='B-'))
+    index.upsert('busy', donor(13.0828, 80.2708, isAvailable=False))
+    index.upsert('no-token', donor(13.0828, 80.2708, token=None))
+    index.upsert('no-location', donor(0, 0))
+
+    result = index.nearest(13.0827, 80.2707, 25, 10, blood_groups={'O+'})
+
+    assert [d.user_id for _, d in result] == ['near', 'mid']
+    assert len(index) == 6
+
+
+def test_nearest_honours_limit_and_exclusions():
+    index = DonorIndex()
+    for i in range(50):
+        index.upsert(f'd{i}', donor(13.0 + i * 0.001, 80.0))
+
+    result = index.nearest(13.0, 80.0, 50, 5, exclude={'d0'})
+
+    assert [d.user_id for _, d in result] == ['d1', 'd2', 'd3', 'd4', 'd5']
+
+
+def test_large_radius_and_updates():
+    index = DonorIndex()
+    index.upsert('a', donor(13.0, 80.0))
+    assert index.nearest(19.07, 72.87, 1500, 10)
+
+    index.upsert('a', donor(28.6, 77.2))
+    assert index.nearest(13.0, 80.0, 50, 10) == []
+    index.remove('a')
+    assert len(index) == 0
+
+
+def test_nearest_is_fast_on_large_index():
+    index = DonorIndex()
+    for i in range(100000):
+        index.upsert(f'd{i}', donor(8 + (i % 317) * 0.07, 68 + (i // 317) * 0.09))
+
+    started = time.perf_counter()
+    result = index.nearest(13.0827, 80.2707, 10, 50)
+    elapsed = time.perf_counter() - started
+
+    assert all(distance <= 10 for distance, _ in result)
+    assert all(haversine_km(13.0827, 80.2707, d.lat, d.lon) <= 10 for _, d in result)
+    assert elapsed < 0.05
@@ -0,0 +1,89 @@
+import os
+import sys
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from donor_match import DonorTable, NotifiedCounts, parse_donation_time, request_donor_ids
+from geo import haversine_km
+
+NOW = datetime(2026, 6, 1, tzinfo=timezone.utc).timestamp()
+
+
+def donor(lat, lon, group='O-', **extra):
+    data = {'location': {'latitude': lat, 'longitude': lon}, 'bloodGroup': group, 'fcmToken': 'token'}
+    data.update(extra)
+    return data
+
+
+def test_match_filters_by_compatibility_eligibility_and_radius():
+    table = DonorTable(capacity=2)
+    table.upsert('near', donor(13.01, 80.2))
+    table.upsert('recent', donor(13.01, 80.2, lastDonation='2026-05-01'))
+    table.upsert('old-donation', donor(13.02, 80.2, lastDonation=datetime(2025, 12, 1)))
+    table.upsert('wrong-group', donor(13.01, 80.2, group='A+'))
+    table.upsert('unavailable', donor(13.01, 80.2, isAvailable=False))
+    table.upsert('no-token', donor(13.01, 80.2, fcmToken=None))
+    table.upsert('far', donor(14.5, 80.2))
+    table.upsert('no-location', {'bloodGroup': 'O-', 'fcmToken': 'token'})
+
+    matches = table.match(13.0, 80.2, 25, 'O-', 10, now=NOW)
+    assert [m.user_id for m in matches] == ['near', 'old-donation']
+    assert abs(matches[0].distance_km - haversine_km(13.0, 80.2, 13.01, 80.2)) < 1e-6
+    assert len(table) == 7 and table.capacity == 8
+    assert table.match(13.0, 80.2, 25, 'AB+', 10, now=NOW, exclude={'near'})[0].user_id == 'wrong-group'
+    assert table.match(13.0, 80.2, 25, 'XX', 10, now=NOW) == []
+
+
+def test_accept_history_raises_the_rank_of_responsive_donors():
+    table = DonorTable()
+    table.upsert('closest', donor(13.001, 80.2))
+    table.upsert('responsive', donor(13.05, 80.2))
+    assert [m.user_id for m in table.match(13.0, 80.2, 25, 'O+', 2, now=NOW)] == ['closest', 'responsive']
+
+    table.record_notified(['closest', 'responsive'] * 4)
+    for n in range(4):
+        table.apply_request(f'r{n}', {'donors': ['responsive'] if n % 2 else [{'userId': 'responsive', 'units': 1}]})
+    ranked = table.match(13.0, 80.2, 25, 'O+', 2, now=NOW)
+    assert [m.user_id for m in ranked] == ['responsive', 'closest']
+    assert round(ranked[0].accept_rate, 4) == 0.625 and round(ranked[1].accept_rate, 4) == 0.125
+
+    # Removing requests takes their acceptances back
+    for n in range(4):
+        table.apply_request(f'r{n}', None)
+    assert [m.user_id for m in table.match(13.0, 80.2, 25, 'O+', 1, now=NOW)] == ['closest']
+
+
+def test_restarted_table_keeps_accept_rates_from_persisted_push_counts(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    counts = NotifiedCounts(path)
+    table = DonorTable()
+    table.upsert('responsive', donor(13.05, 80.2))
+    for n in range(2):
+        table.record_notified(['responsive', 'responsive'])
+        counts.add(['responsive', 'responsive'])
+        table.apply_request(f'r{n}', {'donors': ['responsive']})
+    before = table.match(13.0, 80.2, 25, 'O+', 1, now=NOW)[0].accept_rate
+
+    # A new process counts the acceptances again from the requests listener and restores the pushes
+    restarted = DonorTable()
+    restarted.restore_notified(NotifiedCounts(path).load())
+    restarted.upsert('responsive', donor(13.05, 80.2))
+    for n in range(2):
+        restarted.apply_request(f'r{n}', {'donors': ['responsive']})
+    assert NotifiedCounts(path).load() == {'responsive': 4}
+    assert restarted.match(13.0, 80.2, 25, 'O+', 1, now=NOW)[0].accept_rate == before == 0.375
+
+
+def test_removed_rows_are_reused_and_helpers_parse_app_data():
+    table = DonorTable()
+    table.upsert('a', donor(13.0, 80.2))
+    table.upsert('b', donor(13.0, 80.2))
+    table.apply_user('a', None)
+    table.upsert('c', donor(13.0, 80.2))
+    assert table.stats()['donors'] == 2 and table._size == 2
+    assert sorted(m.user_id for m in table.match(13.0, 80.2, 5, 'O-', 5, now=NOW)) == ['b', 'c']
+
+    assert parse_donation_time('2026-01-01') == datetime(2026, 1, 1, tzinfo=timezone.utc).timestamp()
+    assert parse_donation_time('not a date') is None and parse_donation_time(None) is None
+    assert request_donor_ids({'donors': ['u1', {'userId': 'u2'}, {}, None]}) == {'u1', 'u2'}
@@ -0,0 +1,77 @@
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from firebase_admin import messaging
+
+from fanout import send_multicast_batched
+from resilience import AdaptiveLimit, BackendUnavailable, CircuitBreaker, Dependency, deadline_scope
+
+
+def make_messaging(fail_tokens=(), fail_batch_with=None):
+    sent = []
+    lock = threading.Lock()
+
+    def send_each_for_multicast(message):
+        with lock:
+            sent.append(list(message.tokens))
+        if fail_batch_with and fail_batch_with in message.tokens:
+            raise RuntimeError('batch failed')
+        return messaging.BatchResponse([
+            messaging.SendResponse(None, ValueError('bad token')) if token in fail_tokens
+            else messaging.SendResponse({'name': f'msg-{token}'}, None)
+            for token in message.tokens
+        ])
+
+    fake = SimpleNamespace(
+        MulticastMessage=messaging.MulticastMessage,
+        SendResponse=messaging.SendResponse,
+        BatchResponse=messaging.BatchResponse,
+        send_each_for_multicast=send_each_for_multicast,
+    )
+    return fake, sent
+
+
+def test_send_multicast_batched_keeps_token_order():
+    fake, sent = make_messaging(fail_tokens={'t3', 't1200'})
+    tokens = [f't{i}' for i in range(1234)]
+    response = send_multicast_batched(fake, tokens, messaging.Notification(title='x', body='y'))
+
+    assert sorted(len(batch) for batch in sent) == [234, 500, 500]
+    assert len(response.responses) == 1234
+    assert response.success_count == 1232
+    assert response.failure_count == 2
+    assert response.responses[5].message_id == 'msg-t5'
+    assert not response.responses[1200].success
+
+
+def test_send_multicast_batched_isolates_failed_batch():
+    fake, _ = make_messaging(fail_batch_with='t0')
+    tokens = [f't{i}' for i in range(600)]
+    response = send_multicast_batched(fake, tokens, messaging.Notification(title='x', body='y'))
+
+    assert response.failure_count == 500
+    assert response.success_count == 100
+
+
+def test_batches_sent_from_the_pool_keep_the_request_deadline():
+    dependency = Dependency('fcm', CircuitBreaker(), AdaptiveLimit(10))
+
+    def send_each_for_multicast(message):
+        with dependency.call():
+            time.sleep(0.1)
+        return messaging.BatchResponse([messaging.SendResponse({'name': 'm'}, None) for _ in message.tokens])
+    fake, _ = make_messaging()
+    fake.send_each_for_multicast = send_each_for_multicast
+
+    # Two workers send two batches at a time; the third pair starts after the deadline has passed
+    with deadline_scope(0.15):
+        response = send_multicast_batched(fake, [f't{i}' for i in range(6)], messaging.Notification(title='x'),
+                                          batch_size=1, max_workers=2)
+    assert [r.success for r in response.responses] == [True] * 4 + [False] * 2
+    assert all(isinstance(r.exception, BackendUnavailable) for r in response.responses[4:])
+    assert dependency.stats()['rejected']['deadline'] == 2
@@ -0,0 +1,113 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from firebase_admin import exceptions
+
+from jobs import JobQueue, JobStore
+
+
+def wait_for(queue, job_id, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = queue.status(job_id)
+        if job['status'] in ('succeeded', 'failed'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_job_retries_transient_errors(tmp_path):
+    queue = JobQueue(JobStore(str(tmp_path / 'jobs.db')), workers=2, base_delay=0.01, max_delay=0.02,
+                     poll_interval=0.01)
+    calls = []
+
+    def handler(payload, progress):
+        calls.append(payload)
+        if len(calls) < 3:
+            raise exceptions.UnavailableError('fcm down')
+        progress.update(batchesDone=1)
+        return {'success': True, 'value': payload['value']}, 200
+
+    queue.register('echo', handler)
+    queue.start()
+    try:
+        job = wait_for(queue, queue.submit('echo', {'value': 7}))
+    finally:
+        queue.stop()
+
+    assert job['status'] == 'succeeded'
+    assert job['attempts'] == 3
+    assert job['result'] == {'success': True, 'value': 7}
+    assert job['progress'] == {'batchesDone': 1}
+
+
+def test_job_fails_on_permanent_error_and_client_errors(tmp_path):
+    queue = JobQueue(JobStore(str(tmp_path / 'jobs.db')), workers=1, poll_interval=0.01)
+    queue.register('broken', lambda payload, progress: 1 / 0)
+    queue.register('missing', lambda payload, progress: ({'error': 'User not found'}, 404))
+    queue.start()
+    try:
+        broken = wait_for(queue, queue.submit('broken', {}))
+        missing = wait_for(queue, queue.submit('missing', {}))
+    finally:
+        queue.stop()
+
+    assert broken['status'] == 'failed'
+    assert broken['attempts'] == 1
+    assert missing['status'] == 'failed'
+    assert missing['httpStatus'] == 404
+    assert missing['error'] == 'User not found'
+
+
+def test_jobs_survive_restart(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    first = JobQueue(JobStore(path))
+    first.register('echo', lambda payload, progress: (payload, 200))
+    job_id = first.submit('echo', {'value': 1})
+
+    second = JobQueue(JobStore(path), workers=1, poll_interval=0.01)
+    second.register('echo', lambda payload, progress: (payload, 200))
+    second.start()
+    try:
+        job = wait_for(second, job_id)
+    finally:
+        second.stop()
+
+    assert job['result'] == {'value': 1}
+
+
+def test_running_jobs_keep_their_lease_and_exhausted_ones_fail_on_reclaim(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.db'), lease_seconds=0.15)
+    queue = JobQueue(store, workers=1, poll_interval=0.01)
+    release = threading.Event()
+    runs = []
+
+    def slow(payload, progress):
+        runs.append(1)
+        release.wait(5)
+        return {'success': True}, 200
+
+    queue.register('slow', slow)
+    queue.start()
+    try:
+        job_id = queue.submit('slow', {})
+        # Several leases' worth of time, yet no other claim may take the job
+        time.sleep(0.5)
+        assert store.claim() is None
+        release.set()
+        job = wait_for(queue, job_id)
+    finally:
+        queue.stop()
+    assert (job['status'], job['attempts'], len(runs)) == ('succeeded', 1, 1)
+
+    # A worker died during the last attempt: the job fails instead of running again
+    dead_id = store.insert('slow', {}, max_attempts=1)
+    assert store.claim()['id'] == dead_id
+    time.sleep(0.2)
+    assert store.claim() is None
+    job = store.get(dead_id)
+    assert job['status'] == 'failed' and job['attempts'] == 1 and 'last attempt' in job['error']
@@ -0,0 +1,92 @@
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta, timezone
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend')
+sys.path.insert(0, BACKEND_DIR)
+
+from firebase_admin import firestore, messaging
+
+from fanout import send_multicast_batched
+from local_backend import LocalFirestore, LocalMessaging
+from notification_log import NotificationLogWriter
+
+
+def test_query_filters_orders_and_resumes_after_cursor():
+    db = LocalFirestore()
+    now = datetime.now(timezone.utc)
+    db.seed('notifications', {
+        f'n{i}': {'userId': 'u1' if i % 2 == 0 else 'u2', 'sentAt': now - timedelta(minutes=i // 2), 'title': str(i)}
+        for i in range(10)
+    })
+    query = (db.collection('notifications').where('userId', '==', 'u1')
+             .order_by('sentAt', direction=firestore.Query.DESCENDING)
+             .order_by('__name__', direction=firestore.Query.DESCENDING))
+
+    first = list(query.select(['title', 'sentAt']).limit(3).stream())
+    assert [doc.id for doc in first] == ['n0', 'n2', 'n4']
+    assert set(first[0].to_dict()) == {'title', 'sentAt'}
+
+    last = first[-1].to_dict()
+    rest = list(query.start_after({'sentAt': last['sentAt'], '__name__': first[-1].id}).stream())
+    assert [doc.id for doc in rest] == ['n6', 'n8']
+    assert db.stats()['calls'] == {'query': 2}
+
+
+def test_writes_resolve_server_timestamps_and_reach_listeners():
+    db = LocalFirestore()
+    db.seed('users', {'u1': {'fcmToken': 't1'}})
+    seen = []
+    watch = db.collection('users').on_snapshot(
+        lambda docs, changes, read_time: seen.extend((c.type.name, c.document.id) for c in changes)
+    )
+    db.collection('users').document('u1').set({'updatedAt': firestore.SERVER_TIMESTAMP}, merge=True)
+    db.collection('users').document('u2').set({'fcmToken': 't2'})
+    watch.unsubscribe()
+    db.collection('users').document('u3').set({'fcmToken': 't3'})
+
+    assert seen == [('ADDED', 'u1'), ('MODIFIED', 'u1'), ('ADDED', 'u2')]
+    user = db.collection('users').document('u1').get().to_dict()
+    assert user['fcmToken'] == 't1' and user['updatedAt'].tzinfo is not None
+    tokens = {doc.id: doc.to_dict() for doc in db.get_all(
+        [db.collection('users').document(i) for i in ('u1', 'u2', 'nope')], field_paths=['fcmToken']
+    )}
+    assert tokens == {'u1': {'fcmToken': 't1'}, 'u2': {'fcmToken': 't2'}, 'nope': None}
+
+    writer = NotificationLogWriter(db, batch_size=2).start()
+    writer.enqueue_many([{'userId': 'u1', 'sentAt': firestore.SERVER_TIMESTAMP} for _ in range(5)])
+    writer.stop()
+    assert db.stats()['calls']['commit'] == 3
+    assert db.stats()['documents']['notifications'] == 5
+
+
+def test_messaging_failure_rate_and_call_counts():
+    fcm = LocalMessaging(failure_rate=0.5, seed=3)
+    tokens = [f't{i}' for i in range(1200)]
+    response = send_multicast_batched(fcm, tokens, messaging.Notification(title='t', body='b'))
+
+    assert len(response.responses) == 1200
+    assert 400 < response.failure_count < 800
+    stats = fcm.stats()
+    assert stats['calls'] == {'send_each_for_multicast': 3}
+    assert stats['delivered'] == response.success_count
+    assert stats['failures'] == response.failure_count
+
+
+def test_benchmark_emits_json_report(tmp_path):
+    env = dict(os.environ, JOBS_DB_PATH=str(tmp_path / 'jobs.sqlite3'))
+    output = subprocess.run(
+        [sys.executable, 'benchmark.py', '--requests', '10', '--warmup', '0', '--concurrency', '2',
+         '--users', '200', '--firestore-latency-ms', '0', '--fcm-latency-ms', '0',
+         '--scenarios', 'send-notification,get-user-notifications'],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, timeout=120, check=True
+    ).stdout
+    report = json.loads(output)
+
+    send = report['scenarios']['send-notification']
+    assert send['requests'] == 10 and send['errors'] == 0
+    assert send['fcmCallsPerRequest'] == {'send': 1.0}
+    assert send['latencyMs']['p50'] <= send['latencyMs']['p95'] <= send['latencyMs']['p99']
+    assert report['scenarios']['get-user-notifications']['firestoreCallsPerRequest'] == {'query': 1.0}
@@ -0,0 +1,107 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from firebase_admin import messaging
+
+from fanout import send_multicast_batched
+from local_backend import LocalFirestore, LocalMessaging
+from metrics import Metrics, TracedFirestore, TracedMessaging, fcm_error_code
+from profiler import SamplingProfiler
+from user_lookup import resolve_fcm_tokens
+
+
+def test_histogram_renders_cumulative_prometheus_buckets():
+    metrics = Metrics()
+    metrics.requests.observe(0.003, 'GET', '/health', '200')
+    metrics.requests.observe(0.2, 'GET', '/health', '200')
+    metrics.requests.observe(45.0, 'GET', '/health', '200')
+    lines = metrics.render().splitlines()
+
+    assert '# TYPE http_request_duration_seconds histogram' in lines
+    labels = 'method="GET",route="/health",status="200"'
+    assert f'http_request_duration_seconds_bucket{{{labels},le="0.005"}} 1' in lines
+    assert f'http_request_duration_seconds_bucket{{{labels},le="0.25"}} 2' in lines
+    assert f'http_request_duration_seconds_bucket{{{labels},le="30.0"}} 2' in lines
+    assert f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 3' in lines
+    assert f'http_request_duration_seconds_count{{{labels}}} 3' in lines
+
+
+def test_traced_backends_time_every_call_and_count_error_codes():
+    metrics = Metrics()
+    local_db = LocalFirestore()
+    local_db.seed('users', {f'u{i}': {'fcmToken': f't{i}'} for i in range(250)})
+    db = TracedFirestore(local_db, metrics)
+    fcm = TracedMessaging(LocalMessaging(failure_rate=1.0), metrics)
+
+    lookup = resolve_fcm_tokens(db, [f'u{i}' for i in range(250)], chunk_size=100)
+    db.collection('users').document('u1').set({'email': 'a@b.c'}, merge=True)
+    batch = db.batch()
+    batch.set(db.collection('notifications').document(), {'userId': 'u1'})
+    batch.commit()
+    list(db.collection('notifications').where('userId', '==', 'u1').stream())
+    send_multicast_batched(fcm, lookup.tokens, messaging.Notification(title='t', body='b'))
+
+    assert metrics.backend_calls.summary('firestore', 'get_all')[0] == 3
+    assert metrics.backend_calls.summary('firestore', 'set')[0] == 1
+    assert metrics.backend_calls.summary('firestore', 'commit')[0] == 1
+    assert metrics.backend_calls.summary('firestore', 'query')[0] == 1
+    assert metrics.backend_calls.summary('fcm', 'send_each_for_multicast')[0] == 1
+    assert metrics.fcm_errors.value('send_each_for_multicast', 'UNAVAILABLE') == 250
+    # Dry-run token checks are counted apart from pushes
+    send_multicast_batched(TracedMessaging(LocalMessaging(), metrics), lookup.tokens[:10], None, dry_run=True)
+    assert metrics.fcm_tokens.value('send_each_for_multicast', 'failure') == 250
+    assert metrics.fcm_tokens.value('send_each_for_multicast', 'success') == 0
+    assert metrics.fcm_tokens.value('send_each_for_multicast_dry_run', 'success') == 10
+    assert local_db.stats()['documents']['notifications'] == 1
+    assert fcm_error_code(messaging.UnregisteredError('gone')) == 'UNREGISTERED'
+
+
+def test_sampling_profiler_collects_stacks_only_while_running():
+    stop = threading.Event()
+
+    def busy_loop():
+        while not stop.is_set():
+            sum(range(1000))
+
+    worker = threading.Thread(target=busy_loop)
+    worker.start()
+    profiler = SamplingProfiler(interval=0.001).start()
+    try:
+        time.sleep(0.1)
+    finally:
+        profiler.stop()
+        stop.set()
+        worker.join()
+
+    samples = profiler.stats()['samples']
+    assert samples > 0 and not profiler.running
+    assert any('busy_loop' in stack for stack, _ in profiler.top())
+    time.sleep(0.01)
+    assert profiler.stats()['samples'] == samples
+
+
+def test_sampling_profiler_start_stop_races_and_stack_cap():
+    profiler = SamplingProfiler(interval=0.001, max_stacks=1)
+    toggles = [threading.Thread(target=profiler.start if i % 2 else profiler.stop) for i in range(40)]
+    for thread in toggles:
+        thread.start()
+    for thread in toggles:
+        thread.join()
+    profiler.start()
+    # This thread and the sleeper are sampled in different functions, giving two distinct stacks
+    sleeper = threading.Thread(target=lambda: time.sleep(0.1))
+    sleeper.start()
+    time.sleep(0.05)
+    profiler.stop()
+    sleeper.join()
+
+    # Only one sampling thread is left running at a time, and it stops for good
+    assert not profiler.running
+    assert not [t for t in threading.enumerate() if t.name == 'sampling-profiler']
+    stats = profiler.stats()
+    assert stats['distinctStacks'] <= 2 and stats['foldedSamples'] > 0
+    assert '(other stacks)' in dict(profiler.top())
@@ -0,0 +1,81 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+import pytest
+from google.api_core.exceptions import PermissionDenied, ServiceUnavailable
+
+from batcher import BackgroundBatcher
+from notification_log import NotificationLogWriter
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, ref, data):
+        self.writes.append(data)
+
+    def commit(self):
+        if self.db.errors:
+            raise self.db.errors.pop(0)
+        self.db.commits.append(self.writes)
+
+
+class FakeDb:
+    def __init__(self, errors=()):
+        self.commits = []
+        self.errors = list(errors)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def collection(self, name):
+        return self
+
+    def document(self):
+        return object()
+
+
+def test_writer_coalesces_records_into_batches():
+    db = FakeDb()
+    writer = NotificationLogWriter(db, batch_size=500, flush_interval=5.0).start()
+    writer.enqueue_many({'n': i} for i in range(1200))
+    writer.stop()
+
+    assert [len(batch) for batch in db.commits] == [500, 500, 200]
+    stats = writer.stats()
+    assert stats['written'] == 1200
+    assert stats['queueDepth'] == 0
+    assert stats['flushCount'] == 3
+
+
+def test_writer_drops_records_after_stop():
+    writer = NotificationLogWriter(FakeDb()).start()
+    writer.stop()
+
+    assert not writer.enqueue({'n': 1})
+    assert writer.stats()['dropped'] == 1
+    # The base class has no flush of its own to run
+    with pytest.raises(TypeError):
+        BackgroundBatcher(10, 1.0)
+
+
+def test_writer_retries_transient_commit_errors_before_dropping_records():
+    db = FakeDb(errors=[ServiceUnavailable('busy'), ServiceUnavailable('busy')])
+    writer = NotificationLogWriter(db, flush_interval=0.01, retry_delay=0.01).start()
+    writer.enqueue_many({'n': i} for i in range(3))
+    writer.stop()
+    assert [len(batch) for batch in db.commits] == [3]
+    assert (writer.stats()['written'], writer.stats()['retried']) == (3, 2)
+
+    # Permanent errors are not retried, and transient ones only commit_attempts times
+    db = FakeDb(errors=[PermissionDenied('denied')] + [ServiceUnavailable('busy')] * 2)
+    writer = NotificationLogWriter(db, batch_size=1, flush_interval=0.01, retry_delay=0.01, commit_attempts=2).start()
+    writer.enqueue_many([{'n': 1}, {'n': 2}, {'n': 3}])
+    writer.stop()
+    assert [batch[0]['n'] for batch in db.commits] == [3]
+    stats = writer.stats()
+    assert (stats['written'], stats['failed'], stats['retried']) == (1, 2, 1)
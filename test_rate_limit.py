@@ -0,0 +1,65 @@
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from rate_limit import DonorRateLimiter, QuietHours
+
+
+def test_bucket_allows_a_burst_then_refills_over_time():
+    limiter = DonorRateLimiter(capacity=3, refill_per_hour=6, max_donors=100)
+
+    assert limiter.acquire_many(['u1'] * 4, mono_now=0.0) == [True, True, True, False]
+    assert limiter.acquire_many(['u2', 'u1'], mono_now=0.0) == [True, False]
+    assert limiter.retry_after('u1', mono_now=0.0) == 601
+    # One token every ten minutes
+    assert limiter.acquire('u1', mono_now=600.0)
+    assert not limiter.acquire('u1', mono_now=600.0)
+    # Urgent sends may overdraw by a full bucket, then stop too
+    assert limiter.acquire_many(['u1'] * 4, urgent=True, mono_now=600.0) == [True, True, True, False]
+    assert limiter.stats()['throttled'] == 4
+
+    # A push that was not delivered is given back, up to a full bucket
+    assert limiter.acquire_many(['u2'] * 4, mono_now=600.0) == [True, True, True, False]
+    limiter.refund(['u2'], mono_now=600.0)
+    assert limiter.acquire_many(['u2'] * 2, mono_now=600.0) == [True, False]
+    limiter.refund(['u3'] * 5, mono_now=600.0)
+    assert limiter.acquire_many(['u3'] * 4, mono_now=600.0) == [True, True, True, False]
+    assert limiter.stats()['refunded'] == 6
+
+
+def test_quiet_hours_hold_back_only_non_urgent_pushes():
+    ist = timezone(timedelta(minutes=330))
+    night = datetime(2026, 3, 1, 23, 30, tzinfo=ist).timestamp()
+    day = datetime(2026, 3, 1, 12, 0, tzinfo=ist).timestamp()
+    quiet = QuietHours.parse('22-7', utc_offset_minutes=330)
+
+    assert quiet.active(night) and not quiet.active(day)
+    assert quiet.seconds_until_end(night) == int(7.5 * 3600)
+    assert QuietHours.parse('') is None
+
+    limiter = DonorRateLimiter(capacity=5, refill_per_hour=5, max_donors=10, quiet_hours=quiet)
+    assert limiter.acquire_many(['u1', 'u2'], wall_now=night) == [False, False]
+    assert limiter.acquire_many(['u1', 'u2'], urgent=True, wall_now=night) == [True, True]
+    assert limiter.stats()['quietHoursHeld'] == 2
+    assert limiter.retry_after('u3', mono_now=0.0, wall_now=night) == int(7.5 * 3600)
+
+    # Buckets run on the monotonic clock, which says nothing about the local time of day
+    assert limiter.acquire('u3', mono_now=night, wall_now=day)
+    assert limiter.acquire_many(['u4'] * 6, mono_now=5.0, wall_now=day) == [True] * 5 + [False]
+
+
+def test_compact_store_reuses_refilled_slots_before_evicting():
+    limiter = DonorRateLimiter(capacity=1, refill_per_hour=3600, max_donors=4)
+    assert limiter.slots == 8
+    assert limiter.stats()['memoryBytes'] == 8 * 20
+
+    # Every bucket has refilled a second later, so new donors take over slots without losing state
+    assert all(limiter.acquire_many([f'a{i}' for i in range(8)], mono_now=0.0))
+    assert all(limiter.acquire_many([f'b{i}' for i in range(8)], mono_now=2.0))
+    assert limiter.evictions == 0
+    # With every slot holding a drained bucket, a new donor evicts the stalest one
+    assert limiter.acquire('c0', mono_now=2.5)
+    assert limiter.evictions == 1
+    assert limiter.used_slots == 8
@@ -0,0 +1,93 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from request_index import RequestIndex, is_open_request
+
+
+def blood_request(lat, lon, group='O+', **extra):
+    data = {
+        'bloodGroup': group, 'units': 2, 'unitsFulfilled': 0, 'status': 'active', 'userId': 'requester',
+        'location': {'latitude': lat, 'longitude': lon}, 'contact': '+91 90000 00000',
+    }
+    data.update(extra)
+    return data
+
+
+def test_query_lists_compatible_open_requests_closest_first():
+    index = RequestIndex()
+    index.apply_request('far', blood_request(13.1, 80.2))
+    index.apply_request('near', blood_request(13.01, 80.2, group='AB+'))
+    index.apply_request('incompatible', blood_request(13.0, 80.2, group='O-'))
+    index.apply_request('own', blood_request(13.0, 80.2, userId='donor'))
+    index.apply_request('out-of-range', blood_request(14.0, 80.2))
+    index.apply_request('filled', blood_request(13.0, 80.2, unitsFulfilled=2))
+    index.apply_request('no-location', blood_request(13.0, 80.2, location=None))
+
+    version, matches, removed, full = index.query(13.0, 80.2, 15, donor_group='o+', exclude_user_id='donor')
+    assert [entry.request_id for _, entry in matches] == ['near', 'far']
+    assert full and removed == [] and version == 7
+    assert 'contact' not in matches[0][1].summary and matches[0][1].summary['bloodGroup'] == 'AB+'
+    assert len(index.query(13.0, 80.2, 15)[1]) == 4
+
+
+def test_delta_since_a_version_lists_changes_and_removals_nearby():
+    index = RequestIndex()
+    for n in range(3):
+        index.apply_request(f'r{n}', blood_request(13.0 + n * 0.01, 80.2))
+    index.apply_request('elsewhere', blood_request(28.6, 77.2))
+    since = index.version
+
+    index.apply_request('r0', blood_request(13.0, 80.2, status='completed'))
+    index.apply_request('r1', blood_request(13.01, 80.2, group='AB-'))
+    index.apply_request('r3', blood_request(13.03, 80.2))
+    index.apply_request('elsewhere', None)
+
+    _, matches, removed, full = index.query(13.0, 80.2, 15, donor_group='O+', since=since)
+    assert not full
+    assert [entry.request_id for _, entry in matches] == ['r3']
+    # r0 closed and r1 no longer accepts O+; the removal far away is not reported
+    assert removed == ['r0', 'r1']
+    assert index.query(13.0, 80.2, 15, since=index.version)[1:] == ([], [], False)
+
+
+def test_moved_request_is_removed_where_it_was():
+    index = RequestIndex()
+    index.apply_request('moved', blood_request(13.0, 80.2))
+    index.apply_request('stays', blood_request(13.01, 80.2))
+    since = index.version
+
+    index.apply_request('moved', blood_request(13.5, 80.2))
+    # Later updates in place must not lose the removal at the old position
+    index.apply_request('moved', blood_request(13.5, 80.2, unitsFulfilled=1))
+    index.apply_request('stays', blood_request(13.01, 80.2, urgency='critical'))
+
+    _, matches, removed, _ = index.query(13.0, 80.2, 15, since=since)
+    assert [entry.request_id for _, entry in matches] == ['stays'] and removed == ['moved']
+    _, matches, removed, _ = index.query(13.5, 80.2, 15, since=since)
+    assert [entry.request_id for _, entry in matches] == ['moved'] and removed == []
+    # A client covering both positions still sees it, so it is not removed
+    _, matches, removed, _ = index.query(13.25, 80.2, 40, since=since)
+    assert sorted(entry.request_id for _, entry in matches) == ['moved', 'stays'] and removed == []
+    assert index.stats()['tombstones'] == 1
+
+    # Closed and reopened where it was: listed again, not removed
+    index.apply_request('stays', None)
+    index.apply_request('stays', blood_request(13.01, 80.2))
+    _, matches, removed, _ = index.query(13.0, 80.2, 15, since=since)
+    assert [entry.request_id for _, entry in matches] == ['stays'] and removed == ['moved']
+
+
+def test_old_or_foreign_versions_fall_back_to_a_full_list():
+    index = RequestIndex(max_tombstones=2)
+    for n in range(4):
+        index.apply_request(f'r{n}', blood_request(13.0, 80.2 + n * 0.01))
+    for n in range(3):
+        index.apply_request(f'r{n}', None)
+
+    assert index.stats()['tombstones'] == 2
+    _, matches, removed, full = index.query(13.0, 80.2, 15, since=1)
+    assert full and removed == [] and [entry.request_id for _, entry in matches] == ['r3']
+    assert index.query(13.0, 80.2, 15, since=index.version + 5)[3]
+    assert not is_open_request({'status': 'accepted'}) and is_open_request({'status': 'active', 'units': 'x'})
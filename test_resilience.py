@@ -0,0 +1,141 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from google.api_core.exceptions import DeadlineExceeded, NotFound
+
+from local_backend import LocalFirestore, LocalMessaging
+from metrics import Metrics, TracedFirestore, TracedMessaging
+from resilience import (CLOSED, HALF_OPEN, OPEN, AdaptiveLimit, BackendUnavailable, CircuitBreaker, Dependency,
+                        deadline_scope)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_breaker_opens_on_dependency_failures_and_closes_after_a_successful_probe():
+    clock = FakeClock()
+    fs = LocalFirestore()
+    dependency = Dependency('firestore', CircuitBreaker(failure_threshold=3, reset_timeout=10, clock=clock),
+                            AdaptiveLimit(8))
+    db = TracedFirestore(fs, Metrics(), dependency)
+    user = db.collection('users').document('u1')
+
+    # A missing document is the caller's problem, not an outage
+    with pytest.raises(NotFound):
+        user.update({'name': 'x'})
+    fs.failure_rate = 1.0
+    for _ in range(3):
+        with pytest.raises(Exception) as failure:
+            user.get()
+        assert not isinstance(failure.value, BackendUnavailable)
+    assert dependency.breaker.state == OPEN
+
+    calls = fs.stats()['calls']['get']
+    with pytest.raises(BackendUnavailable) as rejected:
+        list(db.collection('users').stream())
+    assert (rejected.value.reason, rejected.value.retry_after) == ('open', 10)
+    assert fs.stats()['calls']['get'] == calls and 'query' not in fs.stats()['calls']
+
+    # The first probe fails and reopens the breaker for twice as long
+    clock.now += 10
+    with pytest.raises(Exception):
+        user.get()
+    assert dependency.breaker.state == OPEN and dependency.breaker.retry_after() == 20
+    clock.now += 20
+    fs.failure_rate = 0.0
+    assert dependency.breaker.allow() == (True, True) and dependency.breaker.state == HALF_OPEN
+    # Only one probe at a time
+    assert dependency.breaker.allow() == (False, False)
+    dependency.breaker.record(False, probe=True)
+    assert dependency.breaker.state == CLOSED
+    assert not user.get().exists
+    assert dependency.stats()['rejected'] == {'open': 1, 'overloaded': 0, 'deadline': 0}
+
+    dependency.breaker.force(OPEN)
+    clock.now += 1000
+    with pytest.raises(BackendUnavailable):
+        user.get()
+    dependency.breaker.force(CLOSED)
+    assert not user.get().exists
+
+
+def test_adaptive_limit_halves_on_slow_calls_grows_back_and_sheds_when_full():
+    clock = FakeClock()
+    limit = AdaptiveLimit(16, latency_target=0.5, clock=clock)
+    for _ in range(4):
+        assert limit.acquire(0)
+    # Four slow calls finishing together only cut the limit once
+    for _ in range(4):
+        limit.release(2.0)
+    assert (limit.limit, limit.decreases) == (8, 1)
+    clock.now += 0.5
+    assert limit.acquire(0)
+    limit.release(0.1, failed=True)
+    assert limit.limit == 4
+    for _ in range(4):
+        assert limit.acquire(0)
+        limit.release(0.1)
+    assert 4.9 < limit.limit < 5
+
+    messaging = LocalMessaging(latency=0.2)
+    dependency = Dependency('fcm', CircuitBreaker(), AdaptiveLimit(1, latency_target=1.0), max_wait=0.05)
+    traced = TracedMessaging(messaging, Metrics(), dependency)
+    message = messaging.Message(token='t1')
+    started = threading.Event()
+
+    def send():
+        started.set()
+        traced.send(message)
+
+    worker = threading.Thread(target=send)
+    worker.start()
+    started.wait()
+    time.sleep(0.05)
+    with pytest.raises(BackendUnavailable) as rejected:
+        traced.send(message)
+    worker.join()
+    assert rejected.value.reason == 'overloaded' and rejected.value.retry_after == 1.0
+    assert messaging.stats()['calls']['send'] == 1 and dependency.breaker.state == CLOSED
+
+    messaging.latency = 0
+    messaging.outage = True
+    for _ in range(5):
+        with pytest.raises(Exception):
+            traced.send(message)
+    assert dependency.breaker.state == OPEN
+
+
+def test_request_deadline_bounds_backend_calls_and_fails_fast_once_spent():
+    fs = LocalFirestore(latency=0.3)
+    fs.seed('users', {'u1': {'name': 'Donor'}})
+    dependency = Dependency('firestore', CircuitBreaker(), AdaptiveLimit(8, latency_target=1.0))
+    db = TracedFirestore(fs, Metrics(), dependency)
+
+    started = time.perf_counter()
+    with deadline_scope(0.05):
+        with pytest.raises(DeadlineExceeded):
+            db.collection('users').document('u1').get()
+    assert time.perf_counter() - started < 0.25
+    assert fs.stats()['timeouts'] == 1
+
+    with deadline_scope(0.0):
+        with pytest.raises(BackendUnavailable) as rejected:
+            list(db.get_all([db.collection('users').document('u1')]))
+    assert rejected.value.reason == 'deadline' and 'get_all' not in fs.stats()['calls']
+
+    # Without a deadline, as in background jobs, calls take as long as they take
+    fs.latency = 0.01
+    assert db.collection('users').document('u1').get().to_dict() == {'name': 'Donor'}
+    assert [doc.id for doc in db.collection('users').stream()] == ['u1']
+    assert dependency.stats()['inFlight'] == 0 and dependency.stats()['failures'] == 1
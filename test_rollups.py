@@ -0,0 +1,79 @@
+import gzip
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from local_backend import LocalFirestore
+from rollups import DAY, HOUR, archive_notifications, read_stats, rolled_up_until, rollup_notifications
+
+NOW = datetime(2026, 6, 2, 12, 30, tzinfo=timezone.utc)
+
+
+def log(minutes_ago, **fields):
+    record = {'userId': 'u1', 'title': 'Blood needed', 'status': 'sent', 'sentAt': NOW - timedelta(minutes=minutes_ago)}
+    record.update(fields)
+    return record
+
+
+def test_rollup_counts_complete_hours_into_hourly_and_daily_buckets():
+    db = LocalFirestore()
+    db.seed('notifications', {
+        'a': log(80, type='blood_request', bloodType='O+', urgency='critical'),
+        'b': log(85, type='blood_request', bloodType='O+', urgency='normal', error='Requested entity was not found.'),
+        'c': log(150, type='topic', topic='donors'),
+        'd': log(60 * 24, type='blood_request', bloodType='AB-'),
+        # Still inside the current hour, so not rolled up yet
+        'e': log(10, type='general'),
+    })
+
+    assert rollup_notifications(db, now=NOW) == (3, 4)
+    assert rolled_up_until(db) == datetime(2026, 6, 2, 12, tzinfo=timezone.utc)
+
+    hours = read_stats(db, HOUR, NOW - timedelta(hours=3), NOW)
+    assert [(h['bucketStart'].hour, h['count']) for h in hours] == [(10, 1), (11, 2)]
+    assert hours[1]['failed'] == 1 and hours[1]['byUrgency'] == {'critical': 1, 'normal': 1}
+    days = read_stats(db, DAY, NOW - timedelta(days=2), NOW)
+    assert [(d['bucketStart'].day, d['count']) for d in days] == [(1, 1), (2, 3)]
+    assert days[1]['byType'] == {'blood_request': 2, 'topic': 1} and days[1]['byTopic'] == {'donors': 1}
+
+
+def test_rollup_resumes_after_the_watermark_and_rewrites_days_idempotently():
+    db = LocalFirestore()
+    db.seed('notifications', {'a': log(80), 'b': log(10)})
+    rollup_notifications(db, now=NOW)
+    # Running again within the same hour does nothing
+    assert rollup_notifications(db, now=NOW) == (0, 0)
+
+    db.seed('notifications', {'late': log(90), 'c': log(5)})
+    later = NOW + timedelta(hours=1)
+    assert rollup_notifications(db, now=later) == (1, 2)
+    # A log written into an hour already rolled up stays out of the stats
+    days = read_stats(db, DAY, NOW - timedelta(hours=2), later)
+    assert [d['count'] for d in days] == [3]
+    assert rolled_up_until(db) == datetime(2026, 6, 2, 13, tzinfo=timezone.utc)
+
+
+def test_archive_moves_old_rolled_up_logs_to_gzip_files_and_deletes_them(tmp_path):
+    db = LocalFirestore()
+    db.seed('notifications', {
+        f'old{n}': log(60 * 24 * 40 + n, userId=f'u{n}', fcmToken='token') for n in range(5)
+    })
+    db.seed('notifications', {'recent': log(120), 'unrolled': log(10)})
+    older_than = NOW - timedelta(days=30)
+    # Nothing is archived before it has been counted
+    assert archive_notifications(db, str(tmp_path), older_than) == 0
+
+    rollup_notifications(db, now=NOW)
+    assert archive_notifications(db, str(tmp_path), older_than, page_size=2) == 5
+    assert sorted(db.stats()['documents'].items())[0] == ('notificationStats', 5)
+    assert sorted(doc.id for doc in db.collection('notifications').stream()) == ['recent', 'unrolled']
+
+    [archive] = os.listdir(tmp_path)
+    assert archive == 'notifications-2026-04-23.jsonl.gz'
+    with gzip.open(tmp_path / archive, 'rt') as f:
+        records = [json.loads(line) for line in f]
+    assert sorted(record['id'] for record in records) == [f'old{n}' for n in range(5)]
+    assert records[0]['sentAt'].startswith('2026-04-23')
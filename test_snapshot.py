@@ -0,0 +1,102 @@
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from blood_compat import CompatibilityIndex
+from donor_index import DonorIndex
+from donor_match import DonorTable
+from local_backend import LocalFirestore
+from snapshot import SnapshotError, load_donor_snapshot, load_snapshot, write_donor_snapshot, write_snapshot
+from views import CollectionView
+
+
+def donor(lat, lon, group='O+', **extra):
+    data = {'location': {'latitude': lat, 'longitude': lon}, 'bloodGroup': group, 'fcmToken': 'token'}
+    data.update(extra)
+    return data
+
+
+def test_snapshot_round_trips_columns_and_rejects_damaged_files(tmp_path):
+    path = str(tmp_path / 'test.snapshot')
+    size = write_snapshot(path, {'score': np.array([1.5, 2.5, 3.5]), 'flag': np.array([True, False, True])},
+                          {'ids': ['a', 'é', 'c'], 'tokens': ['t', None, '']}, {'readTime': 12.5})
+    assert size == os.path.getsize(path)
+
+    snapshot = load_snapshot(path)
+    assert snapshot.count == 3 and snapshot.meta == {'readTime': 12.5}
+    assert snapshot.columns['score'].tolist() == [1.5, 2.5, 3.5] and not snapshot.columns['score'].flags.writeable
+    assert snapshot.strings == {'ids': ['a', 'é', 'c'], 'tokens': ['t', '', '']}
+
+    with open(path, 'r+b') as f:
+        f.seek(-2, os.SEEK_END)
+        f.write(b'x')
+    with pytest.raises(SnapshotError):
+        load_snapshot(path)
+    with open(path, 'r+b') as f:
+        f.truncate(size // 2)
+    with pytest.raises(SnapshotError):
+        load_snapshot(path)
+    with pytest.raises(ValueError):
+        write_snapshot(path, {'score': np.zeros(2)}, {'ids': ['only one']})
+
+
+def test_donor_snapshot_restores_the_table_and_indexes(tmp_path):
+    path = str(tmp_path / 'donors.snapshot')
+    users = {
+        'near': donor(13.01, 80.2),
+        'recent': donor(13.02, 80.2, group='O-', lastDonation='2026-05-01'),
+        'unavailable': donor(13.0, 80.21, group='A+', isAvailable=False),
+        'no-token': donor(13.0, 80.22, fcmToken=None),
+        'unknown-group': donor(13.0, 80.23, group='??'),
+    }
+    table, index, compat = DonorTable(), DonorIndex(), CompatibilityIndex()
+    for user_id, data in users.items():
+        table.upsert(user_id, data)
+        index.upsert(user_id, data)
+        compat.apply_user(user_id, data)
+    table.record_notified(['near'] * 3)
+    write_donor_snapshot(path, table.export(), 100.0)
+
+    restored_table, restored_index, restored_compat = DonorTable(), DonorIndex(), CompatibilityIndex()
+    restored_table.record_notified(['near'] * 3)
+    snapshot = load_donor_snapshot(path, restored_table, restored_index, restored_compat)
+    assert snapshot.count == 5 and snapshot.meta['readTime'] == 100.0
+
+    now = time.time()
+    assert restored_table.match(13.0, 80.2, 25, 'AB+', 10, now=now) == table.match(13.0, 80.2, 25, 'AB+', 10, now=now)
+    assert ([(d, donor.user_id, donor.cells) for d, donor in restored_index.nearest(13.0, 80.2, 25, 10)]
+            == [(d, donor.user_id, donor.cells) for d, donor in index.nearest(13.0, 80.2, 25, 10)])
+    assert restored_compat.eligible_donors('AB+') == compat.eligible_donors('AB+') == {'near', 'recent', 'no-token'}
+
+    with pytest.raises(SnapshotError):
+        load_donor_snapshot(path, DonorTable(), DonorIndex(), CompatibilityIndex(), source='another-project')
+
+
+def test_warm_started_view_applies_only_changes_after_the_snapshot(tmp_path):
+    path = str(tmp_path / 'donors.snapshot')
+    db = LocalFirestore()
+    db.seed('users', {f'u{n}': donor(13.0 + n * 0.01, 80.2) for n in range(4)})
+    table = DonorTable()
+    view = CollectionView('users', table.apply_user).start(db)
+    read_time, exported = view.read_consistent(table.export)
+    write_donor_snapshot(path, exported, read_time.timestamp())
+    view.stop()
+
+    db.collection('users').document('u0').delete()
+    db.collection('users').document('u1').set(donor(13.01, 80.2, group='AB-'))
+    db.collection('users').document('u9').set(donor(13.09, 80.2))
+
+    restored = DonorTable()
+    snapshot = load_donor_snapshot(path, restored, DonorIndex(), CompatibilityIndex())
+    warm = CollectionView('users', restored.apply_user)
+    warm.start(db, snapshot.strings['userIds'], snapshot.meta['readTime'])
+    assert warm.stats()['skipped'] == 2 and warm.stats()['documents'] == 4
+    matches = restored.match(13.0, 80.2, 25, 'AB+', 10, now=time.time())
+    assert sorted(m.user_id for m in matches) == ['u1', 'u2', 'u3', 'u9']
+    # u1 turned AB- after the snapshot, so it no longer gives to O+
+    assert sorted(m.user_id for m in restored.match(13.0, 80.2, 25, 'O+', 10, now=time.time())) == ['u2', 'u3', 'u9']
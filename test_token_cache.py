@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from firebase_admin import messaging
+
+from token_cache import TokenCache, is_invalid_token_error
+
+
+def test_cache_evicts_least_recently_used():
+    cache = TokenCache(max_size=2, ttl=60)
+    cache.put('a', 'tok-a')
+    cache.put('b', 'tok-b')
+    cache.get('a')
+    cache.put('c', 'tok-c')
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 'tok-a'
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+
+
+def test_cache_entries_expire():
+    cache = TokenCache(ttl=0.01)
+    cache.put('a', 'tok-a')
+    time.sleep(0.02)
+
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_invalidate_only_matching_token():
+    cache = TokenCache()
+    cache.put('a', 'new-token')
+
+    assert not cache.invalidate('a', 'old-token')
+    assert cache.invalidate('a', 'new-token')
+    assert cache.get('a') is None
+
+
+def test_is_invalid_token_error():
+    assert is_invalid_token_error(messaging.UnregisteredError('gone'))
+    assert not is_invalid_token_error(RuntimeError('timeout'))
+    assert not is_invalid_token_error(None)
@@ -0,0 +1,83 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from firebase_admin import exceptions, messaging
+
+from local_backend import LocalFirestore, LocalMessaging
+from token_hygiene import TokenPruner, stale_token_reason, stale_tokens, sweep_tokens
+
+
+def test_stale_tokens_classifies_dead_token_errors_only():
+    responses = [
+        messaging.SendResponse({'name': 'm1'}, None),
+        messaging.SendResponse(None, messaging.UnregisteredError('gone')),
+        messaging.SendResponse(None, exceptions.UnavailableError('retry later')),
+        messaging.SendResponse(None, messaging.SenderIdMismatchError('other project')),
+    ]
+    assert stale_tokens(['u1', 'u2', 'u3', 'u4'], ['t1', 't2', 't3', 't4'], responses) == [
+        ('u2', 't2', 'UNREGISTERED'), ('u4', 't4', 'SENDER_ID_MISMATCH'),
+    ]
+    assert stale_token_reason(messaging.UnregisteredError('gone')) == 'UNREGISTERED'
+
+    # INVALID_ARGUMENT only blames the token when the same message reached other tokens
+    invalid = messaging.SendResponse(None, exceptions.InvalidArgumentError('bad token'))
+    assert stale_token_reason(invalid.exception) is None
+    assert stale_tokens(['u1'], ['t1'], [invalid]) == []
+    assert stale_tokens(['u1', 'u2'], ['t1', 't2'], [invalid, invalid]) == []
+    assert stale_tokens(['u1', 'u2'], ['t1', 't2'], [responses[0], invalid]) == [('u2', 't2', 'INVALID_ARGUMENT')]
+
+
+def test_pruner_clears_tokens_and_unsubscribes_topics_unless_refreshed():
+    db = LocalFirestore()
+    db.seed('users', {
+        'u1': {'fcmToken': 'dead1', 'name': 'A'}, 'u2': {'fcmToken': 'fresh2'}, 'u3': {'fcmToken': 'dead3'}
+    })
+    db.seed('topic_subscriptions', {
+        'u1_blood': {'userId': 'u1', 'topic': 'blood', 'status': 'subscribed', 'fcmToken': 'dead1'},
+        'u1_news': {'userId': 'u1', 'topic': 'news', 'status': 'unsubscribed', 'fcmToken': 'dead1'},
+    })
+    fcm = LocalMessaging()
+    pruned = []
+    pruner = TokenPruner(db, fcm, on_pruned=lambda user_id, token: pruned.append((user_id, token)))
+
+    get_all = db.get_all
+
+    def get_all_then_save_token(references, **kwargs):
+        snapshots = list(get_all(references, **kwargs))
+        # /save-fcm-token lands between the pruner's read and its write
+        db.collection('users').document('u3').set({'fcmToken': 'new3'}, merge=True)
+        return snapshots
+
+    db.get_all = get_all_then_save_token
+    # u2 refreshed its token after the failed send and u3 while it was being pruned, so only u1 is cleared
+    entries = [('u1', 'dead1', 'UNREGISTERED'), ('u2', 'dead2', 'UNREGISTERED'), ('u3', 'dead3', 'UNREGISTERED')]
+    assert pruner.prune(entries) == 1
+    assert db.collection('users').document('u3').get().to_dict()['fcmToken'] == 'new3'
+
+    user = db.collection('users').document('u1').get().to_dict()
+    assert 'fcmToken' not in user and user['name'] == 'A'
+    assert user['invalidFcmToken'] == 'dead1' and user['fcmTokenError'] == 'UNREGISTERED'
+    assert db.collection('users').document('u2').get().to_dict()['fcmToken'] == 'fresh2'
+    subscription = db.collection('topic_subscriptions').document('u1_blood').get().to_dict()
+    assert subscription['status'] == 'unsubscribed' and subscription['reason'] == 'stale-token'
+    assert fcm.stats()['calls'] == {'unsubscribe_from_topic': 1}
+    assert pruned == [('u1', 'dead1')]
+    assert pruner.stats()['pruned'] == 1 and pruner.stats()['skipped'] == 2
+
+
+def test_sweep_dry_runs_every_token_page_by_page():
+    db = LocalFirestore()
+    db.seed('users', {f'u{i:03}': {'fcmToken': f't{i}'} for i in range(120)})
+    db.seed('users', {'u999': {'name': 'no token'}})
+    fcm = LocalMessaging(invalid_tokens={'t7', 't42', 't119'})
+    pages = []
+
+    checked, stale = sweep_tokens(db, fcm, page_size=50, on_page=lambda n, s: pages.append((n, s)))
+
+    assert checked == 120
+    assert sorted(stale) == [('u007', 't7', 'UNREGISTERED'), ('u042', 't42', 'UNREGISTERED'),
+                             ('u119', 't119', 'UNREGISTERED')]
+    assert pages == [(50, 2), (50, 0), (20, 1)]
+    assert fcm.stats()['delivered'] == 0
@@ -0,0 +1,65 @@
+import os
+import sys
+import threading
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from firebase_admin import messaging
+
+from topics import is_valid_topic, manage_topic_subscriptions, subscription_id, write_subscription_records
+
+
+def make_messaging(bad_tokens=()):
+    calls = []
+    lock = threading.Lock()
+
+    def subscribe_to_topic(tokens, topic):
+        with lock:
+            calls.append((topic, len(tokens)))
+        return messaging.TopicManagementResponse({'results': [
+            {'error': 'NOT_FOUND'} if token in bad_tokens else {} for token in tokens
+        ]})
+
+    return SimpleNamespace(subscribe_to_topic=subscribe_to_topic), calls
+
+
+def test_manage_topic_subscriptions_chunks_per_topic():
+    fake, calls = make_messaging(bad_tokens={'t5', 't1500'})
+    user_ids = [f'u{i}' for i in range(2500)]
+    tokens = [f't{i}' for i in range(2500)]
+
+    results = manage_topic_subscriptions(fake, user_ids, tokens, ['a', 'b'])
+
+    assert sorted(calls) == sorted([(topic, n) for topic in 'ab' for n in (1000, 1000, 500)])
+    assert len(results['a']['succeeded']) == 2498
+    assert [e['userId'] for e in results['b']['errors']] == ['u5', 'u1500']
+    assert results['b']['errors'][0]['reason'] == 'NOT_FOUND'
+
+
+def test_write_subscription_records_uses_deterministic_ids():
+    commits = []
+
+    class Batch:
+        def __init__(self):
+            self.writes = []
+
+        def set(self, ref, data, merge=False):
+            self.writes.append((ref, merge))
+
+        def commit(self):
+            commits.append(self.writes)
+
+    collection = SimpleNamespace(document=lambda doc_id: doc_id)
+    db = SimpleNamespace(collection=lambda name: collection, batch=Batch)
+    records = [{'userId': f'u{i}', 'topic': 'news'} for i in range(1200)]
+
+    assert write_subscription_records(db, records) == 1200
+    assert [len(c) for c in commits] == [500, 500, 200]
+    assert commits[0][0] == (subscription_id('u0', 'news'), True)
+
+
+def test_is_valid_topic():
+    assert is_valid_topic('blood_type_opos')
+    assert not is_valid_topic('bad topic')
+    assert not is_valid_topic(None)
@@ -0,0 +1,61 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from user_lookup import resolve_fcm_tokens
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return self._data
+
+
+class FakeRef:
+    def __init__(self, doc_id):
+        self.id = doc_id
+
+
+class FakeCollection:
+    def document(self, doc_id):
+        return FakeRef(doc_id)
+
+
+class FakeDb:
+    def __init__(self, users):
+        self.users = users
+        self.calls = []
+
+    def collection(self, name):
+        return FakeCollection()
+
+    def get_all(self, refs, field_paths=None):
+        self.calls.append(([ref.id for ref in refs], field_paths))
+        # get_all does not guarantee ordering, so return the chunk reversed
+        for ref in reversed(refs):
+            yield FakeSnapshot(ref.id, self.users.get(ref.id))
+
+
+def test_resolve_fcm_tokens_classifies_users():
+    db = FakeDb({'a': {'fcmToken': 'tok-a'}, 'b': {}, 'c': {'fcmToken': 'tok-c'}})
+    lookup = resolve_fcm_tokens(db, ['c', 'missing', 'a', 'b', 'a'])
+
+    assert lookup.user_ids == ['c', 'a']
+    assert lookup.tokens == ['tok-c', 'tok-a']
+    assert lookup.missing == ['missing']
+    assert lookup.without_token == ['b']
+    assert db.calls == [(['c', 'missing', 'a', 'b'], ['fcmToken'])]
+
+
+def test_resolve_fcm_tokens_chunks_requests():
+    users = {f'user{i}': {'fcmToken': f'tok{i}'} for i in range(250)}
+    db = FakeDb(users)
+    lookup = resolve_fcm_tokens(db, list(users), chunk_size=100)
+
+    assert len(db.calls) == 3
+    assert lookup.tokens == [f'tok{i}' for i in range(250)]
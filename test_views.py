@@ -0,0 +1,69 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from local_backend import LocalFirestore
+from views import LIVE, RESYNCING, STOPPED, CollectionView, ViewWatchdog
+
+
+def test_view_loads_the_collection_and_follows_changes():
+    db = LocalFirestore()
+    db.seed('users', {'u1': {'bloodGroup': 'O+'}, 'u2': {'bloodGroup': 'A-'}})
+    mirror = {}
+    synced = []
+    view = CollectionView('users', lambda doc_id, data: mirror.__setitem__(doc_id, data),
+                          on_synced=lambda: synced.append(True)).start(db)
+
+    assert view.state == LIVE and synced == [True]
+    db.collection('users').document('u1').set({'bloodGroup': 'B+'})
+    db.collection('users').document('u2').delete()
+    assert mirror == {'u1': {'bloodGroup': 'B+'}, 'u2': None}
+    stats = view.stats()
+    assert stats['documents'] == 1 and stats['changes'] == 4 and stats['resyncs'] == 0
+    assert stats['lastReadTime'] is not None
+
+    view.stop()
+    db.collection('users').document('u3').set({'bloodGroup': 'O-'})
+    assert 'u3' not in mirror and view.state == STOPPED
+
+
+def test_dead_listener_is_replaced_and_missed_deletes_are_applied():
+    db = LocalFirestore()
+    db.seed('requests', {f'r{n}': {'status': 'active'} for n in range(3)})
+    mirror = {}
+    view = CollectionView('requests', lambda doc_id, data: mirror.__setitem__(doc_id, data)).start(db)
+    watchdog = ViewWatchdog([view])
+    assert watchdog.check() == 0
+
+    # The stream dies; changes made meanwhile only arrive through the resync
+    view._watch.close('stream reset')
+    db.collection('requests').document('r0').delete()
+    db.collection('requests').document('r1').set({'status': 'completed'})
+    assert mirror['r0'] == {'status': 'active'}
+
+    assert watchdog.check() == 1
+    assert mirror == {'r0': None, 'r1': {'status': 'completed'}, 'r2': {'status': 'active'}}
+    assert view.state == LIVE and view.resyncs == 1 and view.stats()['documents'] == 2
+    db.collection('requests').document('r3').set({'status': 'active'})
+    assert mirror['r3'] == {'status': 'active'}
+
+
+def test_failed_resubscribe_is_retried_on_the_next_check():
+    db = LocalFirestore()
+    mirror = {}
+    view = CollectionView('users', lambda doc_id, data: mirror.__setitem__(doc_id, data)).start(db)
+    view._watch.close()
+
+    def unavailable(callback):
+        raise ConnectionError('firestore unavailable')
+
+    original = db._listen
+    db._listen = lambda collection, callback: unavailable(callback)
+    assert view.check()
+    assert view.state == RESYNCING and view.stats()['lastError'] == 'firestore unavailable'
+
+    db._listen = original
+    db.seed('users', {'u1': {'bloodGroup': 'O+'}})
+    assert view.check()
+    assert view.state == LIVE and view.resyncs == 2 and mirror == {'u1': {'bloodGroup': 'O+'}}
@@ -0,0 +1,67 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flask-backend'))
+
+from waves import ACTIVE, CANCELLED, FAILED, WaveScheduler, WaveStore
+
+
+def test_scheduler_fires_in_due_order_and_honours_earlier_reschedules():
+    fired = []
+    done = threading.Event()
+
+    def fire(key):
+        fired.append(key)
+        if len(fired) == 3:
+            done.set()
+
+    scheduler = WaveScheduler(fire).start()
+    try:
+        now = time.time()
+        scheduler.schedule('late', now + 0.15)
+        scheduler.schedule('early', now + 0.05)
+        # A new earliest deadline wakes the thread before the one it is waiting on
+        scheduler.schedule('now', now)
+        assert done.wait(2)
+    finally:
+        scheduler.stop()
+    assert fired == ['now', 'early', 'late']
+    assert len(scheduler) == 0
+
+
+def test_due_wave_is_claimed_once_and_survives_a_reopen(tmp_path):
+    path = str(tmp_path / 'waves.sqlite3')
+    store = WaveStore(path)
+    wave_id = store.create({'requestId': 'r1'}, next_at=time.time() - 1)
+    later_id = store.create({'requestId': 'r2'}, next_at=time.time() + 3600)
+
+    # Another process reopening the same database sees the same pending dispatches
+    reopened = WaveStore(path)
+    assert sorted(wave for wave, _ in reopened.pending()) == sorted([wave_id, later_id])
+    assert reopened.take_due(later_id) is None
+    assert reopened.take_due(wave_id) == 0
+    assert store.take_due(wave_id) is None
+    assert [wave for wave, _ in store.pending()] == [later_id]
+
+    assert store.finish(later_id, CANCELLED)
+    assert not store.finish(later_id, CANCELLED)
+    assert store.pending() == []
+
+
+def test_record_wave_is_compare_and_set_and_failures_stop_the_dispatch(tmp_path):
+    store = WaveStore(str(tmp_path / 'waves.sqlite3'))
+    wave_id = store.create({'requestId': 'r1'})
+
+    assert store.record_wave(wave_id, 0, 2, ['u1', 'u2'], {'recipientCount': 2}, next_at=100.0)
+    assert not store.record_wave(wave_id, 0, 2, ['u3'], {'recipientCount': 1}, next_at=200.0)
+    dispatch = store.get(wave_id)
+    assert (dispatch['wave'], dispatch['notified'], dispatch['next_at']) == (2, ['u1', 'u2'], 100.0)
+    assert dispatch['history'] == [{'recipientCount': 2}]
+
+    store.reschedule(wave_id, 2, 300.0, max_failures=2)
+    assert (store.get(wave_id)['status'], store.get(wave_id)['next_at']) == (ACTIVE, 300.0)
+    store.reschedule(wave_id, 2, 400.0, max_failures=2)
+    assert (store.get(wave_id)['status'], store.get(wave_id)['next_at']) == (FAILED, None)
+    assert store.counts() == {FAILED: 1}